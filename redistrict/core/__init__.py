@@ -3,3 +3,4 @@ Core module
 """
 
 from .core_utils import CoreUtils  # NOQA
+from .process_dissolver import ProcessPoolDissolver  # NOQA
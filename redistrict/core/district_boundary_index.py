@@ -0,0 +1,470 @@
+"""
+LINZ Redistricting Plugin - District boundary index
+"""
+
+from functools import partial
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple
+)
+
+from qgis.PyQt.QtCore import (
+    QCoreApplication,
+    QObject
+)
+from qgis.core import (
+    QgsApplication,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsPointXY,
+    QgsRectangle,
+    QgsSpatialIndex,
+    QgsTask,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource
+)
+
+
+class DistrictBoundaries:
+    """
+    Spatial indexes of target features, and of the shared boundaries between
+    pairs of neighbouring target features assigned to different districts.
+
+    This class holds no references to layers, so it can be built from a feature
+    source within a background task (see DistrictBoundaryIndexTask).
+    """
+
+    def __init__(self):
+        self.feature_index = QgsSpatialIndex()
+        self.feature_bounds: Dict[int, QgsRectangle] = {}
+        self.districts = {}
+
+        self.boundary_index = QgsSpatialIndex()
+        self.next_boundary_id = 0
+        # boundary id to (feature id, neighbour feature id, boundary feature)
+        self.boundaries: Dict[int, Tuple[int, int, QgsFeature]] = {}
+        # feature id to ids of all indexed boundaries for feature
+        self.feature_boundaries: Dict[int, Set[int]] = {}
+
+    @staticmethod
+    def from_source(source, target_field_index: int,
+                    is_canceled: Optional[Callable[[], bool]] = None,
+                    progress: Optional[Callable[[float], None]] = None) -> Optional['DistrictBoundaries']:
+        """
+        Builds district boundaries from all features in a feature source
+        :param source: feature source (or layer) for target features
+        :param target_field_index: index of field containing the district assigned to target features
+        :param is_canceled: optional callback which returns True if the build should be canceled
+        :param progress: optional callback for reporting progress, as a percentage
+        :returns built boundaries, or None if the build was canceled
+        """
+        boundaries = DistrictBoundaries()
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([target_field_index])
+        geometries = {}
+        for f in source.getFeatures(request):
+            if is_canceled is not None and is_canceled():
+                return None
+            if not f.hasGeometry():
+                continue
+
+            boundaries.add_feature(f.id(), f.geometry().boundingBox(), f[target_field_index])
+            geometries[f.id()] = f.geometry()
+
+        pairs = boundaries.candidate_pairs(geometries.keys())
+        if not boundaries.add_boundaries(pairs, geometries, is_canceled=is_canceled, progress=progress):
+            return None
+        return boundaries
+
+    def add_feature(self, feature_id: int, bounds: QgsRectangle, district):
+        """
+        Adds a target feature to the feature index. Boundaries for the feature
+        are not calculated.
+        :param feature_id: target feature ID
+        :param bounds: bounding box of target feature
+        :param district: district assigned to target feature
+        """
+        self.feature_index.addFeature(feature_id, bounds)
+        self.feature_bounds[feature_id] = bounds
+        self.districts[feature_id] = district
+
+    def remove_feature(self, feature_id: int):
+        """
+        Removes a target feature, and all of its boundaries, from the index
+        :param feature_id: target feature ID
+        """
+        self.remove_boundaries(feature_id)
+        bounds = self.feature_bounds.pop(feature_id, None)
+        self.districts.pop(feature_id, None)
+        if bounds is not None:
+            indexed = QgsFeature(feature_id)
+            indexed.setGeometry(QgsGeometry.fromRect(bounds))
+            self.feature_index.deleteFeature(indexed)
+
+    def candidate_pairs(self, feature_ids: Iterable[int]) -> Set[Tuple[int, int]]:
+        """
+        Returns all pairs of features with different districts and overlapping bounding boxes,
+        where at least one feature from each pair is from the specified list
+        :param feature_ids: feature IDs to find candidate pairs for
+        """
+        pairs = set()
+        for feature_id in feature_ids:
+            district = self.districts[feature_id]
+            for candidate in self.feature_index.intersects(self.feature_bounds[feature_id]):
+                if candidate != feature_id and candidate in self.districts and \
+                        self.districts[candidate] != district:
+                    pairs.add((min(feature_id, candidate), max(feature_id, candidate)))
+        return pairs
+
+    def add_boundaries(self, pairs: Iterable[Tuple[int, int]], geometries: Dict[int, QgsGeometry],
+                       is_canceled: Optional[Callable[[], bool]] = None,
+                       progress: Optional[Callable[[float], None]] = None) -> bool:
+        """
+        Calculates and indexes the shared boundaries for pairs of features
+        :param pairs: feature pairs to calculate boundaries for
+        :param geometries: dictionary of feature ID to geometry, for all features in pairs
+        :param is_canceled: optional callback which returns True if calculation should be canceled
+        :param progress: optional callback for reporting progress, as a percentage
+        :returns False if the calculation was canceled
+        """
+        pairs = list(pairs)
+        engines = {}
+        for i, (feature_id, neighbour_id) in enumerate(pairs):
+            if i % 100 == 0:
+                if is_canceled is not None and is_canceled():
+                    return False
+                if progress is not None:
+                    progress(100 * i / len(pairs))
+
+            geometry = geometries.get(feature_id)
+            neighbour_geometry = geometries.get(neighbour_id)
+            if geometry is None or neighbour_geometry is None:
+                continue
+
+            engine = engines.get(feature_id)
+            if engine is None:
+                engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+                engine.prepareGeometry()
+                engines[feature_id] = engine
+            if not engine.intersects(neighbour_geometry.constGet()):
+                continue
+
+            shared = geometry.intersection(neighbour_geometry)
+            if shared.isNull():
+                # intersection fails for some invalid geometries
+                shared = geometry.makeValid().intersection(neighbour_geometry.makeValid())
+            if shared.isEmpty():
+                continue
+
+            boundary = QgsFeature(self.next_boundary_id)
+            self.next_boundary_id += 1
+            boundary.setGeometry(shared)
+            self.boundary_index.addFeature(boundary)
+            self.boundaries[boundary.id()] = (feature_id, neighbour_id, boundary)
+            self.feature_boundaries.setdefault(feature_id, set()).add(boundary.id())
+            self.feature_boundaries.setdefault(neighbour_id, set()).add(boundary.id())
+        return True
+
+    def remove_boundaries(self, feature_id: int):
+        """
+        Removes all indexed boundaries for a feature
+        :param feature_id: target feature ID
+        """
+        for boundary_id in self.feature_boundaries.pop(feature_id, set()):
+            first, second, boundary = self.boundaries.pop(boundary_id)
+            self.boundary_index.deleteFeature(boundary)
+            other = second if first == feature_id else first
+            if other in self.feature_boundaries:
+                self.feature_boundaries[other].discard(boundary_id)
+
+
+class DistrictBoundaryIndexTask(QgsTask):
+    """
+    A background task for building district boundaries from a snapshot of the
+    target layer
+    """
+
+    def __init__(self, task_name: str, target_layer: QgsVectorLayer, target_field_index: int):
+        """
+        Constructor for DistrictBoundaryIndexTask
+        :param task_name: user-visible, translated name for task
+        :param target_layer: target layer (e.g. meshblocks)
+        :param target_field_index: index of field containing the district assigned to target features
+        """
+        super().__init__(task_name)
+        self.source = QgsVectorLayerFeatureSource(target_layer)
+        self.target_field_index = target_field_index
+        self.boundaries: Optional[DistrictBoundaries] = None
+
+    def run(self):  # pylint: disable=missing-docstring
+        self.boundaries = DistrictBoundaries.from_source(self.source, self.target_field_index,
+                                                         is_canceled=self.isCanceled, progress=self.setProgress)
+        return self.boundaries is not None
+
+
+class DistrictBoundaryIndex(QObject):
+    """
+    A spatial index of the boundaries which separate target features
+    assigned to different districts.
+
+    Only the shared boundaries between pairs of neighbouring features with
+    different districts are indexed, so lookups for district boundaries
+    near a point do not need to consider the (much larger) set of boundaries
+    interior to districts.
+
+    The index is built in a background task on first use (or by calling
+    build_in_background()), and lookups made before the build completes
+    fall back to querying the target layer directly, with no district boundaries
+    reported. Changes made through the layer's edit buffer (e.g. by a redistrict
+    handler, or by undoing redistricting operations) are tracked, and the
+    boundaries surrounding changed features are recalculated on the next lookup.
+    Changes made directly to the layer's data provider are not tracked, and
+    require a call to invalidate().
+    """
+
+    def __init__(self, target_layer: QgsVectorLayer, target_field: str):
+        """
+        Constructor
+        :param target_layer: target layer (e.g. meshblocks)
+        :param target_field: field containing the district assigned to target features
+        """
+        super().__init__()
+        self.target_layer = target_layer
+        self.target_field = target_field
+        self.target_field_index = target_layer.fields().lookupField(target_field)
+        assert self.target_field_index >= 0
+
+        self._data: Optional[DistrictBoundaries] = None
+        self._build_task: Optional[DistrictBoundaryIndexTask] = None
+        # district changes made while the index is being built, applied once the build completes
+        self._pending_districts = {}
+        # features with changed districts, which require their boundaries to be recalculated
+        self._dirty: Set[int] = set()
+        # features which have been added, deleted or had their geometry changed
+        self._stale: Set[int] = set()
+
+        target_layer.attributeValueChanged.connect(self._attribute_value_changed)
+        target_layer.geometryChanged.connect(self._feature_changed)
+        target_layer.featureAdded.connect(self._feature_changed)
+        target_layer.featureDeleted.connect(self._feature_changed)
+
+    def invalidate(self, *_):
+        """
+        Invalidates the index, forcing a full rebuild on next use
+        """
+        if self._build_task is not None:
+            self._build_task.cancel()
+            self._build_task = None
+        self._data = None
+        self._pending_districts = {}
+        self._dirty = set()
+        self._stale = set()
+
+    def is_built(self) -> bool:
+        """
+        Returns True if the index is currently built
+        """
+        return self._data is not None
+
+    def is_building(self) -> bool:
+        """
+        Returns True if the index is currently being built in a background task
+        """
+        return self._build_task is not None
+
+    def build(self):
+        """
+        Builds the index from the current target layer contents, blocking until
+        the build is complete
+        """
+        self.invalidate()
+        self._data = DistrictBoundaries.from_source(self.target_layer, self.target_field_index)
+
+    def build_in_background(self):
+        """
+        Starts building the index in a background task, if it is not already built or
+        being built. The index is used as soon as the task completes.
+        """
+        if self._data is not None or self._build_task is not None:
+            return
+
+        self._pending_districts = {}
+        self._stale = set()
+        task = DistrictBoundaryIndexTask(
+            QCoreApplication.translate('LinzRedistrict', 'Indexing district boundaries'),
+            target_layer=self.target_layer, target_field_index=self.target_field_index)
+        task.taskCompleted.connect(partial(self._build_completed, task))
+        task.taskTerminated.connect(partial(self._build_terminated, task))
+        self._build_task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def _build_completed(self, task: DistrictBoundaryIndexTask):
+        """
+        Triggered when a background build completes
+        """
+        if task is not self._build_task:
+            # index was invalidated during the build
+            return
+
+        self._build_task = None
+        self._data = task.boundaries
+        # apply changes made since the task's snapshot of the layer was taken
+        for feature_id, district in self._pending_districts.items():
+            if feature_id in self._data.districts:
+                self._data.districts[feature_id] = district
+                self._dirty.add(feature_id)
+        self._pending_districts = {}
+
+    def _build_terminated(self, task: DistrictBoundaryIndexTask):
+        """
+        Triggered when a background build fails or is canceled
+        """
+        if task is self._build_task:
+            self._build_task = None
+            self._pending_districts = {}
+
+    def _attribute_value_changed(self, feature_id: int, field_index: int, value):
+        """
+        Triggered when an attribute value is changed in the target layer's edit buffer
+        """
+        if field_index != self.target_field_index:
+            return
+
+        if self._build_task is not None:
+            self._pending_districts[feature_id] = value
+            return
+
+        if self._data is None or feature_id not in self._data.districts:
+            return
+
+        self._data.districts[feature_id] = value
+        self._dirty.add(feature_id)
+
+    def _feature_changed(self, feature_id: int, *_):
+        """
+        Triggered when a feature is added to or deleted from the target layer,
+        or its geometry is changed
+        """
+        if self._data is None and self._build_task is None:
+            return
+
+        self._stale.add(feature_id)
+
+    def _update(self) -> bool:
+        """
+        Ensures the index is built, and recalculates the boundaries for any
+        changed features
+        :returns True if the index is built, or False if it is still being built
+        """
+        if self._data is None:
+            self.build_in_background()
+            return False
+
+        if self._stale:
+            stale = self._stale
+            self._stale = set()
+            for feature_id in stale:
+                self._data.remove_feature(feature_id)
+
+            request = QgsFeatureRequest().setFilterFids(stale)
+            request.setSubsetOfAttributes([self.target_field_index])
+            for f in self.target_layer.getFeatures(request):
+                if f.hasGeometry():
+                    self._data.add_feature(f.id(), f.geometry().boundingBox(), f[self.target_field_index])
+                    self._dirty.add(f.id())
+
+        if not self._dirty:
+            return True
+
+        dirty = {feature_id for feature_id in self._dirty if feature_id in self._data.districts}
+        self._dirty = set()
+        for feature_id in dirty:
+            self._data.remove_boundaries(feature_id)
+
+        pairs = self._data.candidate_pairs(dirty)
+        if not pairs:
+            return True
+
+        request = QgsFeatureRequest().setFilterFids({feature_id for pair in pairs for feature_id in pair})
+        request.setNoAttributes()
+        geometries = {f.id(): f.geometry() for f in self.target_layer.getFeatures(request)}
+        self._data.add_boundaries(pairs, geometries)
+        return True
+
+    def boundary_count(self) -> int:
+        """
+        Returns the number of indexed district boundaries
+        """
+        if not self._update():
+            return 0
+        return len(self._data.boundaries)
+
+    def district(self, feature_id: int):
+        """
+        Returns the district for a target feature, or None if the feature is not
+        present in the index
+        :param feature_id: target feature ID
+        """
+        if self._update():
+            return self._data.districts.get(feature_id)
+
+        request = QgsFeatureRequest().setFilterFid(feature_id)
+        request.setSubsetOfAttributes([self.target_field_index])
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        for f in self.target_layer.getFeatures(request):
+            return f[self.target_field_index]
+        return None
+
+    def features_near(self, point: QgsPointXY, tolerance: float) -> List[int]:
+        """
+        Returns the IDs of target features with bounding boxes within a tolerance of a point
+        :param point: point, in target layer CRS
+        :param tolerance: search tolerance, in target layer units
+        """
+        rect = QgsRectangle(point.x() - tolerance, point.y() - tolerance,
+                            point.x() + tolerance, point.y() + tolerance)
+        if self._update():
+            return self._data.feature_index.intersects(rect)
+
+        request = QgsFeatureRequest().setFilterRect(rect)
+        request.setNoAttributes()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        return [f.id() for f in self.target_layer.getFeatures(request)]
+
+    def boundary_matches(self, point: QgsPointXY, tolerance: float) -> List[Tuple[int, float, QgsPointXY]]:
+        """
+        Returns the target features with a district boundary within a tolerance of a point.
+        No matches are returned while the index is being built.
+        :param point: point, in target layer CRS
+        :param tolerance: search tolerance, in target layer units
+        :return: list of (feature ID, distance to boundary, closest point on boundary), with
+        each feature listed once only, sorted by distance
+        """
+        if not self._update():
+            return []
+
+        rect = QgsRectangle(point.x() - tolerance, point.y() - tolerance,
+                            point.x() + tolerance, point.y() + tolerance)
+        point_geometry = QgsGeometry.fromPointXY(point)
+
+        nearest = {}
+        for boundary_id in self._data.boundary_index.intersects(rect):
+            feature_id, neighbour_id, boundary = self._data.boundaries[boundary_id]
+            distance = boundary.geometry().distance(point_geometry)
+            if distance < 0 or distance > tolerance:
+                continue
+
+            closest = boundary.geometry().nearestPoint(point_geometry).asPoint()
+            for target_id in (feature_id, neighbour_id):
+                if target_id not in nearest or distance < nearest[target_id][0]:
+                    nearest[target_id] = (distance, closest)
+
+        return sorted([(feature_id, distance, closest) for feature_id, (distance, closest) in nearest.items()],
+                      key=lambda match: match[1])
@@ -0,0 +1,135 @@
+"""
+LINZ Redistricting Plugin - Process pool dissolver
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor
+)
+from typing import (
+    List,
+    Optional,
+    Union
+)
+
+from qgis.core import QgsGeometry
+
+
+def dissolve_wkb(parts: List[bytes]) -> bytes:
+    """
+    Dissolves a list of WKB geometries, returning the result as WKB.
+
+    This is run within worker processes, so only picklable types may be
+    passed in and out.
+    :param parts: list of WKB encoded geometries to dissolve
+    """
+    from redistrict.core.core_utils import CoreUtils  # pylint: disable=import-outside-toplevel
+
+    geometries = []
+    for wkb in parts:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        geometries.append(geometry)
+
+    output = CoreUtils.union_geometries(geometries)
+    output.makeValid()
+    if output.isEmpty():
+        return b''
+    return bytes(output.asWkb())
+
+
+class ProcessPoolDissolver:
+    """
+    Dissolves geometries using a pool of worker processes, avoiding
+    contention on the Python interpreter lock.
+
+    Geometries are sent to and returned from the worker processes as WKB.
+    A single pool is shared between all tasks, since starting the worker
+    processes is expensive.
+    """
+
+    _instance: Optional['ProcessPoolDissolver'] = None
+
+    def __init__(self, max_workers: Optional[int] = None):
+        """
+        Constructor for ProcessPoolDissolver
+        :param max_workers: maximum number of worker processes. If not set,
+        the number of available CPUs will be used.
+        """
+        context = multiprocessing.get_context('spawn')
+        executable = ProcessPoolDissolver.python_executable()
+        if executable:
+            context.set_executable(executable)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+    @staticmethod
+    def instance() -> 'ProcessPoolDissolver':
+        """
+        Returns the shared dissolver instance, creating it if required
+        """
+        if ProcessPoolDissolver._instance is None:
+            ProcessPoolDissolver._instance = ProcessPoolDissolver()
+        return ProcessPoolDissolver._instance
+
+    @staticmethod
+    def shutdown_instance():
+        """
+        Shuts down the shared dissolver instance, if it exists
+        """
+        if ProcessPoolDissolver._instance is not None:
+            ProcessPoolDissolver._instance.executor.shutdown(wait=False, cancel_futures=True)
+            ProcessPoolDissolver._instance = None
+
+    @staticmethod
+    def python_executable() -> Optional[str]:
+        """
+        Returns the Python interpreter to use for worker processes. Within QGIS,
+        sys.executable is the QGIS application itself, which can't be used
+        to spawn workers.
+        """
+        if os.path.basename(sys.executable).lower().startswith('python'):
+            return sys.executable
+
+        if sys.platform == 'win32':
+            candidate = os.path.join(sys.exec_prefix, 'python.exe')
+            if os.path.exists(candidate):
+                return candidate
+        else:
+            version = f'python{sys.version_info.major}.{sys.version_info.minor}'
+            for name in (version, f'python{sys.version_info.major}'):
+                candidate = os.path.join(sys.exec_prefix, 'bin', name)
+                if os.path.exists(candidate):
+                    return candidate
+                candidate = shutil.which(name)
+                if candidate:
+                    return candidate
+
+        return None
+
+    def submit(self, geometries: List[QgsGeometry]) -> Future:
+        """
+        Submits a list of geometries for dissolving. The returned future's
+        result is the dissolved geometry as WKB, or an empty bytes object if
+        the result was empty.
+        :param geometries: geometries to dissolve
+        """
+        return self.executor.submit(dissolve_wkb, [bytes(g.asWkb()) for g in geometries])
+
+    @staticmethod
+    def geometry_from_result(wkb: Union[bytes, QgsGeometry]) -> QgsGeometry:
+        """
+        Converts a WKB result from a worker process back to a geometry
+        :param wkb: WKB result. Geometries (e.g. results from thread based workers)
+        are returned unchanged.
+        """
+        if isinstance(wkb, QgsGeometry):
+            return wkb
+
+        geometry = QgsGeometry()
+        if wkb:
+            geometry.fromWkb(wkb)
+        return geometry
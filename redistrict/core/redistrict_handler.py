@@ -70,11 +70,14 @@ class RedistrictHandler(QObject):
         self.redistrict_occured.emit()
         self.operation_ended.emit()
 
-    def assign_district(self, target_ids, new_district):
+    def assign_district(self, target_ids, new_district, old_districts=None):
         """
         Assigns a new district to a set of target features
         :param target_ids: feature IDs for features to redistrict
         :param new_district: new district attribute for targets
+        :param old_districts: optional dictionary of feature ID to existing district. If
+        set, these values will be used when recording the changes in the layer's edit buffer,
+        avoiding a separate request for the existing value of each feature.
         :return True if redistrict was successful
         """
         if not self.target_layer.isEditable():
@@ -83,7 +86,12 @@ class RedistrictHandler(QObject):
         field_index = self.target_layer.fields().lookupField(self.target_field)
         success = True
         for feature_id in target_ids:
-            if not self.target_layer.changeAttributeValue(feature_id, field_index, new_district):
+            if old_districts and feature_id in old_districts:
+                changed = self.target_layer.changeAttributeValue(feature_id, field_index, new_district,
+                                                                 old_districts[feature_id])
+            else:
+                changed = self.target_layer.changeAttributeValue(feature_id, field_index, new_district)
+            if not changed:
                 success = False
 
         self.target_layer.triggerRepaint()
@@ -52,6 +52,46 @@ def get_use_mock_api() -> bool:
     return QgsSettings().value('redistrict/use_mock_api', False, bool, QgsSettings.Plugins)
 
 
+def get_dissolve_backend() -> str:
+    """
+    Returns the backend to use when dissolving meshblocks into electorates, either
+    'threads' or 'processes'
+    """
+    return QgsSettings().value('redistrict/dissolve_backend', 'threads', str, QgsSettings.Plugins)
+
+
+def get_use_graph_validation() -> bool:
+    """
+    Returns True if electorate contiguity should be validated using the meshblock
+    adjacency graph, instead of electorate geometries
+    """
+    return QgsSettings().value('redistrict/use_graph_validation', True, bool, QgsSettings.Plugins)
+
+
+def get_use_background_boundaries() -> bool:
+    """
+    Returns True if electorate boundaries should be recalculated in a background
+    task after interactive redistricting operations
+    """
+    return QgsSettings().value('redistrict/background_boundaries', False, bool, QgsSettings.Plugins)
+
+
+def get_undo_history_memory_limit() -> int:
+    """
+    Returns the maximum memory (in MB) to use for electorate geometries in the
+    redistricting undo history
+    """
+    return QgsSettings().value('redistrict/undo_history_memory_limit', 256, int, QgsSettings.Plugins)
+
+
+def get_use_scenario_lineage() -> bool:
+    """
+    Returns True if branched scenarios should only store the meshblocks which differ
+    from their parent scenario, instead of a full copy of the parent's meshblocks
+    """
+    return QgsSettings().value('redistrict/scenario_lineage', False, bool, QgsSettings.Plugins)
+
+
 class DistrictSettingsDialog(QDialog):
     """
     A dialog used for plugin settings
@@ -94,6 +134,21 @@ class DistrictSettingsDialog(QDialog):
                                 QgsSettings.Plugins))
         g_layout.addWidget(self.gms_version_combo, 1, 1)
 
+        g_layout.addWidget(QLabel(self.tr('Calculate electorates using')), 2, 0)
+        self.dissolve_backend_combo = QComboBox()
+        self.dissolve_backend_combo.addItem(self.tr('Multiple threads'), 'threads')
+        self.dissolve_backend_combo.addItem(self.tr('Multiple processes'), 'processes')
+        self.dissolve_backend_combo.setCurrentIndex(self.dissolve_backend_combo.findData(get_dissolve_backend()))
+        g_layout.addWidget(self.dissolve_backend_combo, 2, 1)
+
+        g_layout.addWidget(QLabel(self.tr('Undo history memory limit')), 3, 0)
+        self.undo_history_memory_spin = QSpinBox()
+        self.undo_history_memory_spin.setMinimum(16)
+        self.undo_history_memory_spin.setMaximum(16384)
+        self.undo_history_memory_spin.setSuffix(' ' + self.tr('MB'))
+        self.undo_history_memory_spin.setValue(get_undo_history_memory_limit())
+        g_layout.addWidget(self.undo_history_memory_spin, 3, 1)
+
         layout.addLayout(g_layout)
 
         self.use_mock_checkbox = QCheckBox(self.tr('Use mock Statistics NZ API'))
@@ -109,6 +164,43 @@ class DistrictSettingsDialog(QDialog):
             QgsSettings().value('redistrict/show_overlays', False, bool, QgsSettings.Plugins))
         layout.addWidget(self.use_overlays_checkbox)
 
+        self.use_graph_validation_checkbox = QCheckBox(self.tr('Validate contiguity using meshblock adjacency'))
+        self.use_graph_validation_checkbox.setChecked(get_use_graph_validation())
+        layout.addWidget(self.use_graph_validation_checkbox)
+
+        self.background_boundaries_checkbox = QCheckBox(self.tr('Update electorate boundaries in the background'))
+        self.background_boundaries_checkbox.setChecked(get_use_background_boundaries())
+        layout.addWidget(self.background_boundaries_checkbox)
+
+        self.scenario_lineage_checkbox = QCheckBox(self.tr('Store only changed meshblocks for branched scenarios'))
+        self.scenario_lineage_checkbox.setChecked(get_use_scenario_lineage())
+        layout.addWidget(self.scenario_lineage_checkbox)
+
+        self.use_geometry_cache_group_box = QGroupBox(self.tr('Cache calculated electorate geometries'))
+        self.use_geometry_cache_group_box.setCheckable(True)
+        self.use_geometry_cache_group_box.setChecked(
+            QgsSettings().value('redistrict/use_geometry_cache', True, bool, QgsSettings.Plugins))
+
+        cache_layout = QGridLayout()
+        cache_layout.addWidget(QLabel(self.tr('Discard cached geometries unused for')), 0, 0)
+        self.geometry_cache_max_age_spin = QSpinBox()
+        self.geometry_cache_max_age_spin.setMinimum(1)
+        self.geometry_cache_max_age_spin.setMaximum(365)
+        self.geometry_cache_max_age_spin.setSuffix(' ' + self.tr('days'))
+        self.geometry_cache_max_age_spin.setValue(
+            QgsSettings().value('redistrict/geometry_cache_max_age', 30, int, QgsSettings.Plugins))
+        cache_layout.addWidget(self.geometry_cache_max_age_spin, 0, 1)
+        cache_layout.addWidget(QLabel(self.tr('Maximum cached geometries')), 1, 0)
+        self.geometry_cache_max_entries_spin = QSpinBox()
+        self.geometry_cache_max_entries_spin.setMinimum(100)
+        self.geometry_cache_max_entries_spin.setMaximum(100000)
+        self.geometry_cache_max_entries_spin.setValue(
+            QgsSettings().value('redistrict/geometry_cache_max_entries', 5000, int, QgsSettings.Plugins))
+        cache_layout.addWidget(self.geometry_cache_max_entries_spin, 1, 1)
+
+        self.use_geometry_cache_group_box.setLayout(cache_layout)
+        layout.addWidget(self.use_geometry_cache_group_box)
+
         self.use_sound_group_box = QGroupBox(self.tr('Use audio feedback'))
         self.use_sound_group_box.setCheckable(True)
         self.use_sound_group_box.setChecked(
@@ -158,10 +250,26 @@ class DistrictSettingsDialog(QDialog):
         QgsSettings().setValue('redistrict/base_url', self.base_url(), QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/check_every', self.check_every_spin.value(), QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/show_overlays', self.use_overlays_checkbox.isChecked(), QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/use_graph_validation', self.use_graph_validation_checkbox.isChecked(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/background_boundaries', self.background_boundaries_checkbox.isChecked(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/scenario_lineage', self.scenario_lineage_checkbox.isChecked(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/use_geometry_cache', self.use_geometry_cache_group_box.isChecked(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/geometry_cache_max_age', self.geometry_cache_max_age_spin.value(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/geometry_cache_max_entries', self.geometry_cache_max_entries_spin.value(),
+                               QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/use_audio_feedback', self.use_sound_group_box.isChecked(),
                                QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/on_redistrict', self.on_redistrict_file_widget.filePath(),
                                QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/dissolve_backend', self.dissolve_backend_combo.currentData(),
+                               QgsSettings.Plugins)
+        QgsSettings().setValue('redistrict/undo_history_memory_limit', self.undo_history_memory_spin.value(),
+                               QgsSettings.Plugins)
         QgsSettings().setValue('redistrict/gms_version',
                                self.gms_version_combo.currentText(),
                                QgsSettings.Plugins)
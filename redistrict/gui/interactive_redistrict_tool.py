@@ -23,53 +23,10 @@ from qgis.core import (Qgis,
 from qgis.gui import (QgsMapTool,
                       QgsSnapIndicator)
 from qgis.utils import iface
+from redistrict.core.district_boundary_index import DistrictBoundaryIndex
 from redistrict.gui.audio_utils import AudioUtils
 
 
-class UniqueFeatureEdgeMatchCollectingFilter(QgsPointLocator.MatchFilter):
-    """
-    A snapping filter which collects all nearby edges from unique
-    features. Required because by default the snapper only returns
-    a single match (the closest), yet we want to know ALL unique edges
-    within the tolerance.
-    """
-
-    def __init__(self, tolerance):
-        """
-        Constructor for filter
-        :param tolerance: maximum distance from cursor to edge allowed
-        """
-        super().__init__()
-        self.matches = []
-        self.tolerance = tolerance
-
-    def acceptMatch(self, match):
-        """
-        Tests current match for validity, but also collects a list of unique
-        matches
-        :param match: snapping match candidate
-        """
-        if match.distance() > self.tolerance:
-            return False
-
-        # do we already have a match with this layer/feature combination?
-        duplicate_matches = [m for m in self.matches if
-                             m.layer() == match.layer() and m.featureId() == match.featureId()]
-        if not duplicate_matches:
-            # if not, record this match
-            self.matches.append(match)
-
-        # we always return True for valid matches, even if we consider them a duplicate
-        # this allows the snapper to compare distances and always return the closest match
-        return True
-
-    def get_matches(self):
-        """
-        Returns the full list of unique layer/feature matches
-        """
-        return self.matches
-
-
 class DecoratorFactory:
     """
     Factory class for decorators drawn during the interactive redistrict tool
@@ -97,7 +54,8 @@ class InteractiveRedistrictingTool(QgsMapTool):
     def __init__(self, canvas,
                  handler,
                  district_registry,
-                 decorator_factory=None):
+                 decorator_factory=None,
+                 boundary_index=None):
         """
         Constructor for map tool
         :param canvas: linked map canvas
@@ -105,11 +63,18 @@ class InteractiveRedistrictingTool(QgsMapTool):
         :param district_registry: associated district registry
         :param decorator_factory: optional factory for creating map decorations
         during the redistricting operation (e.g. population displays)
+        :param boundary_index: optional district boundary index for the handler's
+        target layer. If not set, a new index will be created for the tool.
         """
         super().__init__(canvas)
         self.handler = handler
         self.district_registry = district_registry
         self.decorator_factory = decorator_factory
+        if boundary_index is None:
+            boundary_index = DistrictBoundaryIndex(handler.target_layer, handler.target_field)
+        self.boundary_index = boundary_index
+        # start indexing now, so that boundaries are available by the time the user hovers over them
+        self.boundary_index.build_in_background()
 
         self.snap_indicator = QgsSnapIndicator(self.canvas())
         self.pop_decorator = None
@@ -119,6 +84,8 @@ class InteractiveRedistrictingTool(QgsMapTool):
         self.current_district = None
         self.click_point = None
         self.modified = set()
+        # per-operation cache of target feature id to (district, geometry, prepared geometry engine)
+        self.feature_cache = {}
 
     def get_district_boundary_matches(self, point):
         """
@@ -126,15 +93,15 @@ class InteractiveRedistrictingTool(QgsMapTool):
         between existing districts
         :param point: map point to snap from
         """
+        layer = self.handler.target_layer
 
         # use QGIS cursor tolerance setting
-        tolerance = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
+        tolerance = QgsTolerance.vertexSearchRadius(layer, self.canvas().mapSettings())
 
-        # collect matching edges
-        locator = self.canvas().snappingUtils().locatorForLayer(self.handler.target_layer)
-        match_filter = UniqueFeatureEdgeMatchCollectingFilter(tolerance)
-        locator.nearestEdge(point, tolerance, match_filter)
-        return match_filter.get_matches()
+        layer_point = self.toLayerCoordinates(layer, point)
+        return [QgsPointLocator.Match(QgsPointLocator.Edge, layer, feature_id, distance,
+                                      self.toMapCoordinates(layer, closest))
+                for feature_id, distance, closest in self.boundary_index.boundary_matches(layer_point, tolerance)]
 
     def get_district_area_match(self, point):
         """
@@ -142,9 +109,23 @@ class InteractiveRedistrictingTool(QgsMapTool):
         the cursor
         :param point: map point to snap from
         """
-        locator = self.canvas().snappingUtils().locatorForLayer(self.handler.target_layer)
-        tolerance = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
-        match = locator.nearestArea(point, tolerance)
+        layer = self.handler.target_layer
+        tolerance = QgsTolerance.vertexSearchRadius(layer, self.canvas().mapSettings())
+
+        layer_point = self.toLayerCoordinates(layer, point)
+        point_geometry = QgsGeometry.fromPointXY(layer_point)
+        candidates = self.get_cached_features(self.boundary_index.features_near(layer_point, tolerance))
+
+        match = QgsPointLocator.Match()
+        for feature_id, (_, geometry, engine) in candidates.items():
+            if engine.intersects(point_geometry.constGet()):
+                return QgsPointLocator.Match(QgsPointLocator.Area, layer, feature_id, 0, point)
+
+            # not inside this feature, but maybe within tolerance of it
+            distance = geometry.distance(point_geometry)
+            if 0 <= distance <= tolerance and (not match.isValid() or distance < match.distance()):
+                match = QgsPointLocator.Match(QgsPointLocator.Area, layer, feature_id, distance, point)
+
         return match
 
     def get_districts_from_matches(self, matches):
@@ -153,8 +134,11 @@ class InteractiveRedistrictingTool(QgsMapTool):
         :param matches: snapping matches to scan
         :return: list of district values
         """
-        features = self.get_target_features_from_matches(matches)
-        return {f[self.handler.target_field] for f in features}
+        if self.is_active:
+            return {district for _, (district, _, _) in self.get_cached_targets(matches).items()}
+
+        districts = (self.boundary_index.district(match.featureId()) for match in matches if match.isValid())
+        return {district for district in districts if district is not None}
 
     def get_target_features_from_matches(self, matches):
         """
@@ -166,6 +150,36 @@ class InteractiveRedistrictingTool(QgsMapTool):
         feature_ids = [match.featureId() for match in matches]
         return self.handler.target_layer.getFeatures(QgsFeatureRequest().setFilterFids(feature_ids))
 
+    def get_cached_targets(self, matches):
+        """
+        Returns the cached district and geometry for the target features corresponding
+        to a list of snapping matches. Features which have not yet been cached during the
+        current operation are fetched and added to the cache.
+        :param matches: snapping matches to scan
+        :return: dictionary of feature id to (district, geometry, prepared geometry engine)
+        """
+        return self.get_cached_features({match.featureId() for match in matches if match.isValid()})
+
+    def get_cached_features(self, feature_ids):
+        """
+        Returns the cached district and geometry for a set of target features. Features which
+        have not yet been cached during the current operation are fetched and added to the cache.
+        :param feature_ids: target feature IDs
+        :return: dictionary of feature id to (district, geometry, prepared geometry engine)
+        """
+        missing = [feature_id for feature_id in feature_ids if feature_id not in self.feature_cache]
+        if missing:
+            request = QgsFeatureRequest().setFilterFids(missing)
+            request.setSubsetOfAttributes([self.handler.target_field], self.handler.target_layer.fields())
+            for f in self.handler.target_layer.getFeatures(request):
+                geometry = f.geometry()
+                engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+                engine.prepareGeometry()
+                self.feature_cache[f.id()] = (f[self.handler.target_field], geometry, engine)
+
+        return {feature_id: self.feature_cache[feature_id] for feature_id in feature_ids if
+                feature_id in self.feature_cache}
+
     def matches_are_valid_for_boundary(self, matches):
         """
         Returns true if a list of matches corresponds to a valid
@@ -194,11 +208,11 @@ class InteractiveRedistrictingTool(QgsMapTool):
                 return
             match = self.get_district_area_match(event.mapPoint())
             p = QgsGeometry.fromPointXY(event.mapPoint())
-            targets = [m for m in self.get_target_features_from_matches([match]) if
-                       m.id() not in self.modified and m.geometry().intersects(p)]
+            targets = [(feature_id, district) for feature_id, (district, _, engine) in
+                       self.get_cached_targets([match]).items() if
+                       feature_id not in self.modified and engine.intersects(p.constGet())]
             if len(targets) == 1:
-                target = targets[0]
-                old_district = target[self.handler.target_field]
+                target_id, old_district = targets[0]
                 if not self.current_district:
                     candidates = [d for d in self.districts if d != old_district]
                     if candidates:
@@ -210,8 +224,10 @@ class InteractiveRedistrictingTool(QgsMapTool):
                             QCoreApplication.translate('LinzRedistrict', 'Redistrict to {}').format(
                                 self.district_registry.get_district_title(self.current_district)))
 
-                    self.modified.add(target.id())
-                    self.handler.assign_district([target.id()], self.current_district)
+                    self.modified.add(target_id)
+                    self.handler.assign_district([target_id], self.current_district)
+                    _, geometry, engine = self.feature_cache[target_id]
+                    self.feature_cache[target_id] = (self.current_district, geometry, engine)
                     self.update_decorator()
                     AudioUtils.play_redistrict_sound()
 
@@ -248,6 +264,7 @@ class InteractiveRedistrictingTool(QgsMapTool):
         self.is_active = False
         self.districts = None
         self.current_district = None
+        self.feature_cache = {}
         self.handler.end_operation()
 
     def canvasPressEvent(self, event):  # pylint: disable=missing-docstring
@@ -276,6 +293,7 @@ class InteractiveRedistrictingTool(QgsMapTool):
 
             self.current_district = None
             self.modified = set()
+            self.feature_cache = {}
             if valid:
                 self.is_active = True
                 self.click_point = event.mapPoint()
@@ -25,6 +25,7 @@ from qgis.core import (
     NULL
 )
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.scenario_snapshot import ScenarioSnapshot
 from redistrict.linz.nz_electoral_api import (
     ConcordanceItem
 )
@@ -61,15 +62,21 @@ class CompareScenariosTask(QgsTask):
                  meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str,
                  task: str,
-                 base_scenario_id: int,
-                 secondary_scenario_id: int):
+                 base_scenario_id: Optional[int],
+                 secondary_scenario_id: Optional[int],
+                 base_snapshot: Optional[ScenarioSnapshot] = None,
+                 secondary_snapshot: Optional[ScenarioSnapshot] = None):
         """
         Constructor for CompareScenariosTask
         :param task_name: user-visible, translated name for task
         :param scenario_registry: scenario registry
         :param task: target task
-        :param base_scenario_id: base ("original") scenario ID
-        :param secondary_scenario_id: secondary ("new") scenario ID
+        :param base_scenario_id: base ("original") scenario ID. Ignored if base_snapshot is set.
+        :param secondary_scenario_id: secondary ("new") scenario ID. Ignored if secondary_snapshot is set.
+        :param base_snapshot: optional base scenario snapshot, to compare instead of a scenario
+        from the registry
+        :param secondary_snapshot: optional secondary scenario snapshot, to compare instead of a
+        scenario from the registry
         """
         super().__init__(task_name)
 
@@ -95,10 +102,15 @@ class CompareScenariosTask(QgsTask):
             self._meshblock_number_field_name)
         assert self._meshblock_number_field_index >= 0
 
+        self._base_snapshot = base_snapshot
+        self._secondary_snapshot = secondary_snapshot
+
         # do a bit of preparatory processing on the main thread for safety
-        self._meshblock_features = scenario_registry.meshblocks_for_scenarios([
-            self._base_scenario_id, self._secondary_scenario_id
-        ])
+        registry_scenarios = [scenario for scenario, snapshot in ((self._base_scenario_id, base_snapshot),
+                                                                  (self._secondary_scenario_id, secondary_snapshot))
+                              if snapshot is None]
+        self._meshblock_features = scenario_registry.meshblocks_for_scenarios(
+            registry_scenarios) if registry_scenarios else iter([])
 
         self.changed_meshblocks = set()
         self.base_electorates = {}
@@ -108,8 +120,10 @@ class CompareScenariosTask(QgsTask):
         self._meshblock_layer_geometry_type = meshblock_layer.wkbType()
         self._meshblock_layer_crs = meshblock_layer.crs()
 
-        self._base_scenario_name = scenario_registry.get_scenario_name(self._base_scenario_id)
-        self._secondary_scenario_name = scenario_registry.get_scenario_name(self._secondary_scenario_id)
+        self._base_scenario_name = base_snapshot.name if base_snapshot is not None else \
+            scenario_registry.get_scenario_name(self._base_scenario_id)
+        self._secondary_scenario_name = secondary_snapshot.name if secondary_snapshot is not None else \
+            scenario_registry.get_scenario_name(self._secondary_scenario_id)
         self.changed_meshblocks_layer: Optional[QgsVectorLayer] = None
         self.changed_areas_layer: Optional[QgsVectorLayer] = None
         self.concordance = []
@@ -119,6 +133,11 @@ class CompareScenariosTask(QgsTask):
 
     def run(self):  # pylint: disable=missing-docstring,too-many-locals,too-many-statements,too-many-branches
 
+        if self._base_snapshot is not None:
+            self.base_electorates = self._base_snapshot.electorates_by_meshblock(self.associated_task)
+        if self._secondary_snapshot is not None:
+            self.secondary_electorates = self._secondary_snapshot.electorates_by_meshblock(self.associated_task)
+
         for meshblock in self._meshblock_features:
             electorate = meshblock[self._electorate_field_index]
             if electorate == NULL:
@@ -148,12 +167,22 @@ class CompareScenariosTask(QgsTask):
             assert meshblock_id in all_meshblock_ids
 
         unchanged_electorates = set()
-        for meshblock_id, _base_electorate in self.base_electorates.items():
-            if self.secondary_electorates[meshblock_id] == _base_electorate:
-                unchanged_electorates.add(_base_electorate)
-                continue
+        if self._base_snapshot is not None and self._secondary_snapshot is not None:
+            # compare the snapshot arrays directly, only considering meshblocks assigned in the base scenario
+            self.changed_meshblocks = {meshblock_id for meshblock_id in
+                                       ScenarioSnapshot.changed_meshblocks(self._base_snapshot,
+                                                                           self._secondary_snapshot,
+                                                                           self.associated_task)
+                                       if meshblock_id in self.base_electorates}
+            unchanged_electorates = {electorate for meshblock_id, electorate in self.base_electorates.items()
+                                     if meshblock_id not in self.changed_meshblocks}
+        else:
+            for meshblock_id, _base_electorate in self.base_electorates.items():
+                if self.secondary_electorates[meshblock_id] == _base_electorate:
+                    unchanged_electorates.add(_base_electorate)
+                    continue
 
-            self.changed_meshblocks.add(meshblock_id)
+                self.changed_meshblocks.add(meshblock_id)
 
         changed_meshblocks_str = ','.join(
             f"'{_id}'" for _id in self.changed_meshblocks)
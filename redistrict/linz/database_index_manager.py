@@ -0,0 +1,183 @@
+"""
+LINZ Redistricting Plugin - Database index manager
+"""
+
+from contextlib import closing
+import sqlite3
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple
+)
+
+
+class DatabaseIndexManager:
+    """
+    Checks for, and creates, the attribute indexes required for fast scenario
+    and electorate queries within the project database.
+
+    Meshblock electorate records are always filtered by scenario, and then by
+    electorate or meshblock, and electorates are filtered by type and id. An
+    existing index satisfies a requirement if its leading columns match the
+    required columns, regardless of the index name.
+    """
+
+    def __init__(self, database: str,
+                 meshblock_electorate_table: str = 'meshblock_electorates',
+                 electorate_table: str = 'electorates'):
+        """
+        Constructor for DatabaseIndexManager
+        :param database: path to project database
+        :param meshblock_electorate_table: name of meshblock electorate table
+        :param electorate_table: name of electorate table
+        """
+        self.database = database
+        self.meshblock_electorate_table = meshblock_electorate_table
+        self.electorate_table = electorate_table
+
+    def required_indexes(self) -> List[Tuple[str, str, Tuple[str, ...]]]:
+        """
+        Returns all required indexes, as a list of (index name, table name, indexed columns)
+        """
+        indexes = []
+        for column in ('gn_id', 'gs_id', 'm_id', 'meshblock_number'):
+            indexes.append((f'idx_{self.meshblock_electorate_table}_scenario_{column}',
+                            self.meshblock_electorate_table, ('scenario_id', column)))
+        indexes.append((f'idx_{self.electorate_table}_type_electorate_id',
+                        self.electorate_table, ('type', 'electorate_id')))
+        indexes.append((f'idx_{self.electorate_table}_electorate_id',
+                        self.electorate_table, ('electorate_id',)))
+        return indexes
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database. Connections are not shared, so that the manager
+        can safely be used from background tasks.
+        """
+        return sqlite3.connect(self.database, timeout=5)
+
+    @staticmethod
+    def _quoted(identifier: str) -> str:
+        """
+        Returns a quoted SQL identifier
+        """
+        escaped = identifier.replace('"', '""')
+        return f'"{escaped}"'
+
+    @staticmethod
+    def _table_columns(connection: sqlite3.Connection, table: str) -> List[str]:
+        """
+        Returns the names of all columns in a table, or an empty list if the table does not exist
+        """
+        return [row[1] for row in connection.execute(f'PRAGMA table_info({DatabaseIndexManager._quoted(table)})')]
+
+    @staticmethod
+    def _indexed_columns(connection: sqlite3.Connection, table: str) -> List[Tuple[str, ...]]:
+        """
+        Returns the indexed columns for all existing indexes on a table
+        """
+        indexed = []
+        for index_row in connection.execute(f'PRAGMA index_list({DatabaseIndexManager._quoted(table)})').fetchall():
+            index_columns = connection.execute(
+                f'PRAGMA index_info({DatabaseIndexManager._quoted(index_row[1])})').fetchall()
+            indexed.append(tuple(row[2] for row in sorted(index_columns)))
+        return indexed
+
+    def missing_indexes(self) -> List[Tuple[str, str, Tuple[str, ...]]]:
+        """
+        Returns the required indexes which are missing from the database, as a list
+        of (index name, table name, indexed columns). Indexes for tables or columns which
+        are not present in the database are not reported as missing.
+        """
+        missing = []
+        try:
+            with closing(self._connect()) as connection:
+                table_columns = {}
+                indexed_columns = {}
+                for name, table, columns in self.required_indexes():
+                    if table not in table_columns:
+                        table_columns[table] = self._table_columns(connection, table)
+                        indexed_columns[table] = self._indexed_columns(connection, table)
+                    if not all(column in table_columns[table] for column in columns):
+                        continue
+                    if not any(indexed[:len(columns)] == columns for indexed in indexed_columns[table]):
+                        missing.append((name, table, columns))
+        except sqlite3.Error:
+            return []
+        return missing
+
+    def create_indexes(self, indexes: List[Tuple[str, str, Tuple[str, ...]]],
+                       is_canceled: Optional[Callable[[], bool]] = None,
+                       progress: Optional[Callable[[float], None]] = None) -> bool:
+        """
+        Creates indexes in the database, and then updates the database statistics
+        for the indexed tables so that the query planner will use them
+        :param indexes: list of (index name, table name, indexed columns) to create
+        :param is_canceled: optional callback which returns True if creation should be canceled
+        :param progress: optional callback for reporting progress, as a percentage
+        :returns True if all indexes were successfully created
+        """
+        try:
+            with closing(self._connect()) as connection:
+                for i, (name, table, columns) in enumerate(indexes):
+                    if is_canceled is not None and is_canceled():
+                        return False
+                    connection.execute(
+                        f'CREATE INDEX IF NOT EXISTS {self._quoted(name)} ON {self._quoted(table)} '
+                        f'({",".join(self._quoted(column) for column in columns)})')
+                    connection.commit()
+                    if progress is not None:
+                        progress(100 * (i + 1) / len(indexes))
+
+                for table in {table for _, table, _ in indexes}:
+                    connection.execute(f'ANALYZE {self._quoted(table)}')
+                connection.commit()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def time_queries(self) -> Dict[str, float]:
+        """
+        Times a representative set of the plugin's scenario and electorate queries
+        against the database
+        :return: dictionary of query description to elapsed time, in seconds
+        """
+        timings = {}
+        try:
+            with closing(self._connect()) as connection:
+                meshblock_columns = self._table_columns(connection, self.meshblock_electorate_table)
+                electorate_columns = self._table_columns(connection, self.electorate_table)
+
+                queries = []
+                if 'scenario_id' in meshblock_columns:
+                    scenario = connection.execute(
+                        f'SELECT scenario_id FROM {self._quoted(self.meshblock_electorate_table)} LIMIT 1').fetchone()
+                    for column in ('gn_id', 'gs_id', 'm_id'):
+                        if scenario is None or column not in meshblock_columns:
+                            continue
+                        # an electorate lookup per electorate, as performed when switching scenarios
+                        electorates = [row[0] for row in connection.execute(
+                            f'SELECT DISTINCT {self._quoted(column)} FROM '
+                            f'{self._quoted(self.meshblock_electorate_table)} WHERE scenario_id=?', scenario)]
+                        queries.append((f'{self.meshblock_electorate_table}.{column}',
+                                        f'SELECT meshblock_number FROM {self._quoted(self.meshblock_electorate_table)} '
+                                        f'WHERE scenario_id=? AND {self._quoted(column)}=?',
+                                        [(scenario[0], electorate) for electorate in electorates]))
+                if 'type' in electorate_columns and 'electorate_id' in electorate_columns:
+                    electorates = connection.execute(
+                        f'SELECT type, electorate_id FROM {self._quoted(self.electorate_table)}').fetchall()
+                    queries.append((f'{self.electorate_table}.electorate_id',
+                                    f'SELECT * FROM {self._quoted(self.electorate_table)} '
+                                    f'WHERE type=? AND electorate_id=?', electorates))
+
+                for description, sql, parameters in queries:
+                    start = time.perf_counter()
+                    for params in parameters:
+                        connection.execute(sql, params).fetchall()
+                    timings[description] = time.perf_counter() - start
+        except sqlite3.Error:
+            return timings
+        return timings
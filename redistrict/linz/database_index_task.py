@@ -0,0 +1,53 @@
+"""
+LINZ Redistricting Plugin - Database index creation task
+"""
+
+from typing import (
+    List,
+    Tuple
+)
+
+from qgis.core import QgsTask
+from redistrict.linz.database_index_manager import DatabaseIndexManager
+
+
+class DatabaseIndexTask(QgsTask):
+    """
+    A background task for creating missing database indexes, timing
+    representative queries before and after the indexes are created
+    """
+
+    def __init__(self, task_name: str, index_manager: DatabaseIndexManager,
+                 indexes: List[Tuple[str, str, Tuple[str, ...]]]):
+        """
+        Constructor for DatabaseIndexTask
+        :param task_name: user-visible, translated name for task
+        :param index_manager: database index manager
+        :param indexes: list of (index name, table name, indexed columns) to create
+        """
+        super().__init__(task_name)
+        self.index_manager = index_manager
+        self.indexes = indexes
+        # query description to elapsed time in seconds, before and after indexing
+        self.timings_before = {}
+        self.timings_after = {}
+
+    def run(self):  # pylint: disable=missing-docstring
+        self.timings_before = self.index_manager.time_queries()
+        if self.isCanceled():
+            return False
+
+        if not self.index_manager.create_indexes(self.indexes, is_canceled=self.isCanceled,
+                                                 progress=self.setProgress):
+            return False
+
+        self.timings_after = self.index_manager.time_queries()
+        return True
+
+    def timing_summary(self) -> str:
+        """
+        Returns a summary of the query timings before and after indexing
+        """
+        return ', '.join(f'{description}: {self.timings_before[description] * 1000:.0f} ms → '
+                         f'{self.timings_after[description] * 1000:.0f} ms'
+                         for description in self.timings_before if description in self.timings_after)
@@ -0,0 +1,149 @@
+"""
+LINZ Redistricting Plugin - Dissolve scheduler
+"""
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    wait
+)
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional
+)
+
+from qgis.core import QgsGeometry
+from redistrict.core.process_dissolver import ProcessPoolDissolver
+
+
+class DissolveScheduler:
+    """
+    Schedules dissolving of electorate geometries across a pool of workers.
+
+    Large jobs are split into spatially coherent chunks which are dissolved
+    in parallel, and the partial results are then merged pairwise as they
+    become available, forming a reduction tree. This avoids the largest
+    electorates dominating the total time while other workers sit idle.
+
+    Callers should add jobs in order of decreasing size, so that the longest
+    running jobs are started first.
+    """
+
+    DEFAULT_CHUNK_SIZE = 1000
+
+    def __init__(self, submit: Callable[[List[QgsGeometry]], Future],
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Constructor for DissolveScheduler
+        :param submit: callable which submits a list of geometries to a worker for dissolving,
+        returning a future which resolves to the dissolved geometry (or its WKB)
+        :param chunk_size: maximum number of geometries to dissolve in a single job. Larger
+        jobs will be split into chunks.
+        """
+        self.submit = submit
+        self.chunk_size = chunk_size
+
+        # dict of future to job id
+        self.futures: Dict[Future, object] = {}
+        # dict of job id to count of outstanding futures
+        self.outstanding: Dict[object, int] = {}
+        # dict of job id to completed partial results
+        self.partials: Dict[object, List[QgsGeometry]] = {}
+        self.results: Dict[object, QgsGeometry] = {}
+
+    @staticmethod
+    def spatially_sorted(geometries: List[QgsGeometry]) -> List[QgsGeometry]:
+        """
+        Sorts geometries so that consecutive geometries are spatially close
+        :param geometries: geometries to sort
+        """
+
+        def sort_key(geometry: QgsGeometry):
+            center = geometry.boundingBox().center()
+            return center.x(), center.y()
+
+        return sorted(geometries, key=sort_key)
+
+    def chunks(self, geometries: List[QgsGeometry]) -> List[List[QgsGeometry]]:
+        """
+        Splits a list of geometries into chunks for parallel dissolving
+        :param geometries: geometries to split
+        """
+        if len(geometries) <= self.chunk_size:
+            return [geometries]
+
+        chunk_count = -(-len(geometries) // self.chunk_size)
+        # evenly sized chunks
+        size = -(-len(geometries) // chunk_count)
+        geometries = self.spatially_sorted(geometries)
+        return [geometries[i:i + size] for i in range(0, len(geometries), size)]
+
+    def _submit(self, job_id, geometries: List[QgsGeometry]):
+        """
+        Submits geometries for dissolving as part of a job
+        """
+        self.futures[self.submit(geometries)] = job_id
+        self.outstanding[job_id] = self.outstanding.get(job_id, 0) + 1
+
+    def add_job(self, job_id, geometries: List[QgsGeometry]):
+        """
+        Adds a job to the scheduler, and submits it (or its chunks) to the workers
+        :param job_id: unique job id
+        :param geometries: geometries to dissolve
+        """
+        self.partials[job_id] = []
+        for chunk in self.chunks(geometries):
+            self._submit(job_id, chunk)
+
+    def _handle_result(self, job_id, geometry: QgsGeometry) -> bool:
+        """
+        Handles a completed result for a job
+        :returns True if the job is completely finished
+        """
+        self.outstanding[job_id] -= 1
+        partials = self.partials[job_id]
+        if not geometry.isNull() and not geometry.isEmpty():
+            partials.append(geometry)
+
+        # merge partial results as soon as there is a pair available
+        while len(partials) >= 2:
+            self._submit(job_id, [partials.pop(), partials.pop()])
+
+        if self.outstanding[job_id] > 0:
+            return False
+
+        self.results[job_id] = partials[0] if partials else QgsGeometry()
+        del self.partials[job_id]
+        del self.outstanding[job_id]
+        return True
+
+    def cancel(self):
+        """
+        Cancels all pending futures
+        """
+        for future in self.futures:
+            future.cancel()
+
+    def run(self, is_canceled: Callable[[], bool],
+            job_finished: Optional[Callable[[object, QgsGeometry], None]] = None) -> Optional[Dict[object, QgsGeometry]]:
+        """
+        Blocks until all jobs are complete
+        :param is_canceled: callable which returns True if the dissolve has been canceled
+        :param job_finished: optional callback, called with the job id and result as each job completes
+        :returns dictionary of job id to dissolved geometry, or None if canceled
+        """
+        while self.futures:
+            if is_canceled():
+                self.cancel()
+                return None
+
+            # the timeout is only used to regularly check for cancellation
+            done, _ = wait(list(self.futures.keys()), timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id = self.futures.pop(future)
+                if self._handle_result(job_id, ProcessPoolDissolver.geometry_from_result(future.result())) and job_finished is not None:
+                    job_finished(job_id, self.results[job_id])
+
+        return self.results
@@ -0,0 +1,136 @@
+"""
+LINZ Redistricting Plugin - Electorate boundary recalculation task
+"""
+
+from typing import (
+    Dict,
+    Set
+)
+
+from qgis.core import (
+    Qgis,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsMessageLog,
+    QgsTask,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource
+)
+from redistrict.core.core_utils import CoreUtils
+from redistrict.linz.electorate_changes_queue import (
+    ElectorateEditQueue,
+    QueueItem
+)
+
+
+class ElectorateBoundaryTask(QgsTask):
+    """
+    A background task for recalculating the boundaries of electorates
+    after an interactive redistricting operation.
+
+    Boundaries are adjusted by adding the geometries of meshblocks newly
+    assigned to an electorate and removing those of meshblocks no longer
+    assigned to it. The calculated geometries are set on the associated
+    ElectorateEditQueue item when the task completes.
+    """
+
+    # seconds between checks for cancellation while waiting on earlier boundary calculations
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self, task_name: str, meshblock_layer: QgsVectorLayer,  # pylint: disable=too-many-arguments
+                 electorate_changes_queue: ElectorateEditQueue, queue_item: QueueItem,
+                 original_geometries: Dict[int, QgsGeometry],
+                 added_meshblocks: Dict[int, Set[int]], removed_meshblocks: Dict[int, Set[int]]):
+        """
+        Constructor for ElectorateBoundaryTask
+        :param task_name: user-visible, translated name for task
+        :param meshblock_layer: meshblock layer
+        :param electorate_changes_queue: electorate changes queue
+        :param queue_item: queue item pushed with pending geometries for the electorates
+        :param original_geometries: dictionary of electorate feature id to existing electorate
+        geometry. Electorates with a pending geometry from an earlier queue item will instead
+        use the geometry calculated for that item.
+        :param added_meshblocks: dictionary of electorate feature id to feature ids of meshblocks
+        added to the electorate
+        :param removed_meshblocks: dictionary of electorate feature id to feature ids of meshblocks
+        removed from the electorate
+        """
+        super().__init__(task_name)
+        self.electorate_changes_queue = electorate_changes_queue
+        self.queue_item = queue_item
+        self.original_geometries = original_geometries
+        self.added_meshblocks = added_meshblocks
+        self.removed_meshblocks = removed_meshblocks
+        self.dependencies = dict(queue_item.dependencies)
+        # results are discarded if the queue is cleared before the task completes
+        self.generation = electorate_changes_queue.generation
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
+        self.geometries = {}
+
+    def meshblock_geometries(self, meshblock_ids: Set[int]):
+        """
+        Returns the geometries for a set of meshblocks
+        :param meshblock_ids: meshblock feature ids
+        """
+        if not meshblock_ids:
+            return []
+        request = QgsFeatureRequest().setFilterFids(meshblock_ids).setNoAttributes()
+        return [f.geometry() for f in self.meshblock_source.getFeatures(request)]
+
+    def original_geometry(self, electorate_id: int):
+        """
+        Returns the geometry to adjust for an electorate, waiting on any earlier pending
+        calculation for the electorate to complete. Returns None if the earlier calculation
+        failed or the task was canceled.
+        :param electorate_id: electorate feature id
+        """
+        earlier = self.dependencies.get(electorate_id)
+        if earlier is None:
+            return self.original_geometries[electorate_id]
+
+        while not earlier.geometries_ready.wait(self.WAIT_INTERVAL):
+            if self.isCanceled():
+                return None
+
+        return earlier.calculated_geometries.get(electorate_id)
+
+    def run(self):  # pylint: disable=missing-docstring
+        try:
+            electorate_ids = list(self.original_geometries.keys())
+            for i, electorate_id in enumerate(electorate_ids):
+                self.setProgress(100 * i / len(electorate_ids))
+                if self.isCanceled():
+                    return False
+
+                geometry = self.original_geometry(electorate_id)
+                if geometry is None:
+                    continue
+
+                # add new bits
+                parts = self.meshblock_geometries(self.added_meshblocks.get(electorate_id))
+                if parts:
+                    parts.append(geometry)
+                    geometry = CoreUtils.union_geometries(parts)
+                # minus lost bits
+                parts = self.meshblock_geometries(self.removed_meshblocks.get(electorate_id))
+                if parts:
+                    geometry = geometry.difference(CoreUtils.union_geometries(parts))
+
+                self.geometries[electorate_id] = geometry
+        finally:
+            self.queue_item.calculated_geometries.update(self.geometries)
+            self.queue_item.geometries_ready.set()
+
+        return len(self.geometries) == len(self.original_geometries)
+
+    def finished(self, result: bool):  # pylint: disable=missing-docstring
+        self.electorate_changes_queue.remove_boundary_task(self)
+        if self.generation != self.electorate_changes_queue.generation:
+            # the queue item was discarded when the queue was cleared
+            return
+
+        self.electorate_changes_queue.set_pending_geometries(self.queue_item, self.geometries)
+        if not result:
+            QgsMessageLog.logMessage(
+                self.tr('Could not update electorate boundaries. Electorates should be rebuilt.'),
+                'REDISTRICT', Qgis.Warning)
@@ -13,12 +13,22 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
-from typing import List
+import threading
+from typing import (
+    Dict,
+    List,
+    Optional
+)
 from qgis.core import (QgsVectorLayer,
                        QgsFeatureRequest,
-                       QgsFeature)
+                       QgsFeature,
+                       QgsGeometry,
+                       QgsTask)
+from qgis.PyQt.QtCore import pyqtSignal
 from qgis.PyQt.QtWidgets import (QUndoCommand,
                                  QUndoStack)
+from redistrict.linz.geometry_history import GeometryHistory
+from redistrict.linz.user_log_writer import UserLogWriter
 
 
 class QueueItem(QUndoCommand):
@@ -26,11 +36,13 @@ class QueueItem(QUndoCommand):
     Item within an ElectorateEditQueue
     """
 
-    def __init__(self, electorate_layer: QgsVectorLayer,
+    def __init__(self, electorate_layer: QgsVectorLayer,  # pylint: disable=too-many-arguments
                  previous_attributes: dict, previous_geometries: dict,
                  new_attributes: dict, new_geometries: dict,
                  user_log_layer: QgsVectorLayer,
-                 user_log_entries: List[QgsFeature]):
+                 user_log_entries: List[QgsFeature],
+                 geometry_history: Optional[GeometryHistory] = None,
+                 user_log_writer: Optional[UserLogWriter] = None):
         """
         Constructor
         :param electorate_layer: associated electorate layer
@@ -40,31 +52,117 @@ class QueueItem(QUndoCommand):
         :param new_geometries: dictionary of geometry edits
         :param user_log_layer: user log layer
         :param user_log_entries: user log entries associated with this change
+        :param geometry_history: optional geometry history for compact storage of
+        the previous and new geometries. If not set, a private history will be used.
+        :param user_log_writer: optional writer for user log entries. If not set, entries
+        will be written directly to the user log layer.
         """
         super().__init__()
         self.electorate_layer = electorate_layer
+        self.geometry_history = geometry_history if geometry_history is not None else GeometryHistory()
         self.previous_attributes = previous_attributes
-        self.previous_geometries = previous_geometries
+        # geometries are held in the history, and only decompressed when the item is undone or redone
+        self.previous_geometry_keys = {feature_id: self.geometry_history.add(geometry) for feature_id, geometry in
+                                       previous_geometries.items()}
         self.new_attributes = new_attributes
-        self.new_geometries = new_geometries
+        self.new_geometry_keys = {feature_id: self.geometry_history.add(geometry) for feature_id, geometry in
+                                  new_geometries.items()}
         self.user_log_layer = user_log_layer
+        self.user_log_writer = user_log_writer if user_log_writer is not None else UserLogWriter(user_log_layer)
         self.user_log_entries = user_log_entries
-        self.user_log_entry_fids = []
+        self.user_log_entry_handles = []
+        self.applied = False
+        # if True, undo and redo only update the item's state, with changes to the layers
+        # applied separately by the queue (see ElectorateEditQueue.jump_to())
+        self.coalesced = False
+
+        # electorate feature ids for which the new geometry is still being calculated
+        self.pending_geometry_ids = set()
+        # electorate feature id to earlier queue item which this item's geometry depends on
+        self.dependencies: Dict[int, 'QueueItem'] = {}
+        # later queue items which depend on this item's pending geometries
+        self.dependents: List['QueueItem'] = []
+        # set once the pending geometries have been calculated (or failed)
+        self.geometries_ready = threading.Event()
+        self.geometries_ready.set()
+        self.calculated_geometries: Dict[int, QgsGeometry] = {}
+
+    @property
+    def previous_geometries(self) -> Dict[int, QgsGeometry]:
+        """
+        Returns a dictionary of the previous geometries
+        """
+        return self.geometry_history.geometries(self.previous_geometry_keys)
+
+    @property
+    def new_geometries(self) -> Dict[int, QgsGeometry]:
+        """
+        Returns a dictionary of the new geometries
+        """
+        return self.geometry_history.geometries(self.new_geometry_keys)
+
+    def set_new_geometries(self, geometries: Dict[int, QgsGeometry]):
+        """
+        Sets the calculated geometries for electorates with pending geometries. If the
+        item is currently applied, the geometries will be immediately written to the layer.
+        :param geometries: dictionary of electorate feature id to new geometry
+        """
+        for feature_id, geometry in geometries.items():
+            self._set_key(self.new_geometry_keys, feature_id, self.geometry_history.add(geometry))
+        self.pending_geometry_ids.difference_update(geometries.keys())
+        if self.applied and geometries:
+            self.electorate_layer.dataProvider().changeGeometryValues(geometries)
+            self.electorate_layer.triggerRepaint()
+
+    def share_previous_geometry(self, feature_id: int, other: 'QueueItem'):
+        """
+        Sets the previous geometry for an electorate to the new geometry from another
+        queue item, sharing the stored geometry between the items
+        :param feature_id: electorate feature id
+        :param other: queue item with new geometry for electorate
+        """
+        key = other.new_geometry_keys[feature_id]
+        self.geometry_history.retain(key)
+        self._set_key(self.previous_geometry_keys, feature_id, key)
+
+    def _set_key(self, keys: Dict[int, int], feature_id: int, key: int):
+        """
+        Sets the history key for a geometry, releasing any existing key
+        """
+        existing = keys.get(feature_id)
+        if existing is not None:
+            self.geometry_history.release(existing)
+        keys[feature_id] = key
+
+    def release_geometries(self):
+        """
+        Releases the item's geometries from the history. Must be called when the
+        item is discarded from the queue.
+        """
+        for key in list(self.previous_geometry_keys.values()) + list(self.new_geometry_keys.values()):
+            self.geometry_history.release(key)
+        self.previous_geometry_keys = {}
+        self.new_geometry_keys = {}
 
     def redo(self):  # pylint: disable=missing-docstring
+        self.applied = True
+        if self.coalesced:
+            return
         self.electorate_layer.dataProvider().changeGeometryValues(self.new_geometries)
         self.electorate_layer.dataProvider().changeAttributeValues(self.new_attributes)
         self.electorate_layer.triggerRepaint()
 
-        self.user_log_entry_fids = [f.id() for f in
-                                    self.user_log_layer.dataProvider().addFeatures(self.user_log_entries)[1]]
+        self.user_log_entry_handles = self.user_log_writer.add_entries(self.user_log_entries)
 
     def undo(self):  # pylint: disable=missing-docstring
+        self.applied = False
+        if self.coalesced:
+            return
         self.electorate_layer.dataProvider().changeGeometryValues(self.previous_geometries)
         self.electorate_layer.dataProvider().changeAttributeValues(self.previous_attributes)
 
-        self.user_log_layer.dataProvider().deleteFeatures(self.user_log_entry_fids)
-        self.user_log_entry_fids = []
+        self.user_log_writer.remove_entries(self.user_log_entry_handles)
+        self.user_log_entry_handles = []
 
         self.electorate_layer.triggerRepaint()
 
@@ -79,20 +177,47 @@ class ElectorateEditQueue(QUndoStack):
     """
     Queue for staged electorate edits, used when
     redistricting changes are created or rolled back
-    to restore electorate layer to a matching state
+    to restore electorate layer to a matching state.
+
+    Changes may be pushed with some electorate geometries still pending,
+    in which case the geometries are set on the queue item once they
+    have been calculated (see ElectorateBoundaryTask).
     """
 
-    def __init__(self, electorate_layer: QgsVectorLayer, user_log_layer: QgsVectorLayer):
+    boundaries_pending_changed = pyqtSignal()
+    # emitted with a list of electorate feature ids whenever the queue changes electorate geometries
+    geometries_changed = pyqtSignal(list)
+
+    def __init__(self, electorate_layer: QgsVectorLayer, user_log_layer: QgsVectorLayer,
+                 history_memory_limit: Optional[int] = None,
+                 user_log_writer: Optional[UserLogWriter] = None):
         """
         Constructor
         :param electorate_layer: target electorate layer
         :param user_log_layer: user log layer
+        :param history_memory_limit: optional maximum size (in bytes) of the compressed
+        electorate geometries to keep in memory. Older geometries will be spilled to a
+        temporary file when the limit is exceeded.
+        :param user_log_writer: optional writer for user log entries, e.g. a buffered writer
+        which is flushed when the meshblock layer is saved. If not set, entries will be
+        written directly to the user log layer.
         """
         super().__init__()
         self.electorate_layer = electorate_layer
         self.user_log_layer = user_log_layer
+        self.user_log_writer = user_log_writer if user_log_writer is not None else UserLogWriter(user_log_layer)
+        self.geometry_history = GeometryHistory(memory_limit=history_memory_limit)
         self.meshblock_undo_index = 0
         self.blocked = False
+        # electorate feature id to the most recent queue item with a pending geometry for the electorate
+        self.pending_boundaries: Dict[int, QueueItem] = {}
+        # background tasks calculating pending geometries
+        self.boundary_tasks: List[QgsTask] = []
+        # incremented whenever the queue is cleared, so that results from boundary
+        # tasks started before the queue was cleared can be discarded
+        self.generation = 0
+        # electorate feature id to number of times the queue has changed the electorate's geometry
+        self.geometry_versions: Dict[int, int] = {}
 
     def sync_to_meshblock_undostack_index(self, index: int):
         """
@@ -102,14 +227,9 @@ class ElectorateEditQueue(QUndoStack):
         if self.blocked:
             return
 
-        is_back = index < self.meshblock_undo_index
-        while self.meshblock_undo_index != index:
-            if is_back:
-                self.back()
-                self.meshblock_undo_index -= 1
-            else:
-                self.forward()
-                self.meshblock_undo_index += 1
+        target = min(max(self.index() + index - self.meshblock_undo_index, 0), self.count())
+        self.jump_to(target)
+        self.meshblock_undo_index = index
 
     def rollback(self):
         """
@@ -117,12 +237,17 @@ class ElectorateEditQueue(QUndoStack):
         """
         self.sync_to_meshblock_undostack_index(0)
 
-    def push_changes(self, attribute_edits: dict, geometry_edits: dict, log_entries: List[QgsFeature]):
+    def push_changes(self, attribute_edits: dict, geometry_edits: dict, log_entries: List[QgsFeature],
+                     pending_geometry_ids: Optional[List[int]] = None) -> QueueItem:
         """
         Pushes a new set of electorate layer changes to the end of the queue
         :param attribute_edits: dictionary of attribute edits
         :param geometry_edits: dictionary of geometry edits
         :param log_entries: user log entries associated with this change
+        :param pending_geometry_ids: optional list of electorate feature ids for which the
+        new geometries are still being calculated. These should later be set by calling
+        set_pending_geometries().
+        :return: new queue item
         """
 
         self.meshblock_undo_index += 1
@@ -135,14 +260,203 @@ class ElectorateEditQueue(QUndoStack):
             feature_id: {attribute_index: attributes[feature_id][attribute_index] for attribute_index in v.keys()} for
             feature_id, v in attribute_edits.items()}
 
-        geometry_feature_ids = list(geometry_edits.keys())
+        geometry_feature_ids = list(geometry_edits.keys()) + list(pending_geometry_ids or [])
         request = QgsFeatureRequest().setFilterFids(geometry_feature_ids).setSubsetOfAttributes([])
         geometries = {f.id(): f.geometry() for f in self.electorate_layer.getFeatures(request)}
-        prev_geometries = {feature_id: geometries[feature_id] for feature_id, v in geometry_edits.items()}
+        prev_geometries = {feature_id: geometries[feature_id] for feature_id in geometry_feature_ids}
+
+        item = QueueItem(self.electorate_layer, prev_attributes, prev_geometries, attribute_edits, geometry_edits,
+                         self.user_log_layer,
+                         log_entries,
+                         geometry_history=self.geometry_history,
+                         user_log_writer=self.user_log_writer)
+
+        # if an earlier change to the electorate is still pending, then the stored geometry is
+        # out of date and this item depends on the earlier item's calculated geometry
+        for feature_id in geometry_feature_ids:
+            earlier = self.pending_item_for_electorate(feature_id)
+            if earlier is not None:
+                item.dependencies[feature_id] = earlier
+                earlier.dependents.append(item)
+
+        if pending_geometry_ids:
+            item.pending_geometry_ids = set(pending_geometry_ids)
+            item.geometries_ready.clear()
+
+        # pushing discards any undone items
+        for index in range(self.index(), self.count()):
+            self.command(index).release_geometries()
+        self.push(item)
+
+        self.mark_geometries_changed(geometry_feature_ids)
+        if pending_geometry_ids:
+            for feature_id in pending_geometry_ids:
+                self.pending_boundaries[feature_id] = item
+            self.boundaries_pending_changed.emit()
+
+        return item
+
+    def geometry_version(self, feature_id: int) -> int:
+        """
+        Returns the current version of an electorate's geometry. The version is incremented
+        whenever the queue changes the electorate's geometry, so can be used to key caches
+        of values derived from the geometry.
+        :param feature_id: electorate feature id
+        """
+        return self.geometry_versions.get(feature_id, 0)
+
+    def mark_geometries_changed(self, feature_ids: List[int]):
+        """
+        Increments the geometry versions for electorates, and emits the geometries_changed signal
+        :param feature_ids: feature ids of electorates with changed geometries
+        """
+        feature_ids = list(feature_ids)
+        if not feature_ids:
+            return
+        for feature_id in feature_ids:
+            self.geometry_versions[feature_id] = self.geometry_version(feature_id) + 1
+        self.geometries_changed.emit(feature_ids)
+
+    def pending_item_for_electorate(self, feature_id: int) -> Optional[QueueItem]:
+        """
+        Returns the applied queue item with a pending geometry for an electorate, if any
+        :param feature_id: electorate feature id
+        """
+        item = self.pending_boundaries.get(feature_id)
+        if item is not None and item.applied and feature_id in item.pending_geometry_ids:
+            return item
+        return None
+
+    def pending_boundary_ids(self) -> List[int]:
+        """
+        Returns a list of the feature ids of all electorates with currently applied,
+        but not yet calculated, geometries
+        """
+        return [feature_id for feature_id in self.pending_boundaries
+                if self.pending_item_for_electorate(feature_id) is not None]
+
+    def add_boundary_task(self, task: QgsTask):
+        """
+        Registers a background task which is calculating pending geometries for the queue.
+        The task will be canceled if the queue is cleared before the task completes.
+        :param task: boundary task
+        """
+        self.boundary_tasks.append(task)
+
+    def remove_boundary_task(self, task: QgsTask):
+        """
+        Removes a completed boundary task
+        :param task: boundary task, as previously passed to add_boundary_task()
+        """
+        if task in self.boundary_tasks:
+            self.boundary_tasks.remove(task)
+
+    def set_pending_geometries(self, item: QueueItem, geometries: Dict[int, QgsGeometry]):
+        """
+        Sets the calculated geometries for a queue item which was pushed with pending geometries
+        :param item: queue item
+        :param geometries: dictionary of electorate feature id to calculated geometry. Any of
+        the item's pending geometries which are not included are considered failed, and
+        will not be updated.
+        """
+        failed = item.pending_geometry_ids.difference(geometries.keys())
+        item.set_new_geometries(geometries)
+        item.pending_geometry_ids = set()
+        if item.applied:
+            self.mark_geometries_changed(list(geometries.keys()))
+
+        # later items recorded their previous geometries before these were available
+        for dependent in item.dependents:
+            for feature_id, earlier in dependent.dependencies.items():
+                if earlier is item and feature_id in geometries:
+                    dependent.share_previous_geometry(feature_id, item)
+
+        for feature_id in list(geometries.keys()) + list(failed):
+            if self.pending_boundaries.get(feature_id) is item:
+                del self.pending_boundaries[feature_id]
+        self.boundaries_pending_changed.emit()
+
+    def jump_to(self, target: int) -> bool:
+        """
+        Moves the queue to the specified index, undoing or redoing all changes
+        between the current and target index.
+
+        Rather than individually undoing or redoing each change, the net change
+        to the electorate and user log layers is applied in a single batch.
+        :param target: target queue index
+        :return: True if the queue index was changed
+        """
+        current = self.index()
+        if target == current or target < 0 or target > self.count():
+            return False
+
+        is_back = target < current
+        if is_back:
+            # latest first, so that the earliest item's previous state wins
+            items = [self.command(i) for i in range(current - 1, target - 1, -1)]
+        else:
+            items = [self.command(i) for i in range(current, target)]
+
+        attributes = {}
+        geometry_keys = {}
+        for item in items:
+            item_attributes = item.previous_attributes if is_back else item.new_attributes
+            for feature_id, values in item_attributes.items():
+                attributes.setdefault(feature_id, {}).update(values)
+            geometry_keys.update(item.previous_geometry_keys if is_back else item.new_geometry_keys)
+
+        geometries = self.geometry_history.geometries(geometry_keys)
+        if geometries:
+            self.electorate_layer.dataProvider().changeGeometryValues(geometries)
+            self.mark_geometries_changed(list(geometries.keys()))
+        if attributes:
+            self.electorate_layer.dataProvider().changeAttributeValues(attributes)
+
+        if is_back:
+            log_entry_handles = []
+            for item in items:
+                log_entry_handles.extend(item.user_log_entry_handles)
+                item.user_log_entry_handles = []
+            self.user_log_writer.remove_entries(log_entry_handles)
+        else:
+            log_entries = []
+            for item in items:
+                log_entries.extend(item.user_log_entries)
+            if log_entries:
+                handles = self.user_log_writer.add_entries(log_entries)
+                offset = 0
+                for item in items:
+                    item.user_log_entry_handles = handles[offset:offset + len(item.user_log_entries)]
+                    offset += len(item.user_log_entries)
+
+        # update the stack state without reapplying each item's changes
+        for item in items:
+            item.coalesced = True
+        try:
+            self.setIndex(target)
+        finally:
+            for item in items:
+                item.coalesced = False
+
+        self.electorate_layer.triggerRepaint()
+        return True
+
+    def clear(self, *_):  # pylint: disable=missing-docstring
+        # pending geometries can't be set once the items and their history are discarded
+        self.generation += 1
+        for task in self.boundary_tasks:
+            task.cancel()
+        self.boundary_tasks = []
+        had_pending_boundaries = bool(self.pending_boundaries)
+        for item in self.pending_boundaries.values():
+            item.pending_geometry_ids = set()
+        self.pending_boundaries = {}
+
+        super().clear()
+        self.geometry_history.clear()
 
-        self.push(QueueItem(self.electorate_layer, prev_attributes, prev_geometries, attribute_edits, geometry_edits,
-                            self.user_log_layer,
-                            log_entries))
+        if had_pending_boundaries:
+            self.boundaries_pending_changed.emit()
 
     def back(self) -> bool:
         """
@@ -153,6 +467,7 @@ class ElectorateEditQueue(QUndoStack):
             return False
 
         self.setIndex(self.index() - 1)
+        self.mark_geometries_changed(list(self.command(self.index()).previous_geometry_keys.keys()))
         return True
 
     def forward(self) -> bool:
@@ -164,4 +479,5 @@ class ElectorateEditQueue(QUndoStack):
             return False
 
         self.setIndex(self.index() + 1)
+        self.mark_geometries_changed(list(self.command(self.index() - 1).new_geometry_keys.keys()))
         return True
@@ -0,0 +1,215 @@
+"""
+LINZ Redistricting Plugin - Electorate geometry cache
+"""
+
+from contextlib import closing
+import hashlib
+import sqlite3
+import struct
+import time
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple
+)
+
+from qgis.core import (
+    QgsGeometry,
+    QgsSettings
+)
+
+
+class ElectorateGeometryCache:
+    """
+    A persistent cache of dissolved electorate geometries and populations,
+    stored in a side table within the project database.
+
+    Cached entries are keyed by scenario, electorate type and electorate id,
+    and are only reused if the fingerprint of the electorate's meshblocks
+    (and of the meshblock dataset they were read from) matches the fingerprint
+    stored alongside the cached geometry. The cache is best-effort only: any
+    database errors are treated as a cache miss.
+    """
+
+    TABLE_NAME = 'electorate_geometry_cache'
+
+    DEFAULT_MAX_AGE_DAYS = 30
+    DEFAULT_MAX_ENTRIES = 5000
+
+    def __init__(self, database: str,
+                 max_age_days: Optional[int] = None,
+                 max_entries: Optional[int] = None):
+        """
+        Constructor for ElectorateGeometryCache
+        :param database: path to project database
+        :param max_age_days: maximum age (since last use) of cached entries, in days. If not set
+        the value will be taken from the plugin settings.
+        :param max_entries: maximum number of cached entries. If not set
+        the value will be taken from the plugin settings.
+        """
+        self.database = database
+        if max_age_days is None:
+            max_age_days = QgsSettings().value('redistrict/geometry_cache_max_age', self.DEFAULT_MAX_AGE_DAYS,
+                                               int, QgsSettings.Plugins)
+        if max_entries is None:
+            max_entries = QgsSettings().value('redistrict/geometry_cache_max_entries', self.DEFAULT_MAX_ENTRIES,
+                                              int, QgsSettings.Plugins)
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self._table_created = False
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """
+        Returns True if the geometry cache is enabled in the plugin settings
+        """
+        return QgsSettings().value('redistrict/use_geometry_cache', True, bool, QgsSettings.Plugins)
+
+    @staticmethod
+    def fingerprint(meshblock_numbers: Iterable[int], meshblock_version: str = '') -> str:
+        """
+        Calculates a fingerprint for a set of meshblocks
+        :param meshblock_numbers: meshblock numbers
+        :param meshblock_version: version of the meshblock dataset, e.g. MeshblockStore.content_hash().
+        Fingerprints for different meshblock datasets never match, even if the meshblock numbers
+        are reused.
+        """
+        numbers = sorted(int(n) for n in meshblock_numbers)
+        fingerprint = hashlib.sha1(meshblock_version.encode('utf-8'))
+        fingerprint.update(struct.pack(f'<{len(numbers)}q', *numbers))
+        return fingerprint.hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database. Connections are not shared, so that the cache
+        can safely be used from background tasks.
+        """
+        connection = sqlite3.connect(self.database, timeout=5)
+        if not self._table_created:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} ('
+                               'scenario_id INTEGER NOT NULL, '
+                               'electorate_type TEXT NOT NULL, '
+                               'electorate_id TEXT NOT NULL, '
+                               'fingerprint TEXT NOT NULL, '
+                               'estimated_pop INTEGER, '
+                               'geometry BLOB, '
+                               'last_used REAL NOT NULL, '
+                               'PRIMARY KEY (scenario_id, electorate_type, electorate_id))')
+            connection.commit()
+            self._table_created = True
+        return connection
+
+    def entries_for_scenario(self, scenario_id) -> Dict[Tuple[str, str], Tuple[str, int, QgsGeometry]]:
+        """
+        Returns all cached entries for a scenario, as a dictionary of (electorate type, electorate id)
+        to a tuple of (fingerprint, estimated population, geometry)
+        :param scenario_id: scenario id
+        """
+        try:
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    f'SELECT electorate_type, electorate_id, fingerprint, estimated_pop, geometry '
+                    f'FROM {self.TABLE_NAME} WHERE scenario_id=?', (scenario_id,)).fetchall()
+        except sqlite3.Error:
+            return {}
+
+        entries = {}
+        for electorate_type, electorate_id, fingerprint, estimated_pop, wkb in rows:
+            geometry = QgsGeometry()
+            if wkb:
+                geometry.fromWkb(bytes(wkb))
+            entries[(electorate_type, electorate_id)] = (fingerprint, estimated_pop, geometry)
+        return entries
+
+    def touch(self, scenario_id, keys: List[Tuple[str, str]]):
+        """
+        Updates the last used time for cached entries
+        :param scenario_id: scenario id
+        :param keys: list of (electorate type, electorate id) keys to update
+        """
+        if not keys:
+            return
+        now = time.time()
+        try:
+            with closing(self._connect()) as connection:
+                connection.executemany(
+                    f'UPDATE {self.TABLE_NAME} SET last_used=? '
+                    'WHERE scenario_id=? AND electorate_type=? AND electorate_id=?',
+                    [(now, scenario_id, electorate_type, electorate_id) for electorate_type, electorate_id in keys])
+                connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def store(self, scenario_id, entries: List[Tuple[str, str, str, int, QgsGeometry]]):
+        """
+        Stores entries in the cache, and then evicts stale entries
+        :param scenario_id: scenario id
+        :param entries: list of (electorate type, electorate id, fingerprint, estimated population, geometry)
+        """
+        if not entries:
+            return
+        now = time.time()
+        try:
+            with closing(self._connect()) as connection:
+                connection.executemany(
+                    f'INSERT OR REPLACE INTO {self.TABLE_NAME} '
+                    '(scenario_id, electorate_type, electorate_id, fingerprint, estimated_pop, geometry, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(scenario_id, electorate_type, electorate_id, fingerprint, estimated_pop,
+                      bytes(geometry.asWkb()) if not geometry.isNull() else None, now)
+                     for electorate_type, electorate_id, fingerprint, estimated_pop, geometry in entries])
+                connection.commit()
+                self._evict(connection)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, connection: sqlite3.Connection):
+        """
+        Evicts entries which are older than the maximum age, and the least recently used
+        entries when the cache exceeds the maximum number of entries
+        """
+        cutoff = time.time() - self.max_age_days * 86400
+        connection.execute(f'DELETE FROM {self.TABLE_NAME} WHERE last_used < ?', (cutoff,))
+        connection.execute(f'DELETE FROM {self.TABLE_NAME} WHERE rowid NOT IN '
+                           f'(SELECT rowid FROM {self.TABLE_NAME} ORDER BY last_used DESC LIMIT ?)',
+                           (self.max_entries,))
+        connection.commit()
+
+    def evict(self):
+        """
+        Evicts stale entries from the cache
+        """
+        try:
+            with closing(self._connect()) as connection:
+                self._evict(connection)
+        except sqlite3.Error:
+            pass
+
+    def clear(self, scenario_id=None) -> bool:
+        """
+        Clears the cache
+        :param scenario_id: if set, only entries for this scenario will be cleared
+        :returns True if cache was successfully cleared
+        """
+        try:
+            with closing(self._connect()) as connection:
+                if scenario_id is None:
+                    connection.execute(f'DELETE FROM {self.TABLE_NAME}')
+                else:
+                    connection.execute(f'DELETE FROM {self.TABLE_NAME} WHERE scenario_id=?', (scenario_id,))
+                connection.commit()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def count(self) -> int:
+        """
+        Returns the number of entries in the cache
+        """
+        try:
+            with closing(self._connect()) as connection:
+                return connection.execute(f'SELECT COUNT(*) FROM {self.TABLE_NAME}').fetchone()[0]
+        except sqlite3.Error:
+            return 0
@@ -13,6 +13,7 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from typing import Optional
 from qgis.core import (QgsVectorLayer,
                        QgsFeature,
                        QgsVectorFileWriter,
@@ -20,6 +21,8 @@ from qgis.core import (QgsVectorLayer,
                        NULL)
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -36,7 +39,8 @@ class ExportTask(ScenarioBaseTask):
     def __init__(self, task_name: str, dest_file: str, electorate_registry: LinzElectoralDistrictRegistry,
                  meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
-                 user_log_layer: QgsVectorLayer):
+                 user_log_layer: QgsVectorLayer, meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None):
         """
         Constructor for ExportTask
         :param task_name: user-visible, translated name for task
@@ -47,12 +51,15 @@ class ExportTask(ScenarioBaseTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param user_log_layer: user log layer
+        :param meshblock_store: shared meshblock store
+        :param geometry_cache: optional electorate geometry cache
         """
         self.electorate_registry = electorate_registry
         super().__init__(task_name=task_name, electorate_layer=self.electorate_registry.source_layer,
                          meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=None)
+                         scenario=scenario, task=None, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
         self.dest_file = dest_file
         self.message = None
         self.user_log_layer = user_log_layer
@@ -77,6 +84,7 @@ class ExportTask(ScenarioBaseTask):
 
         electorate_features = []
 
+        meshblock_number_values = self.meshblock_store.meshblock_number_values
         for electorate_feature_id, attributes in electorate_attributes.items():
             if self.isCanceled():
                 return False
@@ -89,7 +97,7 @@ class ExportTask(ScenarioBaseTask):
             name = attributes[self.ELECTORATE_NAME]
 
             for m in meshblocks:
-                meshblock_number = m[self.meshblock_number_idx]
+                meshblock_number = meshblock_number_values[m]
                 if meshblock_number not in meshblock_electorates:
                     meshblock_electorates[meshblock_number] = {}
                 meshblock_electorates[meshblock_number][electorate_type] = electorate_code
@@ -0,0 +1,166 @@
+"""
+LINZ Redistricting Plugin - Compact storage for electorate geometry history
+"""
+
+from collections import OrderedDict
+import os
+import tempfile
+import zlib
+from typing import (
+    Dict,
+    Optional,
+    Tuple
+)
+
+from qgis.core import QgsGeometry
+
+
+class GeometryHistory:
+    """
+    Compact storage for the electorate geometries held by the electorate
+    changes undo history.
+
+    Geometries are stored as zlib compressed WKB, and identified by an integer
+    key. Entries are reference counted, so that a geometry can be shared between
+    multiple history items.
+
+    If the total size of the compressed geometries held in memory exceeds the
+    memory limit, the oldest entries are spilled to a temporary file and read
+    back on demand.
+    """
+
+    # default memory limit, in bytes
+    DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+    COMPRESSION_LEVEL = 1
+
+    def __init__(self, memory_limit: Optional[int] = None):
+        """
+        Constructor
+        :param memory_limit: maximum size (in bytes) of compressed geometries to
+        keep in memory. If not set, DEFAULT_MEMORY_LIMIT will be used.
+        """
+        self.memory_limit = memory_limit if memory_limit is not None else self.DEFAULT_MEMORY_LIMIT
+
+        self._next_key = 0
+        # key to compressed wkb, oldest first
+        self._entries: Dict[int, bytes] = OrderedDict()
+        self._memory_size = 0
+        # key to (offset, length) within spill file
+        self._spilled: Dict[int, Tuple[int, int]] = {}
+        self._spill_file = None
+        self._ref_counts: Dict[int, int] = {}
+
+    def add(self, geometry: QgsGeometry) -> int:
+        """
+        Adds a geometry to the history, and returns the key for the stored geometry.
+        The returned key has a reference count of 1.
+        :param geometry: geometry to store
+        """
+        key = self._next_key
+        self._next_key += 1
+
+        data = zlib.compress(bytes(geometry.asWkb()), self.COMPRESSION_LEVEL)
+        self._entries[key] = data
+        self._memory_size += len(data)
+        self._ref_counts[key] = 1
+
+        self._spill()
+        return key
+
+    def retain(self, key: int):
+        """
+        Increments the reference count for a stored geometry
+        :param key: geometry key
+        """
+        if key in self._ref_counts:
+            self._ref_counts[key] += 1
+
+    def release(self, key: int):
+        """
+        Decrements the reference count for a stored geometry, removing the
+        geometry from the history once it is no longer referenced
+        :param key: geometry key
+        """
+        count = self._ref_counts.get(key)
+        if count is None:
+            return
+
+        if count > 1:
+            self._ref_counts[key] = count - 1
+            return
+
+        del self._ref_counts[key]
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        # space in the spill file is not reclaimed until the history is cleared
+        self._spilled.pop(key, None)
+
+    def geometry(self, key: int) -> QgsGeometry:
+        """
+        Returns a stored geometry
+        :param key: geometry key
+        """
+        data = self._entries.get(key)
+        if data is None:
+            offset, length = self._spilled[key]
+            self._spill_file.seek(offset)
+            data = self._spill_file.read(length)
+
+        geometry = QgsGeometry()
+        geometry.fromWkb(zlib.decompress(data))
+        return geometry
+
+    def geometries(self, keys: Dict[int, int]) -> Dict[int, QgsGeometry]:
+        """
+        Returns a dictionary of stored geometries
+        :param keys: dictionary of feature id to geometry key
+        :return: dictionary of feature id to geometry
+        """
+        return {feature_id: self.geometry(key) for feature_id, key in keys.items()}
+
+    def count(self) -> int:
+        """
+        Returns the number of geometries stored in the history
+        """
+        return len(self._ref_counts)
+
+    def memory_size(self) -> int:
+        """
+        Returns the total size (in bytes) of the compressed geometries held in memory
+        """
+        return self._memory_size
+
+    def spilled_count(self) -> int:
+        """
+        Returns the number of geometries which have been spilled to disk
+        """
+        return len(self._spilled)
+
+    def _spill(self):
+        """
+        Spills the oldest in memory geometries to the temporary file until the
+        memory limit is no longer exceeded
+        """
+        while self._memory_size > self.memory_limit and self._entries:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(prefix='redistrict_history_')  # pylint: disable=consider-using-with
+
+            key, data = self._entries.popitem(last=False)
+            self._memory_size -= len(data)
+            offset = self._spill_file.seek(0, os.SEEK_END)
+            self._spill_file.write(data)
+            self._spilled[key] = (offset, len(data))
+
+    def clear(self):
+        """
+        Removes all geometries from the history
+        """
+        self._entries = OrderedDict()
+        self._memory_size = 0
+        self._spilled = {}
+        self._ref_counts = {}
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
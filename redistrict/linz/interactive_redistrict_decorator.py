@@ -3,12 +3,13 @@ LINZ Redistricting Plugin - Decorator for electorates
 """
 
 from qgis.PyQt.QtCore import (
+    QCoreApplication,
     QSizeF,
     QPointF
 )
 from qgis.PyQt.QtGui import (
-    QImage,
-    QPainter
+    QPainter,
+    QPicture
 )
 from qgis.core import (
     QgsSettings,
@@ -17,8 +18,7 @@ from qgis.core import (
     QgsTextFormat,
     QgsRenderContext,
     QgsTextRenderer,
-    QgsVectorLayer,
-    NULL
+    QgsVectorLayer
 )
 from qgis.gui import (
     QgsMapCanvas,
@@ -54,86 +54,137 @@ class CentroidDecorator(QgsMapCanvasItem):
         self.text_format.background().setSize(QSizeF(1, 0))
         self.text_format.background().setOffset(QPointF(0, -0.7))
         self.text_format.background().setRadii(QSizeF(1, 1))
-        self.image = None
         self.quota = quota
-        self.original_populations = {}
-        self.new_populations = {}
+        self.populations = {}
+        self.pending_boundaries = set()
+
+        # electorate changes queue of the current handler, used to track changes to electorate geometries
+        self.electorate_changes_queue = None
+        # electorates (and their names) visible in the cached extent, fetched again whenever the
+        # extent changes or the queue changes any electorate geometry
+        self.extent = None
+        self.extent_geometry_versions = None
+        self.visible_electorates = {}
+        # electorate feature id to (geometry version, label anchor point). Anchors are only recalculated
+        # when the queue changes the electorate's geometry, so panning and zooming is cheap.
+        self.anchors = {}
+        # electorate feature id to rendered label
+        self.labels = {}
 
     def redraw(self, handler):
         """
-        Forces a redraw of the cached image
+        Updates the decorator for changes made by a handler, redrawing only the labels for
+        electorates with changed populations
         """
-        self.image = None
-
-        if not self.original_populations:
-            # first run, get initial estimates
-            request = QgsFeatureRequest()
-            request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
-            request.setFlags(QgsFeatureRequest.NoGeometry)
-            for f in self.electorate_layer.getFeatures(request):
-                estimated_pop = f.attribute(handler.stats_nz_pop_field_index)
-                if estimated_pop is None or estimated_pop == NULL:
-                    # otherwise just use existing estimated pop as starting point
-                    estimated_pop = f.attribute(handler.estimated_pop_idx)
-                self.original_populations[f.id()] = estimated_pop
-
-        # step 1: get all electorate features corresponding to affected electorates
-        electorate_features = {f[handler.electorate_layer_field]: f for f in
-                               handler.get_affected_districts(
-                                   [handler.electorate_layer_field, handler.stats_nz_pop_field, 'estimated_pop'],
-                                   needs_geometry=False)}
-
-        self.new_populations = {}
-
-        for district in handler.pending_affected_districts.keys():  # pylint: disable=consider-iterating-dictionary
-            # use stats nz pop as initial estimate, if available
-            estimated_pop = electorate_features[district].attribute(handler.stats_nz_pop_field_index)
-            if estimated_pop is None or estimated_pop == NULL:
-                # otherwise just use existing estimated pop as starting point
-                estimated_pop = electorate_features[district].attribute(handler.estimated_pop_idx)
-            # add new bits
-            estimated_pop = handler.grow_population_with_added_meshblocks(district, estimated_pop)
-            # minus lost bits
-            estimated_pop = handler.shrink_population_by_removed_meshblocks(district, estimated_pop)
-
-            self.new_populations[electorate_features[district].id()] = estimated_pop
-
-    def paint(self, painter, option, widget):  # pylint: disable=missing-docstring, unused-argument, too-many-locals
-        if self.image is not None:
-            painter.drawImage(0, 0, self.image)
-            return
-
-        image_size = self.canvas.mapSettings().outputSize()
-        self.image = QImage(image_size.width(), image_size.height(), QImage.Format_ARGB32)
-        self.image.fill(0)
-        image_painter = QPainter(self.image)
-        render_context = QgsRenderContext.fromQPainter(image_painter)
+        self.electorate_changes_queue = handler.electorate_changes_queue
+        # populations (including pending changes) are maintained by the handler's ledger,
+        # so no feature requests are required here
+        populations = handler.population_ledger.populations_by_feature_id()
+        # electorates whose boundaries are still being recalculated in the background
+        pending_boundaries = set(handler.electorate_changes_queue.pending_boundary_ids())
+
+        changed = {electorate_id for electorate_id in set(populations) | set(self.populations) if
+                   populations.get(electorate_id) != self.populations.get(electorate_id)}
+        changed |= pending_boundaries ^ self.pending_boundaries
+        self.populations = populations
+        self.pending_boundaries = pending_boundaries
+
+        for electorate_id in changed:
+            self.labels.pop(electorate_id, None)
+        if changed:
+            self.update()
+
+    def geometry_version(self, electorate_id: int) -> int:
+        """
+        Returns the current version of an electorate's geometry
+        :param electorate_id: electorate feature id
+        """
+        if self.electorate_changes_queue is None:
+            return 0
+        return self.electorate_changes_queue.geometry_version(electorate_id)
 
-        image_painter.setRenderHint(QPainter.Antialiasing, True)
+    def update_visible_electorates(self, extent):
+        """
+        Fetches the names of all electorates visible in an extent
+        :param extent: visible map extent
+        """
+        self.extent = extent
+        self.extent_geometry_versions = dict(self.electorate_changes_queue.geometry_versions) \
+            if self.electorate_changes_queue is not None else None
 
-        rect = self.canvas.mapSettings().visibleExtent()
         request = QgsFeatureRequest()
-        request.setFilterRect(rect)
+        request.setFilterRect(extent)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
         request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', self.task))
+        request.setSubsetOfAttributes(['name'], self.electorate_layer.fields())
+        self.visible_electorates = {f.id(): f['name'] for f in self.electorate_layer.getFeatures(request)}
 
-        for f in self.electorate_layer.getFeatures(request):
-            #    pole, dist = f.geometry().clipped(rect).poleOfInaccessibility(rect.width() / 30)
-            pixel = self.toCanvasCoordinates(f.geometry().clipped(rect).centroid().asPoint())
-
-            estimated_pop = self.new_populations[f.id()] if f.id() in self.new_populations else \
-            self.original_populations[f.id()]
-
-            variance = LinzElectoralDistrictRegistry.get_variation_from_quota_percent(self.quota, estimated_pop)
-            variance_dir_string = '+' if variance > 0 else ''
-            text_string = [f'{f['name']}',
-                           f'{int(estimated_pop)}',
-                           f'{variance_dir_string}{variance}%']
-            QgsTextRenderer().drawText(QPointF(pixel.x(), pixel.y()), 0, QgsTextRenderer.AlignCenter,
-                                       text_string, render_context, self.text_format)
-
-        image_painter.end()
+    def update_anchors(self, electorate_ids):
+        """
+        Calculates the label anchor points for electorates which have no anchor for their
+        current geometry version
+        :param electorate_ids: electorate feature ids
+        """
+        versions = {electorate_id: self.geometry_version(electorate_id) for electorate_id in electorate_ids}
+        stale = [electorate_id for electorate_id, version in versions.items()
+                 if self.anchors.get(electorate_id, (None, None))[0] != version]
+        if not stale:
+            return
 
-        painter.drawImage(0, 0, self.image)
+        request = QgsFeatureRequest().setFilterFids(stale).setNoAttributes()
+        for f in self.electorate_layer.getFeatures(request):
+            geometry = f.geometry()
+            bounds = geometry.boundingBox()
+            anchor = geometry.poleOfInaccessibility(max(bounds.width(), bounds.height()) / 30)[0]
+            if anchor.isNull():
+                anchor = geometry.centroid()
+            self.anchors[f.id()] = (versions[f.id()], None if anchor.isNull() else anchor.asPoint())
+
+    def render_label(self, electorate_id: int, name: str) -> QPicture:
+        """
+        Renders the label for an electorate, centered on the origin
+        :param electorate_id: electorate feature id
+        :param name: electorate name
+        """
+        estimated_pop = self.populations.get(electorate_id, 0)
+
+        variance = LinzElectoralDistrictRegistry.get_variation_from_quota_percent(self.quota, estimated_pop)
+        variance_dir_string = '+' if variance > 0 else ''
+        text_string = [name,
+                       f'{int(estimated_pop)}',
+                       f'{variance_dir_string}{variance}%']
+        if electorate_id in self.pending_boundaries:
+            text_string.append(QCoreApplication.translate('LinzRedistrict', '(boundary pending)'))
+
+        picture = QPicture()
+        picture_painter = QPainter(picture)
+        picture_painter.setRenderHint(QPainter.Antialiasing, True)
+        render_context = QgsRenderContext.fromQPainter(picture_painter)
+        QgsTextRenderer().drawText(QPointF(0, 0), 0, QgsTextRenderer.AlignCenter,
+                                   text_string, render_context, self.text_format)
+        picture_painter.end()
+        return picture
+
+    def paint(self, painter, option, widget):  # pylint: disable=missing-docstring, unused-argument
+        extent = self.canvas.mapSettings().visibleExtent()
+        geometry_versions = self.electorate_changes_queue.geometry_versions \
+            if self.electorate_changes_queue is not None else None
+        if extent != self.extent or geometry_versions != self.extent_geometry_versions:
+            self.update_visible_electorates(extent)
+        self.update_anchors(self.visible_electorates.keys())
+
+        for electorate_id, name in self.visible_electorates.items():
+            anchor = self.anchors.get(electorate_id, (None, None))[1]
+            if anchor is None:
+                continue
+
+            label = self.labels.get(electorate_id)
+            if label is None:
+                label = self.render_label(electorate_id, name)
+                self.labels[electorate_id] = label
+
+            pixel = self.toCanvasCoordinates(anchor)
+            painter.drawPicture(QPointF(pixel.x(), pixel.y()), label)
 
 
 class CentroidDecoratorFactory(DecoratorFactory):
@@ -2,11 +2,25 @@
 LINZ Redistricting Plugin - LINZ meshblock to scenario bridge
 """
 
-from typing import Dict, List
-from qgis.PyQt.QtCore import QObject
-from qgis.core import (QgsFeatureRequest,
+from functools import partial
+from typing import Dict, List, Optional
+from qgis.PyQt.QtCore import (QObject,
+                              QTimer,
+                              pyqtSignal)
+from qgis.core import (Qgis,
+                       QgsFeatureRequest,
                        QgsExpression,
+                       QgsMessageLog,
                        QgsVectorLayer)
+from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.user_log_writer import UserLogWriter
+
+
+class ScenarioSaveError(Exception):
+    """
+    Raised when changes to the meshblock layer cannot be written to the
+    meshblock-scenario table, and the commit cannot otherwise be blocked
+    """
 
 
 class LinzMeshblockScenarioBridge(QObject):
@@ -15,16 +29,28 @@ class LinzMeshblockScenarioBridge(QObject):
     and the meshblock-scenario table
     """
 
-    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_scenario_layer: QgsVectorLayer, meshblock_number_field_name: str):
+    # emitted with a user-visible, translated message when a save is aborted
+    save_failed = pyqtSignal(str)
+
+    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_scenario_layer: QgsVectorLayer, meshblock_number_field_name: str,
+                 user_log_writer: Optional[UserLogWriter] = None,
+                 scenario_registry: Optional[ScenarioRegistry] = None):
         """
         Constructor
         :param meshblock_layer: meshblock layer
         :param meshblock_scenario_layer: meshblock-scenario table
         :param meshblock_number_field_name: name of meshblock number field
+        :param user_log_writer: optional buffered user log writer, which will be flushed
+        after changes to the meshblock layer are successfully saved
+        :param scenario_registry: optional scenario registry. Must be set if the registry
+        stores branched scenarios as a lineage, so that inherited meshblock records
+        are correctly handled when the meshblock layer is saved
         """
         super().__init__()
         self.meshblock_layer = meshblock_layer
         self.meshblock_scenario_layer = meshblock_scenario_layer
+        self.user_log_writer = user_log_writer
+        self.scenario_registry = scenario_registry
 
         self.staged_electorate_idx = self.meshblock_layer.fields().lookupField('staged_electorate')
         assert self.staged_electorate_idx >= 0
@@ -37,9 +63,50 @@ class LinzMeshblockScenarioBridge(QObject):
         assert self.target_meshblock_number_idx >= 0
 
         self.meshblock_layer.beforeCommitChanges.connect(self.meshblock_layer_saved)
+        # only emitted if the commit succeeds
+        self.meshblock_layer.afterCommitChanges.connect(self.meshblock_layer_committed)
+        self.meshblock_layer.afterRollBack.connect(self.meshblock_layer_rolled_back)
 
-        self.scenario = None
+        self._scenario = None
         self.task = None
+        # meshblock number to target feature id, for current scenario
+        self._target_id_index: Optional[Dict[int, int]] = None
+
+    @property
+    def scenario(self):
+        """
+        Returns the current scenario
+        """
+        return self._scenario
+
+    @scenario.setter
+    def scenario(self, scenario):
+        """
+        Sets the current scenario
+        """
+        if scenario != self._scenario:
+            self.invalidate()
+        self._scenario = scenario
+
+    def invalidate(self):
+        """
+        Invalidates the cached index of target meshblock feature IDs, e.g. after the
+        meshblock-scenario table has been modified
+        """
+        self._target_id_index = None
+
+    def build_target_id_index(self) -> Dict[int, int]:
+        """
+        Builds the index of meshblock numbers to target feature IDs for the current scenario
+        """
+        assert self.scenario is not None
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.target_meshblock_number_idx])
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', self.scenario))
+        self._target_id_index = {int(f[self.target_meshblock_number_idx]): f.id() for f in
+                                 self.meshblock_scenario_layer.getFeatures(request)}
+        return self._target_id_index
 
     def get_new_electorates(self) -> Dict[int, int]:
         """
@@ -78,17 +145,13 @@ class LinzMeshblockScenarioBridge(QObject):
         :param meshblock_numbers: list of meshblock numbers to lookup
         """
         assert self.scenario is not None
-        request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([self.target_meshblock_number_idx])
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', self.scenario))
-        meshblock_numbers_str = ','.join([str(mb) for mb in meshblock_numbers])
-        meshblock_filter = f'meshblock_number IN ({meshblock_numbers_str})'
-        request.combineFilterExpression(meshblock_filter)
+        index = self._target_id_index
+        if index is None or any(int(mb) not in index for mb in meshblock_numbers):
+            # missing meshblocks may have been added since the index was built
+            index = self.build_target_id_index()
+
         # create dictionary of meshblock number to id
-        mb_number_to_target_id = {}
-        for f in self.meshblock_scenario_layer.getFeatures(request):
-            mb_number_to_target_id[f[self.target_meshblock_number_idx]] = f.id()
-        return mb_number_to_target_id
+        return {mb: index[int(mb)] for mb in meshblock_numbers if int(mb) in index}
 
     def meshblock_layer_saved(self):
         """
@@ -103,8 +166,26 @@ class LinzMeshblockScenarioBridge(QObject):
         # dict of meshblock number to new electorate
         new_electorates = self.get_new_electorates()
 
+        if self.scenario_registry is not None and self.scenario_registry.has_lineage_field():
+            # inherited records must be copied to the scenario (and the current records copied
+            # to its branches) before they can be changed. Any meshblocks missing from the
+            # index of the scenario's own records are inherited, and the index is rebuilt
+            # below once they have been copied.
+            index = self._target_id_index if self._target_id_index is not None else self.build_target_id_index()
+            if not self.scenario_registry.prepare_scenario_changes(self.scenario, new_electorates.keys(),
+                                                                   own_records=index):
+                # if any branch did not receive its own copy of the records, changing them
+                # would silently change that branch too
+                self.abort_save(self.tr('Could not copy meshblock records for scenario branches'))
+                return
+
         # find feature ids of affected rows
         mb_number_to_target_id = self.get_target_meshblock_ids_from_numbers(list(new_electorates.keys()))
+        missing = [mb for mb in new_electorates if mb not in mb_number_to_target_id]
+        if missing:
+            self.abort_save(self.tr('Could not find scenario records for meshblocks {}').format(
+                ', '.join(str(mb) for mb in missing)))
+            return
 
         # create map of changes attributes
         target_changed_attributes = {}
@@ -113,3 +194,36 @@ class LinzMeshblockScenarioBridge(QObject):
             target_changed_attributes[mb_id] = {electorate_field_idx: electorate}
 
         self.meshblock_scenario_layer.dataProvider().changeAttributeValues(target_changed_attributes)
+
+    def abort_save(self, message: str):
+        """
+        Aborts the pending commit of the meshblock layer, leaving all changes in the edit buffer
+        :param message: user-visible, translated reason for aborting the save
+        """
+        QgsMessageLog.logMessage(message, 'REDISTRICT', Qgis.Critical)
+        self.save_failed.emit(message)
+        if hasattr(self.meshblock_layer, 'setAllowCommit'):
+            # commitChanges() checks this flag after emitting beforeCommitChanges, so the
+            # commit fails. Allow later commits once the current one has been rejected.
+            self.meshblock_layer.setAllowCommit(False)
+            QTimer.singleShot(0, partial(self.meshblock_layer.setAllowCommit, True))
+        else:
+            raise ScenarioSaveError(message)
+
+    def meshblock_layer_committed(self):
+        """
+        Triggered after changes to the meshblock layer have been successfully saved
+        """
+        # write the user log entries for the saved changes. If the commit fails the
+        # entries remain buffered, as the changes are still pending.
+        if self.user_log_writer is not None:
+            self.user_log_writer.flush()
+
+    def meshblock_layer_rolled_back(self):
+        """
+        Triggered after changes to the meshblock layer have been rolled back
+        """
+        # entries kept after a failed commit no longer have an associated undo step, so
+        # must be explicitly discarded along with the changes they describe
+        if self.user_log_writer is not None:
+            self.user_log_writer.discard()
@@ -2,7 +2,9 @@
 LINZ Redistricting Plugin - LINZ Specific Redistrict Handler
 """
 
+from typing import List
 from qgis.PyQt.QtCore import (
+    QCoreApplication,
     QDateTime,
     QVariant
 )
@@ -16,7 +18,9 @@ from qgis.core import (
 )
 from redistrict.core.redistrict_handler import RedistrictHandler
 from redistrict.core.core_utils import CoreUtils
+from redistrict.linz.electorate_boundary_task import ElectorateBoundaryTask
 from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.linz.population_ledger import PopulationLedger
 
 
 class LinzRedistrictHandler(RedistrictHandler):
@@ -30,7 +34,8 @@ class LinzRedistrictHandler(RedistrictHandler):
     def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_number_field_name: str, target_field: str,
                  electorate_changes_queue: ElectorateEditQueue,
                  electorate_layer: QgsVectorLayer,
-                 electorate_layer_field: str, task: str, user_log_layer: QgsVectorLayer, scenario):
+                 electorate_layer_field: str, task: str, user_log_layer: QgsVectorLayer, scenario,
+                 background_boundaries: bool = False):
         """
         Constructor
         :param meshblock_layer: meshblock layer
@@ -42,6 +47,9 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param task: current task
         :param user_log_layer: user log layer
         :param scenario: current scenario
+        :param background_boundaries: if True, electorate boundaries will be recalculated
+        in a background task after each edit group, instead of blocking until the new
+        boundaries are calculated
         """
         super().__init__(target_layer=meshblock_layer, target_field=target_field)
         self.electorate_changes_queue = electorate_changes_queue
@@ -52,12 +60,15 @@ class LinzRedistrictHandler(RedistrictHandler):
         self.task = task
         self.user_log_layer = user_log_layer
         self.scenario = scenario
+        self.background_boundaries = background_boundaries
         self.stats_nz_pop_field = 'stats_nz_pop'
         self.stats_nz_var_20_field = 'stats_nz_var_20'
         self.stats_nz_var_23_field = 'stats_nz_var_23'
 
         # trigger stats dock update on undo/redo
         self.electorate_changes_queue.indexChanged.connect(self.redistrict_occured)
+        self.electorate_changes_queue.indexChanged.connect(self.electorate_queue_changed)
+        self.pushing_changes = False
 
         self.estimated_pop_idx = self.electorate_layer.fields().lookupField('estimated_pop')
         assert self.estimated_pop_idx >= 0
@@ -94,6 +105,21 @@ class LinzRedistrictHandler(RedistrictHandler):
         self.invalid_reason_field_index = self.electorate_layer.fields().lookupField('invalid_reason')
         assert self.invalid_reason_field_index >= 0
 
+        self.population_ledger = PopulationLedger(meshblock_layer=meshblock_layer,
+                                                  offline_pop_field_idx=self.offline_pop_field_idx,
+                                                  electorate_layer=electorate_layer,
+                                                  electorate_layer_field=electorate_layer_field,
+                                                  estimated_pop_idx=self.estimated_pop_idx,
+                                                  stats_nz_pop_idx=self.stats_nz_pop_field_index)
+
+    def electorate_queue_changed(self):
+        """
+        Triggered when the electorate changes queue is undone or redone, which
+        modifies the stored electorate populations
+        """
+        if not self.pushing_changes:
+            self.population_ledger.invalidate_electorates()
+
     def create_affected_district_filter(self):
         """
         Returns a QgsExpression filter corresponding to all pending affected
@@ -178,15 +204,12 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param district: district to grow
         :param original_pop: original population for district
         """
-        request = self.get_added_meshblocks_request(district)
-        if request is None:
+        if district not in self.pending_affected_districts:
             return original_pop
 
         pop = original_pop
-        parts = [f.attribute(self.offline_pop_field_idx) for f in self.target_layer.getFeatures(
-            request.setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([self.offline_pop_field_idx]))]
-        for p in parts:
-            pop += p
+        for meshblock in self.pending_affected_districts[district]['ADD']:
+            pop += self.population_ledger.meshblock_population(meshblock)
 
         return pop
 
@@ -236,15 +259,12 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param district: district to shrink
         :param original_pop: original population for district
         """
-        request = self.get_removed_meshblocks_request(district)
-        if request is None:
+        if district not in self.pending_affected_districts:
             return original_pop
 
         pop = original_pop
-        parts = [f.attribute(self.offline_pop_field_idx) for f in self.target_layer.getFeatures(
-            request.setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([self.offline_pop_field_idx]))]
-        for p in parts:
-            pop -= p
+        for meshblock in self.pending_affected_districts[district]['REMOVE']:
+            pop -= self.population_ledger.meshblock_population(meshblock)
 
         return pop
 
@@ -262,7 +282,7 @@ class LinzRedistrictHandler(RedistrictHandler):
 
         # step 1: get all electorate features corresponding to affected electorates
         electorate_features = {f[self.electorate_layer_field]: f for f in
-                               self.get_affected_districts([self.electorate_layer_field, self.stats_nz_pop_field, 'estimated_pop'])}
+                               self.get_affected_districts([self.electorate_layer_field])}
 
         # and update the electorate boundaries based on these changes.
         # Ideally we'd redissolve the whole boundary from meshblocks, but that's too
@@ -271,20 +291,17 @@ class LinzRedistrictHandler(RedistrictHandler):
         new_geometries = {}
         new_attributes = {}
         for district in self.pending_affected_districts.keys():  # pylint: disable=consider-iterating-dictionary
-            district_geometry = electorate_features[district].geometry()
-            # use stats nz pop as initial estimate, if available
-            estimated_pop = electorate_features[district].attribute(self.stats_nz_pop_field_index)
-            if estimated_pop is None or estimated_pop == NULL:
-                # otherwise just use existing estimated pop as starting point
-                estimated_pop = electorate_features[district].attribute(self.estimated_pop_idx)
-            # add new bits
-            district_geometry = self.grow_district_with_added_meshblocks(district, district_geometry)
-            estimated_pop = self.grow_population_with_added_meshblocks(district, estimated_pop)
-            # minus lost bits
-            district_geometry = self.shrink_district_by_removed_meshblocks(district, district_geometry)
-            estimated_pop = self.shrink_population_by_removed_meshblocks(district, estimated_pop)
-
-            new_geometries[electorate_features[district].id()] = district_geometry
+            # the ledger tracks the population changes as meshblocks are reassigned
+            estimated_pop = self.population_ledger.population(district)
+
+            if not self.background_boundaries:
+                district_geometry = electorate_features[district].geometry()
+                # add new bits
+                district_geometry = self.grow_district_with_added_meshblocks(district, district_geometry)
+                # minus lost bits
+                district_geometry = self.shrink_district_by_removed_meshblocks(district, district_geometry)
+
+                new_geometries[electorate_features[district].id()] = district_geometry
 
             new_attributes[electorate_features[district].id()] = {self.estimated_pop_idx: estimated_pop,
                                                                   self.stats_nz_pop_field_index: NULL,
@@ -292,7 +309,13 @@ class LinzRedistrictHandler(RedistrictHandler):
                                                                   self.stats_nz_var_23_field_index: NULL,
                                                                   self.invalid_field_index: NULL,
                                                                   self.invalid_reason_field_index: NULL}
-        self.electorate_changes_queue.push_changes(new_attributes, new_geometries, self.pending_log_entries)
+        self.pushing_changes = True
+        if self.background_boundaries:
+            self.push_changes_with_pending_boundaries(electorate_features, new_attributes)
+        else:
+            self.electorate_changes_queue.push_changes(new_attributes, new_geometries, self.pending_log_entries)
+        self.pushing_changes = False
+        self.population_ledger.commit()
 
         self.electorate_changes_queue.blocked = True
         super().end_edit_group()
@@ -302,58 +325,117 @@ class LinzRedistrictHandler(RedistrictHandler):
         self.pending_log_entries = []
         self.redistrict_occured.emit()
 
+    def push_changes_with_pending_boundaries(self, electorate_features: dict, new_attributes: dict):
+        """
+        Pushes the pending electorate changes to the electorate changes queue, with
+        the new electorate boundaries calculated in a background task
+        :param electorate_features: dictionary of district to electorate feature
+        :param new_attributes: dictionary of electorate feature id to new attributes
+        """
+        electorate_ids = [electorate_features[district].id() for district in self.pending_affected_districts]
+        queue_item = self.electorate_changes_queue.push_changes(new_attributes, {}, self.pending_log_entries,
+                                                                pending_geometry_ids=electorate_ids)
+
+        task = ElectorateBoundaryTask(
+            QCoreApplication.translate('LinzRedistrict', 'Updating electorate boundaries'),
+            meshblock_layer=self.target_layer,
+            electorate_changes_queue=self.electorate_changes_queue,
+            queue_item=queue_item,
+            original_geometries={electorate_features[district].id(): electorate_features[district].geometry()
+                                 for district in self.pending_affected_districts},
+            added_meshblocks={electorate_features[district].id(): set(changes['ADD'])
+                              for district, changes in self.pending_affected_districts.items()},
+            removed_meshblocks={electorate_features[district].id(): set(changes['REMOVE'])
+                                for district, changes in self.pending_affected_districts.items()})
+        self.electorate_changes_queue.add_boundary_task(task)
+        QgsApplication.taskManager().addTask(task)
+
     def discard_edit_group(self):
         self.electorate_changes_queue.blocked = True
         super().discard_edit_group()
         self.electorate_changes_queue.blocked = False
         self.pending_affected_districts = {}
         self.pending_log_entries = []
+        self.population_ledger.discard()
 
-    def assign_district(self, target_ids, new_district):
+    def assign_district(self, target_ids, new_district, old_districts=None):  # pylint: disable=unused-argument
         """
         Queue up changes
-        :param target_ids:
-        :param new_district:
-        :return:
+        :param target_ids: feature IDs for meshblocks to redistrict
+        :param new_district: new district attribute for meshblocks
+        :param old_districts: ignored, previous districts are always read from the meshblock layer
+        :return: True if redistrict was successful
         """
-        staged_log_entries = []
+        target_ids = set(target_ids)
         # first, record the previous districts, before they get changed by the super method
         request = QgsFeatureRequest().setFilterFids(target_ids)
         request.setFlags(QgsFeatureRequest.NoGeometry)
         request.setSubsetOfAttributes(
             [self.target_layer.fields().lookupField(self.target_field), self.meshblock_number_idx])
+
+        # dict of meshblock feature id to previous district
+        removed = {}
+        # list of (meshblock number, previous district) for log entries
+        log_changes = []
         for f in self.target_layer.getFeatures(request):
             district = f[self.target_field]
             if district == NULL:
                 continue
 
             if district == new_district:
-                target_ids = [t for t in target_ids if t != f.id()]
+                target_ids.discard(f.id())
                 continue
 
-            meshblock_number = f[self.meshblock_number_idx]
+            removed[f.id()] = district
+            log_changes.append((f[self.meshblock_number_idx], district))
 
-            if district not in self.pending_affected_districts:
-                self.pending_affected_districts[district] = {'ADD': [], 'REMOVE': []}
-            self.pending_affected_districts[district]['REMOVE'].append(f.id())
-
-            staged_log_entries.append(self.create_log_entry(meshblock_number=meshblock_number, old_district=district,
-                                                            new_district=new_district))
-
-        if not super().assign_district(target_ids, new_district):
+        if not super().assign_district(target_ids, new_district, old_districts=removed):
             return False
 
-        self.pending_log_entries.extend(staged_log_entries)
+        self.pending_log_entries.extend(self.create_log_entries(log_changes, new_district))
 
         # if assign was successful, then record all districts affected by this operation
         # (that includes the new district and all old districts)
+        for meshblock, district in removed.items():
+            if district not in self.pending_affected_districts:
+                self.pending_affected_districts[district] = {'ADD': set(), 'REMOVE': set()}
+            self.pending_affected_districts[district]['REMOVE'].add(meshblock)
 
         if new_district not in self.pending_affected_districts:
-            self.pending_affected_districts[new_district] = {'ADD': [], 'REMOVE': []}
+            self.pending_affected_districts[new_district] = {'ADD': set(), 'REMOVE': set()}
+        self.pending_affected_districts[new_district]['ADD'].update(target_ids)
+
+        for meshblock in target_ids:
+            self.population_ledger.move_meshblock(meshblock, removed.get(meshblock), new_district)
 
-        self.pending_affected_districts[new_district]['ADD'].extend(target_ids)
         return True
 
+    def create_log_entries(self, changes, new_district) -> List[QgsFeature]:
+        """
+        Returns a list of features corresponding to new log entries
+        :param changes: list of (meshblock number, previous district)
+        :param new_district: new district
+        """
+        fields = self.user_log_layer.fields()
+        timestamp = QDateTime.currentDateTime()
+        username = QgsApplication.userFullName()
+
+        entries = []
+        for meshblock_number, old_district in changes:
+            f = QgsFeature(fields)
+            f.initAttributes(len(fields))
+
+            f[self.user_log_timestamp_idx] = timestamp
+            f[self.user_log_username_idx] = username
+            f[self.user_log_scenario_idx] = self.scenario
+            f[self.user_log_mb_number_idx] = meshblock_number
+            f[self.user_log_type_idx] = self.task
+            f[self.user_log_from_idx] = old_district
+            f[self.user_log_to_idx] = new_district
+            entries.append(f)
+
+        return entries
+
     def create_log_entry(self, meshblock_number, old_district, new_district) -> QgsFeature:
         """
         Returns a feature corresponding to a new log entry
@@ -361,15 +443,4 @@ class LinzRedistrictHandler(RedistrictHandler):
         :param old_district: previous district
         :param new_district: new district
         """
-        f = QgsFeature(self.user_log_layer.fields())
-        f.initAttributes(len(self.user_log_layer.fields()))
-
-        f[self.user_log_timestamp_idx] = QDateTime.currentDateTime()
-        f[self.user_log_username_idx] = QgsApplication.userFullName()
-        f[self.user_log_scenario_idx] = self.scenario
-        f[self.user_log_mb_number_idx] = meshblock_number
-        f[self.user_log_type_idx] = self.task
-        f[self.user_log_from_idx] = old_district
-        f[self.user_log_to_idx] = new_district
-
-        return f
+        return self.create_log_entries([(meshblock_number, old_district)], new_district)[0]
@@ -6,10 +6,12 @@ from typing import Optional
 from qgis.core import (
     QgsTask,
     QgsFeatureRequest,
-    QgsVectorLayer
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource
 )
 from redistrict.core import CoreUtils
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
 
 
 class CanceledException(Exception):
@@ -36,7 +38,7 @@ class LoadMeshblocksTask(QgsTask):
     def __init__(self,  # pylint: disable=too-many-locals, too-many-statements
                  task_name: str, electorate_layer: QgsVectorLayer, meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
-                 task: Optional[str] = None):
+                 task: Optional[str] = None, meshblock_store: Optional[MeshblockStore] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -46,6 +48,8 @@ class LoadMeshblocksTask(QgsTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current redistricting task
+        :param meshblock_store: shared meshblock store. If not set, a store will be
+        built for this task alone.
         """
         super().__init__(task_name)
 
@@ -61,15 +65,6 @@ class LoadMeshblocksTask(QgsTask):
         assert self.estimated_pop_idx >= 0
         self.mb_number_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField('meshblock_number')
         assert self.mb_number_idx >= 0
-        self.mb_off_pop_m_idx = meshblock_layer.fields().lookupField('offline_pop_m')
-        assert self.mb_off_pop_m_idx >= 0
-        self.mb_off_pop_ni_idx = meshblock_layer.fields().lookupField('offline_pop_gn')
-        assert self.mb_off_pop_ni_idx >= 0
-        self.mb_off_pop_si_idx = meshblock_layer.fields().lookupField('offline_pop_gs')
-        assert self.mb_off_pop_si_idx >= 0
-        self.mb_offshore_idx = meshblock_layer.fields().lookupField('offshore')
-        assert self.mb_offshore_idx >= 0
-
         self.invalid_reason_idx = self.electorate_layer.fields().lookupField('invalid_reason')
         assert self.invalid_reason_idx >= 0
         self.invalid_idx = self.electorate_layer.fields().lookupField('invalid')
@@ -86,10 +81,16 @@ class LoadMeshblocksTask(QgsTask):
 
         # do a bit of preparatory processing on the main thread for safety
 
-        # dict of meshblock number to feature
-        meshblocks = {}
-        for m in meshblock_layer.getFeatures():
-            meshblocks[int(m[self.meshblock_number_idx])] = m
+        if meshblock_store is None:
+            meshblock_store = MeshblockStore(meshblock_layer, meshblock_number_field_name)
+        self.meshblock_store = meshblock_store
+        self.meshblock_store.ensure_built()
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
+
+        # all meshblock assignments for the scenario, read in a single pass
+        scenario_meshblocks = scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=scenario, meshblock_store=self.meshblock_store,
+            electorate_types=[self.task] if self.task else None)
 
         # dict of electorates to process (by id)
         self.electorates_to_process = {}
@@ -104,13 +105,9 @@ class LoadMeshblocksTask(QgsTask):
             if self.task and electorate_type != self.task:
                 continue
 
-            electorate_meshblocks = scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                            electorate_type=electorate_type,
-                                                                            scenario_id=scenario)
-            assigned_meshblock_numbers = [m[self.mb_number_idx] for m in electorate_meshblocks]
-            matching_meshblocks = [meshblocks[m] for m in assigned_meshblock_numbers]
-            offshore_meshblocks = [m for m in matching_meshblocks if m[self.mb_offshore_idx]]
-            non_offshore_meshblocks = [m for m in matching_meshblocks if not m[self.mb_offshore_idx]]
+            matching_meshblocks = scenario_meshblocks.get(electorate_type, {}).get(
+                ScenarioRegistry.electorate_key(electorate_id), [])
+            offshore_meshblocks, non_offshore_meshblocks = self.meshblock_store.split_offshore(matching_meshblocks)
 
             self.electorates_to_process[electorate_id] = {self.ELECTORATE_FEATURE_ID: electorate.id(),
                                                           self.ELECTORATE_TYPE: electorate_type,
@@ -141,15 +138,7 @@ class LoadMeshblocksTask(QgsTask):
             offshore_meshblocks = params[self.OFFSHORE_MESHBLOCKS]
             non_offshore_meshblocks = params[self.NON_OFFSHORE_MESHBLOCKS]
 
-            if electorate_type == 'M':
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_m_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_m_idx])
-            elif electorate_type == 'GN':
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_ni_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_ni_idx])
-            else:
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_si_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_si_idx])
+            estimated_pop = self.meshblock_store.population_sum(matching_meshblocks, electorate_type)
 
             electorate_attributes[electorate_feature_id] = {self.ESTIMATED_POP: estimated_pop,
                                                             self.ELECTORATE_ID: electorate_id,
@@ -160,7 +149,10 @@ class LoadMeshblocksTask(QgsTask):
                                                             self.OFFSHORE_MESHBLOCKS: offshore_meshblocks,
                                                             self.NON_OFFSHORE_MESHBLOCKS: non_offshore_meshblocks}
 
-            meshblock_parts = [m.geometry() for m in matching_meshblocks]
+            request = QgsFeatureRequest()
+            request.setFilterFids(self.meshblock_store.feature_ids_for_ordinals(matching_meshblocks))
+            request.setNoAttributes()
+            meshblock_parts = [m.geometry() for m in self.meshblock_source.getFeatures(request)]
             electorate_geometry = CoreUtils.union_geometries(meshblock_parts)
             electorate_geometry = electorate_geometry.makeValid()
             electorate_geometries[electorate_feature_id] = electorate_geometry
@@ -0,0 +1,307 @@
+"""
+LINZ Redistricting Plugin - Meshblock adjacency graph
+"""
+
+from array import array
+from bisect import bisect_left
+from contextlib import closing
+import hashlib
+import sqlite3
+import struct
+import threading
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple
+)
+
+from qgis.PyQt.QtCore import (
+    QObject,
+    pyqtSignal
+)
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsSpatialIndex,
+    QgsVectorLayer
+)
+
+
+class MeshblockAdjacencyGraph(QObject):
+    """
+    A precomputed graph of which meshblocks share a boundary with each other.
+
+    Meshblocks are identified by their ordinal, i.e. their position within the
+    sorted list of meshblock numbers (matching the ordinals used by MeshblockStore).
+    The graph is held in compressed sparse row form: the neighbours of meshblock
+    ordinal i are neighbours[offsets[i]:offsets[i+1]], with the length of the
+    boundary shared with each neighbour in the matching entries of shared_lengths.
+
+    Meshblocks which only touch at a point are not considered adjacent.
+
+    The graph is persisted to a side table within the project database, and is
+    invalidated whenever meshblock geometries are edited.
+    """
+
+    invalidated = pyqtSignal()
+
+    TABLE_NAME = 'meshblock_adjacency'
+    META_TABLE_NAME = 'meshblock_adjacency_meta'
+
+    def __init__(self, database: str, meshblock_layer: Optional[QgsVectorLayer] = None):
+        """
+        Constructor
+        :param database: path to project database
+        :param meshblock_layer: optional meshblock layer. If set, the graph will be
+        invalidated when geometry changes to the layer are committed.
+        """
+        super().__init__()
+        self.database = database
+
+        self._lock = threading.RLock()
+        self._valid = False
+        self.generation = 0
+        self.meshblock_numbers = array('q')
+        self.offsets = array('l', [0])
+        self.neighbours = array('l')
+        self.shared_lengths = array('d')
+
+        if meshblock_layer is not None:
+            meshblock_layer.committedFeaturesAdded.connect(self.invalidate)
+            meshblock_layer.committedFeaturesRemoved.connect(self.invalidate)
+            meshblock_layer.committedGeometriesChanges.connect(self.invalidate)
+
+    @staticmethod
+    def fingerprint(meshblock_numbers: Iterable[int]) -> str:
+        """
+        Calculates a fingerprint for the set of meshblocks in the graph
+        :param meshblock_numbers: meshblock numbers
+        """
+        numbers = sorted(int(n) for n in meshblock_numbers)
+        return hashlib.sha1(struct.pack(f'<{len(numbers)}q', *numbers)).hexdigest()
+
+    @staticmethod
+    def calculate_edges(source, meshblock_number_idx: int,  # pylint: disable=too-many-locals
+                        is_canceled: Optional[Callable[[], bool]] = None,
+                        progress: Optional[Callable[[float], None]] = None) -> Optional[
+                            List[Tuple[int, int, float]]]:
+        """
+        Calculates the edges of the adjacency graph from meshblock geometries
+        :param source: meshblock layer or feature source
+        :param meshblock_number_idx: index of meshblock number field
+        :param is_canceled: optional callable which returns True if the calculation should be canceled
+        :param progress: optional callable for reporting progress, as a percentage
+        :returns list of (meshblock number, neighbour meshblock number, shared boundary length), with
+        each pair listed once only with the lower meshblock number first. None if canceled.
+        """
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([meshblock_number_idx])
+
+        index = QgsSpatialIndex()
+        geometries = {}
+        numbers = {}
+        for f in source.getFeatures(request):
+            if is_canceled is not None and is_canceled():
+                return None
+            if not f.hasGeometry():
+                continue
+            index.addFeature(f)
+            geometries[f.id()] = f.geometry()
+            numbers[f.id()] = int(f[meshblock_number_idx])
+
+        edges = []
+        for i, (fid, geometry) in enumerate(geometries.items()):
+            if is_canceled is not None and is_canceled():
+                return None
+            if progress is not None:
+                progress(100 * i / len(geometries))
+
+            number = numbers[fid]
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            for candidate in index.intersects(geometry.boundingBox()):
+                if numbers[candidate] <= number:
+                    # each pair only needs to be tested once
+                    continue
+                other = geometries[candidate]
+                if not engine.intersects(other.constGet()):
+                    continue
+                shared_length = geometry.intersection(other).length()
+                if shared_length > 0:
+                    edges.append((number, numbers[candidate], shared_length))
+
+        return edges
+
+    def set_edges(self, meshblock_numbers: Iterable[int], edges: Iterable[Tuple[int, int, float]]):
+        """
+        Sets the graph content
+        :param meshblock_numbers: numbers of all meshblocks in the graph
+        :param edges: list of (meshblock number, neighbour meshblock number, shared boundary length). Each
+        pair should be listed once only.
+        """
+        numbers = array('q', sorted(int(n) for n in meshblock_numbers))
+        number_to_ordinal = {number: ordinal for ordinal, number in enumerate(numbers)}
+
+        adjacency = [[] for _ in numbers]
+        for number, neighbour, shared_length in edges:
+            a = number_to_ordinal.get(int(number))
+            b = number_to_ordinal.get(int(neighbour))
+            if a is None or b is None:
+                continue
+            adjacency[a].append((b, shared_length))
+            adjacency[b].append((a, shared_length))
+
+        offsets = array('l', [0])
+        neighbours = array('l')
+        shared_lengths = array('d')
+        for meshblock_neighbours in adjacency:
+            meshblock_neighbours.sort()
+            neighbours.extend(n for n, _ in meshblock_neighbours)
+            shared_lengths.extend(length for _, length in meshblock_neighbours)
+            offsets.append(len(neighbours))
+
+        with self._lock:
+            self.meshblock_numbers = numbers
+            self.offsets = offsets
+            self.neighbours = neighbours
+            self.shared_lengths = shared_lengths
+            self._valid = True
+
+    def is_valid(self) -> bool:
+        """
+        Returns True if the graph is currently built and up to date
+        """
+        return self._valid
+
+    def invalidate(self, *_):
+        """
+        Invalidates the graph, and removes the persisted copy from the database
+        """
+        with self._lock:
+            self.generation += 1
+            self._valid = False
+        self.clear()
+        self.invalidated.emit()
+
+    def count(self) -> int:
+        """
+        Returns the number of meshblocks in the graph
+        """
+        return len(self.meshblock_numbers)
+
+    def edge_count(self) -> int:
+        """
+        Returns the number of edges (pairs of adjacent meshblocks) in the graph
+        """
+        return len(self.neighbours) // 2
+
+    def ordinal_for_meshblock_number(self, meshblock_number) -> Optional[int]:
+        """
+        Returns the ordinal corresponding to a meshblock number, or None if the
+        meshblock is not present in the graph
+        :param meshblock_number: meshblock number
+        """
+        number = int(meshblock_number)
+        ordinal = bisect_left(self.meshblock_numbers, number)
+        if ordinal < len(self.meshblock_numbers) and self.meshblock_numbers[ordinal] == number:
+            return ordinal
+        return None
+
+    def neighbours_for(self, ordinal: int) -> array:
+        """
+        Returns the ordinals of all meshblocks adjacent to a meshblock
+        :param ordinal: meshblock ordinal
+        """
+        return self.neighbours[self.offsets[ordinal]:self.offsets[ordinal + 1]]
+
+    def shared_lengths_for(self, ordinal: int) -> array:
+        """
+        Returns the lengths of the boundaries shared with each neighbour of a meshblock,
+        in the same order as neighbours_for()
+        :param ordinal: meshblock ordinal
+        """
+        return self.shared_lengths[self.offsets[ordinal]:self.offsets[ordinal + 1]]
+
+    def edges(self) -> Iterator[Tuple[int, int, float]]:
+        """
+        Iterates over all edges in the graph, as (meshblock number, neighbour meshblock number,
+        shared boundary length) with the lower meshblock number first
+        """
+        numbers = self.meshblock_numbers
+        for ordinal in range(len(numbers)):
+            for i in range(self.offsets[ordinal], self.offsets[ordinal + 1]):
+                neighbour = self.neighbours[i]
+                if neighbour > ordinal:
+                    yield numbers[ordinal], numbers[neighbour], self.shared_lengths[i]
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database, creating the graph tables if required
+        """
+        connection = sqlite3.connect(self.database, timeout=5)
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} ('
+                           'meshblock_number INTEGER NOT NULL, '
+                           'neighbour_number INTEGER NOT NULL, '
+                           'shared_length REAL NOT NULL)')
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {self.META_TABLE_NAME} ('
+                           'fingerprint TEXT NOT NULL, '
+                           'meshblock_count INTEGER NOT NULL)')
+        connection.commit()
+        return connection
+
+    def load(self, meshblock_numbers: Iterable[int]) -> bool:
+        """
+        Loads the persisted graph from the database
+        :param meshblock_numbers: numbers of all current meshblocks. The persisted
+        graph is only loaded if it was built for exactly this set of meshblocks.
+        :returns True if the graph was successfully loaded
+        """
+        numbers = sorted(int(n) for n in meshblock_numbers)
+        try:
+            with closing(self._connect()) as connection:
+                meta = connection.execute(f'SELECT fingerprint FROM {self.META_TABLE_NAME}').fetchone()
+                if meta is None or meta[0] != self.fingerprint(numbers):
+                    return False
+                edges = connection.execute(
+                    f'SELECT meshblock_number, neighbour_number, shared_length FROM {self.TABLE_NAME}').fetchall()
+        except sqlite3.Error:
+            return False
+
+        self.set_edges(numbers, edges)
+        return True
+
+    def save(self) -> bool:
+        """
+        Persists the graph to the database
+        :returns True if the graph was successfully saved
+        """
+        try:
+            with closing(self._connect()) as connection:
+                connection.execute(f'DELETE FROM {self.TABLE_NAME}')
+                connection.execute(f'DELETE FROM {self.META_TABLE_NAME}')
+                connection.executemany(
+                    f'INSERT INTO {self.TABLE_NAME} (meshblock_number, neighbour_number, shared_length) '
+                    'VALUES (?, ?, ?)', self.edges())
+                connection.execute(f'INSERT INTO {self.META_TABLE_NAME} (fingerprint, meshblock_count) VALUES (?, ?)',
+                                   (self.fingerprint(self.meshblock_numbers), len(self.meshblock_numbers)))
+                connection.commit()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def clear(self) -> bool:
+        """
+        Removes the persisted graph from the database
+        :returns True if the graph was successfully removed
+        """
+        try:
+            with closing(self._connect()) as connection:
+                connection.execute(f'DELETE FROM {self.TABLE_NAME}')
+                connection.execute(f'DELETE FROM {self.META_TABLE_NAME}')
+                connection.commit()
+        except sqlite3.Error:
+            return False
+        return True
@@ -0,0 +1,61 @@
+"""
+LINZ Redistricting Plugin - Meshblock adjacency graph building task
+"""
+
+from qgis.core import (
+    QgsTask,
+    QgsFeatureRequest,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource
+)
+from redistrict.linz.meshblock_adjacency_graph import MeshblockAdjacencyGraph
+
+
+class MeshblockGraphTask(QgsTask):
+    """
+    A background task for loading or building the meshblock adjacency graph
+    """
+
+    def __init__(self, task_name: str, meshblock_layer: QgsVectorLayer,
+                 meshblock_number_field_name: str, meshblock_graph: MeshblockAdjacencyGraph,
+                 rebuild: bool = False):
+        """
+        Constructor for MeshblockGraphTask
+        :param task_name: user-visible, translated name for task
+        :param meshblock_layer: meshblock layer
+        :param meshblock_number_field_name: name of meshblock number field
+        :param meshblock_graph: graph to load or build
+        :param rebuild: if True, the graph will always be rebuilt from the meshblock
+        geometries. Otherwise the persisted graph will be used if it is up to date.
+        """
+        super().__init__(task_name)
+        self.meshblock_graph = meshblock_graph
+        self.rebuild = rebuild
+        self.generation = meshblock_graph.generation
+
+        self.meshblock_number_idx = meshblock_layer.fields().lookupField(meshblock_number_field_name)
+        assert self.meshblock_number_idx >= 0
+
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
+
+    def run(self):  # pylint: disable=missing-docstring
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.meshblock_number_idx])
+        meshblock_numbers = [int(f[self.meshblock_number_idx]) for f in self.meshblock_source.getFeatures(request)]
+
+        if not self.rebuild and self.meshblock_graph.load(meshblock_numbers):
+            return True
+
+        edges = MeshblockAdjacencyGraph.calculate_edges(self.meshblock_source, self.meshblock_number_idx,
+                                                        is_canceled=self.isCanceled,
+                                                        progress=self.setProgress)
+        if edges is None:
+            return False
+
+        if self.meshblock_graph.generation != self.generation:
+            # meshblocks were edited while the graph was being built
+            return False
+
+        self.meshblock_graph.set_edges(meshblock_numbers, edges)
+        return self.meshblock_graph.save()
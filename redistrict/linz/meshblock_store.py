@@ -0,0 +1,268 @@
+"""
+LINZ Redistricting Plugin - Shared meshblock attribute store
+"""
+
+from array import array
+import hashlib
+import threading
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional
+)
+
+from qgis.PyQt.QtCore import (
+    QObject,
+    pyqtSignal
+)
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsVectorLayer,
+    NULL
+)
+
+
+class MeshblockStore(QObject):
+    """
+    A shared, array-backed store of the static meshblock attributes used
+    by scenario tasks (meshblock numbers, feature ids, offline populations
+    and flags).
+
+    Meshblocks are identified by an "ordinal", their position within the
+    store's arrays. The store is built once on demand and reused by all
+    tasks until the meshblock layer's stored attributes or geometries are
+    edited, at which point it is invalidated and rebuilt on next use.
+    Geometries are never held by the store.
+    """
+
+    invalidated = pyqtSignal()
+
+    TYPE_GN = 'GN'
+    TYPE_GS = 'GS'
+    TYPE_M = 'M'
+
+    def __init__(self, meshblock_layer: QgsVectorLayer, meshblock_number_field_name: str):
+        """
+        Constructor
+        :param meshblock_layer: meshblock layer
+        :param meshblock_number_field_name: name of meshblock number field
+        """
+        super().__init__()
+        self.meshblock_layer = meshblock_layer
+        self.meshblock_number_field_name = meshblock_number_field_name
+
+        self.meshblock_number_idx = meshblock_layer.fields().lookupField(meshblock_number_field_name)
+        assert self.meshblock_number_idx >= 0
+        self.off_pop_gn_idx = meshblock_layer.fields().lookupField('offline_pop_gn')
+        assert self.off_pop_gn_idx >= 0
+        self.off_pop_gs_idx = meshblock_layer.fields().lookupField('offline_pop_gs')
+        assert self.off_pop_gs_idx >= 0
+        self.off_pop_m_idx = meshblock_layer.fields().lookupField('offline_pop_m')
+        assert self.off_pop_m_idx >= 0
+        self.offshore_idx = meshblock_layer.fields().lookupField('offshore')
+        assert self.offshore_idx >= 0
+        # not present in all meshblock layers
+        self.ns_island_idx = meshblock_layer.fields().lookupField('ns_island')
+
+        self.stored_field_indices = {self.meshblock_number_idx,
+                                     self.off_pop_gn_idx,
+                                     self.off_pop_gs_idx,
+                                     self.off_pop_m_idx,
+                                     self.offshore_idx}
+        if self.ns_island_idx >= 0:
+            self.stored_field_indices.add(self.ns_island_idx)
+
+        self._lock = threading.RLock()
+        self._valid = False
+        self.meshblock_numbers = array('q')
+        self.meshblock_number_values: List = []
+        self.feature_ids = array('q')
+        self.offline_pop_gn = array('q')
+        self.offline_pop_gs = array('q')
+        self.offline_pop_m = array('q')
+        self.offshore = array('b')
+        self.ns_island = array('b')
+        self._number_to_ordinal: Dict[int, int] = {}
+        self._fid_to_ordinal: Dict[int, int] = {}
+        self._content_hash: Optional[str] = None
+
+        self.meshblock_layer.committedFeaturesAdded.connect(self.invalidate)
+        self.meshblock_layer.committedFeaturesRemoved.connect(self.invalidate)
+        self.meshblock_layer.committedGeometriesChanges.connect(self.invalidate)
+        self.meshblock_layer.committedAttributeValuesChanges.connect(self._attribute_values_committed)
+
+    @staticmethod
+    def _to_int(value) -> int:
+        """
+        Converts an attribute value to an int, treating null values as 0
+        """
+        if value is None or value == NULL or value == '':
+            return 0
+        return int(value)
+
+    def _attribute_values_committed(self, _, changed_attribute_values: dict):
+        """
+        Triggered when attribute changes are committed to the meshblock layer. Only
+        changes to the stored fields invalidate the store, so that saving redistricting
+        edits (which only touch the staged electorate field) keeps it valid.
+        """
+        for changes in changed_attribute_values.values():
+            if not self.stored_field_indices.isdisjoint(changes.keys()):
+                self.invalidate()
+                return
+
+    def invalidate(self, *_):
+        """
+        Invalidates the store, forcing a rebuild on next use
+        """
+        with self._lock:
+            if not self._valid:
+                return
+            self._valid = False
+        self.invalidated.emit()
+
+    def is_valid(self) -> bool:
+        """
+        Returns True if the store is currently built and up to date
+        """
+        return self._valid
+
+    def ensure_built(self, source=None):
+        """
+        Builds the store if it is not already built
+        :param source: optional feature source to read meshblocks from. If not set,
+        the meshblock layer will be read directly.
+        """
+        with self._lock:
+            if not self._valid:
+                self.build(source)
+
+    def build(self, source=None):
+        """
+        (Re)builds the store from the meshblock layer in a single pass
+        :param source: optional feature source to read meshblocks from. If not set,
+        the meshblock layer will be read directly.
+        """
+        if source is None:
+            source = self.meshblock_layer
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(self.stored_field_indices))
+
+        rows = []
+        for f in source.getFeatures(request):
+            ns_island = f[self.ns_island_idx] if self.ns_island_idx >= 0 else 0
+            rows.append((int(f[self.meshblock_number_idx]),
+                         f[self.meshblock_number_idx],
+                         f.id(),
+                         self._to_int(f[self.off_pop_gn_idx]),
+                         self._to_int(f[self.off_pop_gs_idx]),
+                         self._to_int(f[self.off_pop_m_idx]),
+                         1 if f[self.offshore_idx] else 0,
+                         self._to_int(ns_island)))
+        rows.sort(key=lambda r: r[0])
+
+        with self._lock:
+            self.meshblock_numbers = array('q', (r[0] for r in rows))
+            self.meshblock_number_values = [r[1] for r in rows]
+            self.feature_ids = array('q', (r[2] for r in rows))
+            self.offline_pop_gn = array('q', (r[3] for r in rows))
+            self.offline_pop_gs = array('q', (r[4] for r in rows))
+            self.offline_pop_m = array('q', (r[5] for r in rows))
+            self.offshore = array('b', (r[6] for r in rows))
+            self.ns_island = array('b', (r[7] for r in rows))
+            self._number_to_ordinal = {number: ordinal for ordinal, number in enumerate(self.meshblock_numbers)}
+            self._fid_to_ordinal = {fid: ordinal for ordinal, fid in enumerate(self.feature_ids)}
+            self._content_hash = None
+            self._valid = True
+
+    def content_hash(self) -> str:
+        """
+        Returns a hash of the stored meshblock content (meshblock numbers, feature ids,
+        populations and flags). The hash changes whenever a different set of meshblocks
+        is loaded, even if the same meshblock numbers are reused.
+        """
+        with self._lock:
+            if self._content_hash is None:
+                content = hashlib.sha1()
+                for values in (self.meshblock_numbers, self.feature_ids, self.offline_pop_gn, self.offline_pop_gs,
+                               self.offline_pop_m, self.offshore, self.ns_island):
+                    content.update(values.tobytes())
+                self._content_hash = content.hexdigest()
+            return self._content_hash
+
+    def count(self) -> int:
+        """
+        Returns the number of meshblocks in the store
+        """
+        return len(self.meshblock_numbers)
+
+    def ordinal_for_meshblock_number(self, meshblock_number) -> Optional[int]:
+        """
+        Returns the ordinal corresponding to a meshblock number, or None if the
+        meshblock is not present in the store
+        :param meshblock_number: meshblock number
+        """
+        return self._number_to_ordinal.get(int(meshblock_number))
+
+    def ordinal_for_feature_id(self, feature_id: int) -> Optional[int]:
+        """
+        Returns the ordinal corresponding to a meshblock feature ID, or None if the
+        feature is not present in the store
+        :param feature_id: meshblock layer feature ID
+        """
+        return self._fid_to_ordinal.get(feature_id)
+
+    def ordinals_for_meshblock_numbers(self, meshblock_numbers: Iterable) -> array:
+        """
+        Returns an array of the ordinals corresponding to a list of meshblock numbers. Meshblocks
+        which are not present in the store are skipped.
+        :param meshblock_numbers: meshblock numbers to lookup
+        """
+        lookup = self._number_to_ordinal
+        return array('l', (lookup[n] for n in (int(m) for m in meshblock_numbers) if n in lookup))
+
+    def feature_ids_for_ordinals(self, ordinals: Iterable[int]) -> List[int]:
+        """
+        Returns a list of the meshblock layer feature IDs corresponding to a list of ordinals
+        :param ordinals: meshblock ordinals
+        """
+        feature_ids = self.feature_ids
+        return [feature_ids[o] for o in ordinals]
+
+    def populations(self, electorate_type: str) -> array:
+        """
+        Returns the offline population array corresponding to an electorate type
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        if electorate_type == self.TYPE_M:
+            return self.offline_pop_m
+        if electorate_type == self.TYPE_GN:
+            return self.offline_pop_gn
+        return self.offline_pop_gs
+
+    def population_sum(self, ordinals: Iterable[int], electorate_type: str) -> int:
+        """
+        Returns the total offline population for a set of meshblocks
+        :param ordinals: meshblock ordinals
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        populations = self.populations(electorate_type)
+        return sum(populations[o] for o in ordinals)
+
+    def split_offshore(self, ordinals: Iterable[int]) -> (List[int], List[int]):
+        """
+        Splits a list of meshblock ordinals into offshore and non-offshore meshblocks
+        :param ordinals: meshblock ordinals
+        :returns offshore ordinals, non-offshore ordinals
+        """
+        offshore = []
+        non_offshore = []
+        for o in ordinals:
+            if self.offshore[o]:
+                offshore.append(o)
+            else:
+                non_offshore.append(o)
+        return offshore, non_offshore
@@ -0,0 +1,161 @@
+"""
+LINZ Redistricting Plugin - Electorate population ledger
+"""
+
+from typing import (
+    Dict,
+    Optional
+)
+
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsVectorLayer,
+    NULL
+)
+
+
+class PopulationLedger:
+    """
+    An in-memory ledger of electorate populations, used to track the estimated
+    populations of electorates while they are being interactively redistricted.
+
+    The ledger is seeded from the electorate and meshblock layers on first use,
+    after which each reassigned meshblock adjusts the pending populations of
+    the affected electorates without requiring any further feature requests.
+    Pending changes are either committed (when an edit group ends) or discarded.
+    """
+
+    def __init__(self, meshblock_layer: QgsVectorLayer, offline_pop_field_idx: int,
+                 electorate_layer: QgsVectorLayer, electorate_layer_field: str,
+                 estimated_pop_idx: int, stats_nz_pop_idx: int):
+        """
+        Constructor
+        :param meshblock_layer: meshblock layer
+        :param offline_pop_field_idx: index of meshblock offline population field for current task
+        :param electorate_layer: electorate layer
+        :param electorate_layer_field: matching field from electorate layer
+        :param estimated_pop_idx: index of electorate estimated population field
+        :param stats_nz_pop_idx: index of electorate Stats NZ population field
+        """
+        self.meshblock_layer = meshblock_layer
+        self.offline_pop_field_idx = offline_pop_field_idx
+        self.electorate_layer = electorate_layer
+        self.electorate_layer_field = electorate_layer_field
+        self.electorate_layer_field_idx = electorate_layer.fields().lookupField(electorate_layer_field)
+        assert self.electorate_layer_field_idx >= 0
+        self.estimated_pop_idx = estimated_pop_idx
+        self.stats_nz_pop_idx = stats_nz_pop_idx
+
+        # meshblock feature id to offline population
+        self.meshblock_populations: Optional[Dict[int, int]] = None
+        # district to committed population
+        self.populations: Optional[Dict[object, int]] = None
+        # district to electorate feature id
+        self.electorate_feature_ids: Dict[object, int] = {}
+        # district to pending population change
+        self.pending: Dict[object, int] = {}
+
+    @staticmethod
+    def _to_int(value) -> int:
+        """
+        Converts an attribute value to an int, treating null values as 0
+        """
+        if value is None or value == NULL:
+            return 0
+        return int(value)
+
+    def seed_meshblocks(self):
+        """
+        Reads the offline populations for all meshblocks
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.offline_pop_field_idx])
+        self.meshblock_populations = {f.id(): self._to_int(f[self.offline_pop_field_idx])
+                                      for f in self.meshblock_layer.getFeatures(request)}
+
+    def seed_electorates(self):
+        """
+        Reads the current populations for all electorates. Stats NZ populations are used
+        where available, otherwise the estimated population is used.
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.electorate_layer_field_idx, self.estimated_pop_idx, self.stats_nz_pop_idx])
+        self.populations = {}
+        self.electorate_feature_ids = {}
+        for f in self.electorate_layer.getFeatures(request):
+            district = f[self.electorate_layer_field_idx]
+            pop = f[self.stats_nz_pop_idx]
+            if pop is None or pop == NULL:
+                pop = f[self.estimated_pop_idx]
+            self.populations[district] = self._to_int(pop)
+            self.electorate_feature_ids[district] = f.id()
+
+    def invalidate_electorates(self):
+        """
+        Invalidates the committed electorate populations, e.g. after the electorate layer
+        is changed by an undo or redo operation. They will be re-read on next use.
+        """
+        self.populations = None
+
+    def meshblock_population(self, meshblock_feature_id: int) -> int:
+        """
+        Returns the offline population for a meshblock
+        :param meshblock_feature_id: meshblock feature id
+        """
+        if self.meshblock_populations is None:
+            self.seed_meshblocks()
+        return self.meshblock_populations.get(meshblock_feature_id, 0)
+
+    def move_meshblock(self, meshblock_feature_id: int, old_district, new_district):
+        """
+        Records a pending reassignment of a meshblock
+        :param meshblock_feature_id: meshblock feature id
+        :param old_district: previous district, or None/NULL if meshblock was unassigned
+        :param new_district: new district
+        """
+        pop = self.meshblock_population(meshblock_feature_id)
+        if old_district is not None and old_district != NULL:
+            self.pending[old_district] = self.pending.get(old_district, 0) - pop
+        self.pending[new_district] = self.pending.get(new_district, 0) + pop
+
+    def committed_population(self, district) -> int:
+        """
+        Returns the committed population for a district, ignoring any pending changes
+        :param district: district to retrieve population for
+        """
+        if self.populations is None:
+            self.seed_electorates()
+        return self.populations.get(district, 0)
+
+    def population(self, district) -> int:
+        """
+        Returns the population for a district, including any pending changes
+        :param district: district to retrieve population for
+        """
+        return self.committed_population(district) + self.pending.get(district, 0)
+
+    def populations_by_feature_id(self) -> Dict[int, int]:
+        """
+        Returns a dictionary of electorate feature id to population (including pending
+        changes) for all electorates
+        """
+        if self.populations is None:
+            self.seed_electorates()
+        return {self.electorate_feature_ids[district]: self.population(district) for district in self.populations}
+
+    def commit(self):
+        """
+        Commits all pending population changes
+        """
+        if self.populations is not None:
+            for district, change in self.pending.items():
+                self.populations[district] = self.populations.get(district, 0) + change
+        self.pending = {}
+
+    def discard(self):
+        """
+        Discards all pending population changes
+        """
+        self.pending = {}
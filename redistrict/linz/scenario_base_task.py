@@ -2,6 +2,7 @@
 LINZ Redistricting Plugin - Scenario base task
 """
 import gc
+from concurrent.futures import Future
 
 from typing import (
     Optional,
@@ -12,16 +13,22 @@ from qgis.PyQt.QtCore import (
     QRunnable,
     QThreadPool,
     pyqtSlot,
-    pyqtSignal,
-    QEventLoop
+    pyqtSignal
 )
 
 from qgis.core import (QgsTask,
                        QgsFeatureRequest,
                        QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
                        QgsGeometry)
-from redistrict.core import CoreUtils
+from redistrict.core import (
+    CoreUtils,
+    ProcessPoolDissolver
+)
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
+from redistrict.linz.dissolve_scheduler import DissolveScheduler
 
 
 class CanceledException(Exception):
@@ -49,6 +56,8 @@ class MergedGeometryWorker(QRunnable):
         self.geometries = geometries
         self.output: Optional[QgsGeometry] = None
         self.signals = MergedGeometryWorkerSignals()
+        # resolved with the merged geometry when the worker completes
+        self.future = Future()
 
     @pyqtSlot()
     def run(self):
@@ -58,12 +67,22 @@ class MergedGeometryWorker(QRunnable):
         We can do this in a Python thread with great performance benefits,
         because the vast bulk of this task is performed in c++...
         """
-        self.output = CoreUtils.union_geometries(
-            self.geometries
-        )
-        self.output.makeValid()
-        if self.output.isEmpty():
-            self.output = QgsGeometry()
+        if not self.future.set_running_or_notify_cancel():
+            # canceled before the worker was started
+            return
+
+        try:
+            self.output = CoreUtils.union_geometries(
+                self.geometries
+            )
+            self.output.makeValid()
+            if self.output.isEmpty():
+                self.output = QgsGeometry()
+        except Exception as e:  # pylint: disable=broad-except
+            self.future.set_exception(e)
+            return
+
+        self.future.set_result(self.output)
         self.signals.finished.emit(
             self.worker_id, self.output)
 
@@ -86,10 +105,14 @@ class ScenarioBaseTask(QgsTask):
     DEPRECATED = 'DEPRECATED'
     STATS_NZ_POP = 'STATS_NZ_POP'
 
+    DISSOLVE_THREADS = 'threads'
+    DISSOLVE_PROCESSES = 'processes'
+
     def __init__(self,  # pylint: disable=too-many-locals, too-many-statements
                  task_name: str, electorate_layer: QgsVectorLayer, meshblock_layer: QgsVectorLayer,
                  meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
-                 task: Optional[str] = None):
+                 task: Optional[str] = None, meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -99,6 +122,9 @@ class ScenarioBaseTask(QgsTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current redistricting task
+        :param meshblock_store: shared meshblock store. If not set, a store will be
+        built for this task alone.
+        :param geometry_cache: optional electorate geometry cache
         """
         super().__init__(task_name)
 
@@ -107,6 +133,12 @@ class ScenarioBaseTask(QgsTask):
         self.electorate_layer = electorate_layer
         self.electorate_geometries = {}
         self.task = task
+        self.geometry_cache = geometry_cache
+        # if False, cached geometries will be ignored and recalculated (but newly calculated
+        # geometries will still be stored in the cache)
+        self.reuse_cached_geometries = True
+        # backend used for dissolving meshblocks, one of DISSOLVE_THREADS or DISSOLVE_PROCESSES
+        self.dissolve_backend = self.DISSOLVE_THREADS
 
         self.type_idx = electorate_layer.fields().lookupField('type')
         assert self.type_idx >= 0
@@ -116,15 +148,6 @@ class ScenarioBaseTask(QgsTask):
         assert self.estimated_pop_idx >= 0
         self.mb_number_idx = scenario_registry.meshblock_electorate_layer.fields().lookupField('meshblock_number')
         assert self.mb_number_idx >= 0
-        self.mb_off_pop_m_idx = meshblock_layer.fields().lookupField('offline_pop_m')
-        assert self.mb_off_pop_m_idx >= 0
-        self.mb_off_pop_ni_idx = meshblock_layer.fields().lookupField('offline_pop_gn')
-        assert self.mb_off_pop_ni_idx >= 0
-        self.mb_off_pop_si_idx = meshblock_layer.fields().lookupField('offline_pop_gs')
-        assert self.mb_off_pop_si_idx >= 0
-        self.mb_offshore_idx = meshblock_layer.fields().lookupField('offshore')
-        assert self.mb_offshore_idx >= 0
-
         self.stats_nz_pop_idx = electorate_layer.fields().lookupField('stats_nz_pop')
         assert self.stats_nz_pop_idx >= 0
 
@@ -133,8 +156,8 @@ class ScenarioBaseTask(QgsTask):
         self.invalid_idx = self.electorate_layer.fields().lookupField('invalid')
         assert self.invalid_idx >= 0
 
-        electorate_id_idx = electorate_layer.fields().lookupField('electorate_id')
-        assert electorate_id_idx >= 0
+        self.electorate_id_idx = electorate_layer.fields().lookupField('electorate_id')
+        assert self.electorate_id_idx >= 0
         self.code_idx = electorate_layer.fields().lookupField('code')
         assert self.code_idx >= 0
         self.name_idx = electorate_layer.fields().lookupField('name')
@@ -146,20 +169,48 @@ class ScenarioBaseTask(QgsTask):
         self.deprecated_idx = electorate_layer.fields().lookupField('deprecated')
         assert self.deprecated_idx >= 0
 
-        # do a bit of preparatory processing on the main thread for safety
+        if meshblock_store is None:
+            meshblock_store = MeshblockStore(meshblock_layer, meshblock_number_field_name)
+        self.meshblock_store = meshblock_store
+        self.scenario_registry = scenario_registry
+        # resolved on the main thread, as the scenario layer isn't safe to read in the background
+        self.lineage = scenario_registry.scenario_lineage(scenario)
+
+        # take thread safe snapshots of the layers, so that all reading can be done in the background
+        self.electorate_source = QgsVectorLayerFeatureSource(electorate_layer)
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(scenario_registry.meshblock_electorate_layer)
+
+        # dict of electorates to process (by id), populated by prepare()
+        self.electorates_to_process = {}
+        self.prepared = False
+
+        self.setDependentLayers([electorate_layer])
+        gc.enable()
+
+    def prepare(self):
+        """
+        Reads the electorates and meshblock assignments for the scenario. This
+        is called automatically at the start of calculate_new_electorates(), and
+        is safe to call from the background thread.
+        """
+        self.meshblock_store.ensure_built(self.meshblock_source)
 
-        # dict of meshblock number to feature
-        meshblocks = {}
-        for m in meshblock_layer.getFeatures():
-            meshblocks[int(m[self.meshblock_number_idx])] = m
+        # all meshblock assignments for the scenario, read in a single pass
+        scenario_meshblocks = self.scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=self.scenario, meshblock_store=self.meshblock_store,
+            electorate_types=[self.task] if self.task else None,
+            source=self.meshblock_electorate_source, lineage=self.lineage)
 
-        # dict of electorates to process (by id)
         self.electorates_to_process = {}
         request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([electorate_id_idx, self.type_idx, self.code_idx, self.name_idx, self.expected_regions_idx, self.deprecated_idx, self.stats_nz_pop_idx])
-        for electorate in electorate_layer.getFeatures(request):
+        request.setSubsetOfAttributes([self.electorate_id_idx, self.type_idx, self.code_idx, self.name_idx, self.expected_regions_idx, self.deprecated_idx, self.stats_nz_pop_idx])
+        for electorate in self.electorate_source.getFeatures(request):
+            if self.isCanceled():
+                raise CanceledException
+
             # get meshblocks for this electorate in the target scenario
-            electorate_id = electorate[electorate_id_idx]
+            electorate_id = electorate[self.electorate_id_idx]
             electorate_type = electorate[self.type_idx]
             electorate_code = electorate[self.code_idx]
             electorate_name = electorate[self.name_idx]
@@ -169,13 +220,9 @@ class ScenarioBaseTask(QgsTask):
             if self.task and electorate_type != self.task:
                 continue
 
-            electorate_meshblocks = scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                            electorate_type=electorate_type,
-                                                                            scenario_id=scenario)
-            assigned_meshblock_numbers = [m[self.mb_number_idx] for m in electorate_meshblocks]
-            matching_meshblocks = [meshblocks[m] for m in assigned_meshblock_numbers]
-            offshore_meshblocks = [m for m in matching_meshblocks if m[self.mb_offshore_idx]]
-            non_offshore_meshblocks = [m for m in matching_meshblocks if not m[self.mb_offshore_idx]]
+            matching_meshblocks = scenario_meshblocks.get(electorate_type, {}).get(
+                ScenarioRegistry.electorate_key(electorate_id), [])
+            offshore_meshblocks, non_offshore_meshblocks = self.meshblock_store.split_offshore(matching_meshblocks)
 
             self.electorates_to_process[electorate_id] = {self.ELECTORATE_FEATURE_ID: electorate.id(),
                                                           self.ELECTORATE_TYPE: electorate_type,
@@ -187,9 +234,20 @@ class ScenarioBaseTask(QgsTask):
                                                           self.OFFSHORE_MESHBLOCKS: offshore_meshblocks,
                                                           self.NON_OFFSHORE_MESHBLOCKS: non_offshore_meshblocks,
                                                           self.STATS_NZ_POP: stats_nz_pop}
+        self.prepared = True
 
-        self.setDependentLayers([electorate_layer])
-        gc.enable()
+    def meshblock_geometries(self, meshblocks) -> List[QgsGeometry]:
+        """
+        Fetches the geometries for a list of meshblocks
+        :param meshblocks: meshblock ordinals
+        """
+        if not meshblocks:
+            return []
+
+        request = QgsFeatureRequest()
+        request.setFilterFids(self.meshblock_store.feature_ids_for_ordinals(meshblocks))
+        request.setNoAttributes()
+        return [m.geometry() for m in self.meshblock_source.getFeatures(request)]
 
     def store_electorate_geometry(self,
                                   electorate_id: int,
@@ -199,40 +257,80 @@ class ScenarioBaseTask(QgsTask):
         """
         self.electorate_geometries[electorate_id] = QgsGeometry(geometry)
 
-    def calculate_new_electorates(self):  # pylint: disable=too-many-locals
+    def dissolve(self, jobs: list, completed: int, total: int):
         """
-        Calculates the new electorate geometry and populations for the associated scenario
+        Dissolves meshblocks into electorate geometries, storing the results
+        :param jobs: list of (electorate feature id, meshblocks) to dissolve
+        :param completed: number of electorates already completed
+        :param total: total number of electorates
         """
-        gc.disable()
-        self.electorate_geometries = {}
-        electorate_attributes = {}
-        i = 0
-
-        merging_thread_pool = QThreadPool()
+        if self.dissolve_backend == self.DISSOLVE_PROCESSES:
+            thread_pool = None
+            submit = ProcessPoolDissolver.instance().submit
+        else:
+            thread_pool = QThreadPool()
+            workers = []
+
+            def submit(geometries: List[QgsGeometry]) -> Future:
+                """
+                Submits geometries to a MergedGeometryWorker
+                """
+                worker = MergedGeometryWorker(len(workers), geometries)
+                workers.append(worker)
+                thread_pool.start(worker)
+                return worker.future
+
+        scheduler = DissolveScheduler(submit)
+
+        def cancel():
+            """
+            Cancels all outstanding work
+            """
+            if thread_pool is not None:
+                # removes all queued workers which haven't yet started
+                thread_pool.clear()
+            scheduler.cancel()
+
+        # start the largest electorates first, so that they don't hold up completion
+        for electorate_feature_id, meshblocks in sorted(jobs, key=lambda job: len(job[1]), reverse=True):
+            if self.isCanceled():
+                cancel()
+                raise CanceledException
+            scheduler.add_job(electorate_feature_id, self.meshblock_geometries(meshblocks))
+
+        def job_finished(electorate_feature_id: int, geometry: QgsGeometry):
+            """
+            Stores a completed electorate geometry and updates progress
+            """
+            nonlocal completed
+            self.store_electorate_geometry(electorate_feature_id, geometry)
+            completed += 1
+            if total:
+                self.setProgress(100 * completed / total)
+
+        if scheduler.run(is_canceled=self.isCanceled, job_finished=job_finished) is None:
+            cancel()
+            raise CanceledException
+
+    def calculate_electorate_attributes(self) -> dict:
+        """
+        Calculates the new electorate populations and attributes for the associated scenario,
+        without calculating geometries
+        :returns dictionary of electorate feature id to attributes
+        """
+        if not self.prepared:
+            self.prepare()
 
-        workers = []
-        remaining_worker_ids = set()
+        electorate_attributes = {}
         for electorate_id, params in self.electorates_to_process.items():
             if self.isCanceled():
                 raise CanceledException
 
-            self.setProgress(100 * i / len(self.electorates_to_process))
-
             electorate_feature_id = params[self.ELECTORATE_FEATURE_ID]
             electorate_type = params[self.ELECTORATE_TYPE]
             matching_meshblocks = params[self.MESHBLOCKS]
-            offshore_meshblocks = params[self.OFFSHORE_MESHBLOCKS]
-            non_offshore_meshblocks = params[self.NON_OFFSHORE_MESHBLOCKS]
-
-            if electorate_type == 'M':
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_m_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_m_idx])
-            elif electorate_type == 'GN':
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_ni_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_ni_idx])
-            else:
-                estimated_pop = sum(
-                    mbf[self.mb_off_pop_si_idx] for mbf in matching_meshblocks if mbf[self.mb_off_pop_si_idx])
+
+            estimated_pop = self.meshblock_store.population_sum(matching_meshblocks, electorate_type)
 
             electorate_attributes[electorate_feature_id] = {self.ESTIMATED_POP: estimated_pop,
                                                             self.ELECTORATE_ID: electorate_id,
@@ -242,31 +340,74 @@ class ScenarioBaseTask(QgsTask):
                                                             self.EXPECTED_REGIONS: params[self.EXPECTED_REGIONS],
                                                             self.DEPRECATED: params[self.DEPRECATED],
                                                             self.MESHBLOCKS: matching_meshblocks,
-                                                            self.OFFSHORE_MESHBLOCKS: offshore_meshblocks,
-                                                            self.NON_OFFSHORE_MESHBLOCKS: non_offshore_meshblocks,
+                                                            self.OFFSHORE_MESHBLOCKS: params[self.OFFSHORE_MESHBLOCKS],
+                                                            self.NON_OFFSHORE_MESHBLOCKS: params[
+                                                                self.NON_OFFSHORE_MESHBLOCKS],
                                                             self.STATS_NZ_POP: params[self.STATS_NZ_POP]}
+        return electorate_attributes
 
-            meshblock_parts = [m.geometry() for m in matching_meshblocks]
+    def calculate_electorate_geometries(self, electorate_attributes: dict) -> dict:  # pylint: disable=too-many-locals
+        """
+        Calculates the new electorate geometries for a set of electorates
+        :param electorate_attributes: dictionary of electorate feature id to attributes, as
+        returned by calculate_electorate_attributes(). Geometries will be calculated for
+        all electorates in this dictionary.
+        :returns dictionary of electorate feature id to geometry
+        """
+        gc.disable()
+        self.electorate_geometries = {}
+
+        cached_entries = self.geometry_cache.entries_for_scenario(
+            self.scenario) if self.geometry_cache and self.reuse_cached_geometries else {}
+        meshblock_version = self.meshblock_store.content_hash() if self.geometry_cache else ''
+        reused_cache_keys = []
+        # dict of electorate feature id to details required to cache calculated geometry
+        to_cache = {}
+
+        # list of (electorate feature id, meshblocks) to dissolve
+        jobs = []
+        for electorate_feature_id, attributes in electorate_attributes.items():
+            if self.isCanceled():
+                gc.enable()
+                raise CanceledException
 
-            remaining_worker_ids.add(electorate_feature_id)
-            merging_worker = MergedGeometryWorker(electorate_feature_id, meshblock_parts)
-            workers.append(merging_worker)
-            merging_worker.signals.finished.connect(self.store_electorate_geometry)
-            merging_thread_pool.start(merging_worker)
+            electorate_type = attributes[self.ELECTORATE_TYPE]
+            matching_meshblocks = attributes[self.MESHBLOCKS]
 
-            i += 1
+            if self.geometry_cache is not None:
+                cache_key = (electorate_type, str(attributes[self.ELECTORATE_ID]))
+                fingerprint = ElectorateGeometryCache.fingerprint(
+                    (self.meshblock_store.meshblock_numbers[o] for o in matching_meshblocks),
+                    meshblock_version=meshblock_version)
+                cached = cached_entries.get(cache_key)
+                if cached is not None and cached[0] == fingerprint:
+                    self.electorate_geometries[electorate_feature_id] = cached[2]
+                    reused_cache_keys.append(cache_key)
+                    continue
 
-        merging_thread_pool.waitForDone()
-        loop = QEventLoop()
+                to_cache[electorate_feature_id] = (cache_key, fingerprint, attributes[self.ESTIMATED_POP])
 
-        while True:
-            if not remaining_worker_ids:
-                break
+            jobs.append((electorate_feature_id, matching_meshblocks))
 
-            loop.processEvents()
-            remaining_worker_ids = set(r for r in remaining_worker_ids
-                                       if r not in self.electorate_geometries)
-        loop.quit()
+        try:
+            self.dissolve(jobs, completed=len(reused_cache_keys), total=len(electorate_attributes))
+        finally:
+            gc.enable()
 
-        gc.enable()
-        return self.electorate_geometries, electorate_attributes
+        if self.geometry_cache is not None:
+            self.geometry_cache.touch(self.scenario, reused_cache_keys)
+            self.geometry_cache.store(self.scenario,
+                                      [(cache_key[0], cache_key[1], fingerprint, estimated_pop,
+                                        self.electorate_geometries[electorate_feature_id])
+                                       for electorate_feature_id, (cache_key, fingerprint, estimated_pop)
+                                       in to_cache.items()])
+
+        return self.electorate_geometries
+
+    def calculate_new_electorates(self):
+        """
+        Calculates the new electorate geometry and populations for the associated scenario
+        """
+        electorate_attributes = self.calculate_electorate_attributes()
+        electorate_geometries = self.calculate_electorate_geometries(electorate_attributes)
+        return electorate_geometries, electorate_attributes
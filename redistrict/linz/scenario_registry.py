@@ -2,44 +2,76 @@
 LINZ Redistricting Plugin - Scenario registry
 """
 
+from array import array
 from collections import OrderedDict
+from contextlib import closing
+import os
+import sqlite3
 from typing import (
+    Dict,
+    Iterable,
+    Iterator,
     List,
-    Optional
+    Optional,
+    Tuple
 )
 
 from qgis.PyQt.QtCore import (
     QCoreApplication,
-    QDateTime
+    QDateTime,
+    QVariant
 )
 from qgis.core import (
     QgsFeatureRequest,
     QgsExpression,
+    QgsField,
     QgsVectorLayer,
     QgsFeature,
     QgsApplication,
-    QgsFeatureIterator,
+    QgsProviderRegistry,
     NULL
 )
+from redistrict.linz.scenario_snapshot import ScenarioSnapshot
 
 
 class ScenarioRegistry():
     """
-    A registry for handling available scenarios
+    A registry for handling available scenarios.
+
+    If lineages are enabled and the scenario layer has a parent scenario field, branched
+    scenarios are stored as a lineage: a branch only stores the meshblock records which
+    differ from its parent scenario, and all other meshblock records are inherited from
+    the parent (and its parents, in turn). Reads of scenario meshblocks resolve against
+    the full lineage.
+
+    Any existing lineages are always resolved (and protected when parent scenarios are
+    changed), even if lineages are disabled. Use materialize_all_scenarios() to convert
+    all lineages back to full copies.
+
+    Note that the meshblock electorate records for a branch are incomplete, so anything
+    reading the meshblock electorate table outside of the registry must resolve the
+    parent_scenario_id lineage itself.
     """
 
     MESHBLOCK_SCENARIO_ID_FIELD_NAME = 'scenario_id'
+    PARENT_SCENARIO_ID_FIELD_NAME = 'parent_scenario_id'
+
+    # scenarios with lineages deeper than this are materialized when branched
+    MAX_LINEAGE_DEPTH = 8
 
     def __init__(self, source_layer: QgsVectorLayer,
                  id_field: str,
                  name_field: str,
-                 meshblock_electorate_layer: Optional[QgsVectorLayer]):
+                 meshblock_electorate_layer: Optional[QgsVectorLayer],
+                 use_lineage: bool = True):
         """
         Constructor for ScenarioRegistry
         :param source_layer: source layer for registry
         :param id_field: name of scenario id field
         :param name_field: name of scenario name field
         :param meshblock_electorate_layer: layer containing meshblock to electorate mapping for each scenario
+        :param use_lineage: True if new branches should be stored as changes from their parent scenario,
+        when the scenario layer supports this (see add_lineage_field())
         """
         self.source_layer = source_layer
         self.id_field = id_field
@@ -52,22 +84,85 @@ class ScenarioRegistry():
         self.created_field_index = source_layer.fields().lookupField(self.created_field)
         self.created_by_field = 'created_by'
         self.created_by_field_index = source_layer.fields().lookupField(self.created_by_field)
+        self.parent_field = self.PARENT_SCENARIO_ID_FIELD_NAME
+        self.parent_field_index = source_layer.fields().lookupField(self.parent_field)
+        self.use_lineage = use_lineage
         self.meshblock_electorate_layer = meshblock_electorate_layer
 
-    def get_scenario_name(self, scenario) -> str:
+        # cached scenario metadata, as scenario id to (name, created, created by), in layer order
+        self._metadata: Optional[Dict[int, Tuple[str, QDateTime, str]]] = None
+        # cached sorted scenario titles to scenario id
+        self._titles: Optional[Dict[str, int]] = None
+        # cached scenario id to parent scenario id
+        self._parents: Optional[Dict[int, Optional[int]]] = None
+
+        source_layer.featureAdded.connect(self.invalidate)
+        source_layer.featureDeleted.connect(self.invalidate)
+        source_layer.attributeValueChanged.connect(self.invalidate)
+        source_layer.dataChanged.connect(self.invalidate)
+
+    def invalidate(self, *_):
         """
-        Returns a user-friendly name corresponding to the given scenario
-        :param scenario: scenario id to get name for
+        Invalidates the cached scenario metadata, forcing it to be reloaded
+        from the source layer on next use
         """
+        self._metadata = None
+        self._titles = None
+        self._parents = None
 
-        # lookup matching feature
+    def _scenario_metadata(self) -> Dict[int, Tuple[str, QDateTime, str]]:
+        """
+        Returns the metadata for all scenarios, as a dictionary of scenario id
+        to (name, created, created by). The metadata is read from the source layer
+        in a single request, and cached until the registry is invalidated.
+        """
+        if self._metadata is not None:
+            return self._metadata
+
+        attributes = [self.id_field_index, self.name_field_index] + [
+            idx for idx in (self.created_field_index, self.created_by_field_index, self.parent_field_index) if
+            idx >= 0]
         request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.id_field, scenario))
         request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([self.name_field_index])
-        request.setLimit(1)
-        f = next(self.source_layer.getFeatures(request))
-        return f[self.name_field_index]
+        request.setSubsetOfAttributes(attributes)
+
+        metadata = OrderedDict()
+        parents = {}
+        for f in self.source_layer.getFeatures(request):
+            scenario_id = f[self.id_field_index]
+            if scenario_id == NULL or scenario_id in metadata:
+                continue
+            metadata[scenario_id] = (f[self.name_field_index],
+                                     f[self.created_field_index] if self.created_field_index >= 0 else NULL,
+                                     f[self.created_by_field_index] if self.created_by_field_index >= 0 else NULL)
+            parent = f[self.parent_field_index] if self.parent_field_index >= 0 else NULL
+            parents[scenario_id] = None if parent == NULL else self.electorate_key(parent)
+
+        titles = {name: scenario_id for scenario_id, (name, _, _) in metadata.items()}
+        self._titles = OrderedDict((name, titles[name]) for name in sorted(titles.keys()))
+        self._parents = parents
+        self._metadata = metadata
+        return metadata
+
+    def _metadata_for_scenario(self, scenario) -> Optional[Tuple[str, QDateTime, str]]:
+        """
+        Returns the cached metadata for a scenario, or None if the scenario does not exist
+        :param scenario: scenario id
+        """
+        metadata = self._scenario_metadata()
+        if scenario in metadata:
+            return metadata[scenario]
+        return metadata.get(self.electorate_key(scenario))
+
+    def get_scenario_name(self, scenario) -> str:
+        """
+        Returns a user-friendly name corresponding to the given scenario
+        :param scenario: scenario id to get name for
+        """
+        metadata = self._metadata_for_scenario(scenario)
+        if metadata is None:
+            raise KeyError(scenario)
+        return metadata[0]
 
     def get_scenario(self, scenario) -> QgsFeature:
         """
@@ -83,68 +178,165 @@ class ScenarioRegistry():
         f = next(self.source_layer.getFeatures(request))
         return f
 
-    def scenario_list(self):
+    def has_lineage_field(self) -> bool:
         """
-        Returns a complete list of available scenarios
+        Returns True if the scenario layer has a parent scenario field, and accordingly
+        scenarios may be stored as a lineage of changes from their parent scenarios
+        """
+        return self.parent_field_index >= 0
+
+    def supports_lineage(self) -> bool:
+        """
+        Returns True if the registry stores new branched scenarios as a lineage of
+        changes from their parent scenarios. This requires both that lineages are
+        enabled and that the scenario layer has a parent scenario field.
+        """
+        return self.use_lineage and self.has_lineage_field()
+
+    def has_lineages(self) -> bool:
+        """
+        Returns True if any scenario is currently stored as a lineage of changes
+        from a parent scenario
+        """
+        if not self.has_lineage_field():
+            return False
+
+        self._scenario_metadata()
+        return any(parent is not None for parent in self._parents.values())
+
+    def add_lineage_field(self) -> bool:
+        """
+        Adds the parent scenario field to the scenario layer, if not already present,
+        so that new branches can be stored as changes from their parent scenario.
+
+        This permanently changes the schema of the scenario table, so should only
+        be called after confirmation from the user.
+        :returns True if the scenario layer has a parent scenario field
+        """
+        if self.has_lineage_field():
+            return True
+
+        if not self.source_layer.dataProvider().addAttributes([QgsField(self.parent_field, QVariant.Int)]):
+            return False
+        self.source_layer.updateFields()
+
+        self.parent_field_index = self.source_layer.fields().lookupField(self.parent_field)
+        self.invalidate()
+        return self.has_lineage_field()
+
+    def parent_scenario(self, scenario_id) -> Optional[int]:
+        """
+        Returns the ID of the parent scenario for a scenario, or None if the scenario
+        does not inherit meshblocks from a parent
+        :param scenario_id: ID for scenario
+        """
+        if not self.has_lineage_field():
+            return None
+
+        self._scenario_metadata()
+        if scenario_id in self._parents:
+            return self._parents[scenario_id]
+        return self._parents.get(self.electorate_key(scenario_id))
+
+    def scenario_lineage(self, scenario_id) -> List[int]:
+        """
+        Returns the lineage for a scenario, as a list of the scenario ID followed by
+        the IDs of its parent, grandparent, etc scenarios. Meshblock records for the
+        scenario are taken from the first scenario in the lineage which contains them.
+        :param scenario_id: ID for scenario
         """
+        lineage = [self.electorate_key(scenario_id)]
+        parent = self.parent_scenario(scenario_id)
+        while parent is not None and parent not in lineage:
+            lineage.append(parent)
+            parent = self.parent_scenario(parent)
+        return lineage
+
+    def scenario_features(self, scenario_id, attributes: Optional[List[int]] = None,
+                          meshblock_numbers: Optional[Iterable[int]] = None,
+                          source=None, lineage: Optional[List[int]] = None) -> Dict[int, QgsFeature]:
+        """
+        Returns the meshblock electorate records for a scenario, resolving any records
+        inherited from parent scenarios. Inherited records retain the scenario ID of the
+        scenario which stores them.
+        :param scenario_id: ID for scenario
+        :param attributes: optional list of meshblock electorate field indices to fetch. If
+        not set, all attributes will be fetched.
+        :param meshblock_numbers: optional list of meshblock numbers to restrict the records to
+        :param source: optional feature source to read from, e.g. a thread safe snapshot
+        of the meshblock electorate layer. If not set, the layer will be read directly.
+        :param lineage: optional precalculated scenario lineage (see scenario_lineage())
+        :return: dictionary of meshblock number to meshblock electorate record
+        """
+        fields = self.meshblock_electorate_layer.fields()
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        assert meshblock_number_idx >= 0
+        scenario_id_idx = fields.lookupField(self.MESHBLOCK_SCENARIO_ID_FIELD_NAME)
+        assert scenario_id_idx >= 0
+
+        if lineage is None:
+            lineage = self.scenario_lineage(scenario_id)
+        if meshblock_numbers is not None:
+            meshblock_numbers = list(meshblock_numbers)
+            if not meshblock_numbers:
+                return {}
+
         request = QgsFeatureRequest()
         request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([self.id_field_index])
+        if attributes is not None:
+            request.setSubsetOfAttributes(list(set(attributes) | {meshblock_number_idx, scenario_id_idx}))
+        if len(lineage) == 1:
+            request.setFilterExpression(QgsExpression.createFieldEqualityExpression(
+                self.MESHBLOCK_SCENARIO_ID_FIELD_NAME, lineage[0]))
+        else:
+            lineage_str = ','.join(QgsExpression.quotedValue(s) for s in lineage)
+            request.setFilterExpression(
+                f'{QgsExpression.quotedColumnRef(self.MESHBLOCK_SCENARIO_ID_FIELD_NAME)} IN ({lineage_str})')
+        if meshblock_numbers is not None:
+            numbers_str = ','.join(QgsExpression.quotedValue(n) for n in meshblock_numbers)
+            request.combineFilterExpression(f'{QgsExpression.quotedColumnRef("meshblock_number")} IN ({numbers_str})')
+
+        if source is None:
+            source = self.meshblock_electorate_layer
+
+        depth = {s: i for i, s in enumerate(lineage)}
+        records = {}
+        record_depths = {}
+        for f in source.getFeatures(request):
+            meshblock_number = int(f[meshblock_number_idx])
+            record_depth = depth.get(self.electorate_key(f[scenario_id_idx]), len(lineage))
+            if meshblock_number not in records or record_depth < record_depths[meshblock_number]:
+                records[meshblock_number] = f
+                record_depths[meshblock_number] = record_depth
+        return records
 
-        districts = [f[self.id_field_index]
-                     for f in self.source_layer.getFeatures(request)
-                     if f[self.id_field_index] != NULL]
-        # we want an ordered list of unique values!
-        d = OrderedDict()
-        for x in districts:
-            d[x] = True
-        return list(d.keys())
+    def scenario_list(self):
+        """
+        Returns a complete list of available scenarios
+        """
+        return list(self._scenario_metadata().keys())
 
     def scenario_titles(self):
         """
         Returns a dictionary of sorted scenario titles to corresponding scenario id
         """
-        request = QgsFeatureRequest()
-        request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([self.id_field_index, self.name_field_index])
-
-        districts = {f[self.name_field_index]: f[self.id_field_index]
-                     for f in self.source_layer.getFeatures(request)
-                     if f[self.id_field_index] != NULL}
-        result = OrderedDict()
-        for d in sorted(districts.keys()):
-            result[d] = districts[d]
-        return result
+        self._scenario_metadata()
+        return OrderedDict(self._titles)
 
     def scenario_name_exists(self, new_scenario_name: str) -> bool:
         """
         Returns true if the given scenario name already exists
         :param new_scenario_name: name of scenario to test
         """
-        request = QgsFeatureRequest()
-        request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([])
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.name_field, new_scenario_name))
-        request.setLimit(1)
-        for f in self.source_layer.getFeatures(request):  # pylint: disable=unused-variable
-            # found a matching feature
-            return True
-        return False
+        self._scenario_metadata()
+        return new_scenario_name in self._titles
 
     def scenario_exists(self, scenario_id) -> bool:
         """
         Returns true if the given scenario exists
         :param scenario_id: ID for scenario
         """
-        request = QgsFeatureRequest()
-        request.setFlags(QgsFeatureRequest.NoGeometry)
-        request.setSubsetOfAttributes([])
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(self.id_field, scenario_id))
-        request.setLimit(1)
-        for f in self.source_layer.getFeatures(request):  # pylint: disable=unused-variable
-            # found a matching feature
-            return True
-        return False
+        return self._metadata_for_scenario(scenario_id) is not None
 
     def next_scenario_id(self) -> int:
         """
@@ -152,12 +344,15 @@ class ScenarioRegistry():
         """
         return max(self.source_layer.maximumValue(self.id_field_index), 0) + 1
 
-    def __insert_new_scenario(self, new_scenario_name: str, created_datetime: QDateTime = None, created_by: str = None):
+    def __insert_new_scenario(self, new_scenario_name: str, created_datetime: QDateTime = None, created_by: str = None,
+                              parent_scenario_id=None):
         """
         Inserts a scenario into the registry
         :param new_scenario_name: name for new scenario
         :param created_datetime: optional datetime for scenario, if not set will be set to current date time
         :param created_by: creator user name, if not set will be set to current user name
+        :param parent_scenario_id: optional parent scenario, for scenarios which inherit meshblocks
+        from their parent
         :return: scenario id if successful, and error message
         """
         next_id = self.next_scenario_id()
@@ -170,47 +365,130 @@ class ScenarioRegistry():
             self.created_field_index] = QDateTime.currentDateTime() if created_datetime is None else created_datetime
         scenario_feature[
             self.created_by_field_index] = QgsApplication.userFullName() if created_by is None else created_by
+        if self.parent_field_index >= 0:
+            scenario_feature[self.parent_field_index] = NULL if parent_scenario_id is None else parent_scenario_id
 
-        if not self.source_layer.dataProvider().addFeatures([scenario_feature]):
+        success = self.source_layer.dataProvider().addFeatures([scenario_feature])
+        # features added directly to the provider aren't signaled by the layer
+        self.invalidate()
+        if not success:
             return False, QCoreApplication.translate('LinzRedistrict', 'Could not create scenario')
 
         return next_id, None
 
     @staticmethod
-    def __copy_records_from_scenario(source_meshblock_electorate_layer: QgsVectorLayer,
-                                     source_scenario_id,
-                                     dest_meshblock_electorate_layer: QgsVectorLayer,
-                                     new_scenario_id):
-        """
-        Copies the records associated with a scenario from one table to
-        another
-        :param source_meshblock_electorate_layer: layer containing source meshblock->electorate mappings
-        :param source_scenario_id: source scenario id
+    def __copy_records(records: Iterable[QgsFeature],
+                       dest_meshblock_electorate_layer: QgsVectorLayer,
+                       new_scenario_id) -> bool:
+        """
+        Copies meshblock electorate records to a scenario
+        :param records: meshblock electorate records to copy
         :param dest_meshblock_electorate_layer: destination layer for copied meshblock->electorate mappings
         :param new_scenario_id: new scenario id for copied records
         """
-        request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression(
-            ScenarioRegistry.MESHBLOCK_SCENARIO_ID_FIELD_NAME, source_scenario_id))
-        current_meshblocks = source_meshblock_electorate_layer.getFeatures(request)
-        scenario_id_idx = source_meshblock_electorate_layer.fields().lookupField(
+        scenario_id_idx = dest_meshblock_electorate_layer.fields().lookupField(
             ScenarioRegistry.MESHBLOCK_SCENARIO_ID_FIELD_NAME
         )
-        fid_idx = source_meshblock_electorate_layer.fields().lookupField('fid')
+        fid_idx = dest_meshblock_electorate_layer.fields().lookupField('fid')
         new_features = []
-        for f in current_meshblocks:
+        for f in records:
             f[scenario_id_idx] = new_scenario_id
             if fid_idx >= 0:
                 f[fid_idx] = NULL
             new_features.append(f)
 
+        if not new_features:
+            return True
+
         dest_meshblock_electorate_layer.startEditing()
         dest_meshblock_electorate_layer.addFeatures(new_features)
-        dest_meshblock_electorate_layer.commitChanges()
+        return dest_meshblock_electorate_layer.commitChanges()
+
+    @staticmethod
+    def geopackage_table(layer: QgsVectorLayer) -> Optional[Tuple[str, str]]:
+        """
+        Returns the GeoPackage path and table name for a layer, or None if the
+        layer is not an (unfiltered) table from a GeoPackage
+        :param layer: layer to check
+        """
+        if layer.providerType() != 'ogr' or layer.subsetString():
+            return None
+
+        parts = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+        path = parts.get('path')
+        table = parts.get('layerName')
+        if not path or not table or not path.lower().endswith('.gpkg'):
+            return None
+        return path, table
+
+    @staticmethod
+    def __copy_records_sql(source_meshblock_electorate_layer: QgsVectorLayer,
+                           source_scenario_id,
+                           dest_meshblock_electorate_layer: QgsVectorLayer,
+                           new_scenario_id) -> bool:
+        """
+        Copies the meshblock electorate records for a scenario directly within the database,
+        using a single INSERT ... SELECT statement. This is only possible when both layers are
+        GeoPackage tables. If the source table is in a different GeoPackage to the destination
+        it is attached to the destination database for the copy.
+        :param source_meshblock_electorate_layer: source layer for meshblock->electorate mappings
+        :param source_scenario_id: source scenario id
+        :param dest_meshblock_electorate_layer: destination layer for copied meshblock->electorate mappings
+        :param new_scenario_id: new scenario id for copied records
+        :returns True if the records were copied. If False, no records were copied and
+        the records must be copied through the layers instead.
+        """
+        source = ScenarioRegistry.geopackage_table(source_meshblock_electorate_layer)
+        dest = ScenarioRegistry.geopackage_table(dest_meshblock_electorate_layer)
+        if source is None or dest is None:
+            return False
+        # the database copy would miss uncommitted changes in the layers' edit buffers
+        if source_meshblock_electorate_layer.isModified() or dest_meshblock_electorate_layer.isEditable():
+            return False
+
+        source_path, source_table = source
+        dest_path, dest_table = dest
+        same_database = os.path.normcase(os.path.abspath(source_path)) == os.path.normcase(
+            os.path.abspath(dest_path))
+        scenario_id_column = ScenarioRegistry.MESHBLOCK_SCENARIO_ID_FIELD_NAME
+
+        try:
+            with closing(sqlite3.connect(dest_path, timeout=5)) as connection:
+                source_schema = ''
+                if not same_database:
+                    connection.execute('ATTACH DATABASE ? AS source_db', (source_path,))
+                    source_schema = 'source_db.'
+
+                # primary key (fid) columns are left for the database to populate
+                dest_columns = [row[1] for row in connection.execute(
+                    f'PRAGMA table_info({QgsExpression.quotedColumnRef(dest_table)})') if not row[5]]
+                source_columns = {row[1] for row in connection.execute(
+                    f'PRAGMA {source_schema}table_info({QgsExpression.quotedColumnRef(source_table)})')}
+                if scenario_id_column not in dest_columns or scenario_id_column not in source_columns:
+                    return False
+
+                columns = [column for column in dest_columns if column in source_columns]
+                column_list = ','.join(QgsExpression.quotedColumnRef(column) for column in columns)
+                select_list = ','.join('?' if column == scenario_id_column else QgsExpression.quotedColumnRef(column)
+                                       for column in columns)
+                connection.execute(
+                    f'INSERT INTO {QgsExpression.quotedColumnRef(dest_table)} ({column_list}) '
+                    f'SELECT {select_list} FROM {source_schema}{QgsExpression.quotedColumnRef(source_table)} '
+                    f'WHERE {QgsExpression.quotedColumnRef(scenario_id_column)}=?',
+                    (new_scenario_id, ScenarioRegistry.electorate_key(source_scenario_id)))
+                connection.commit()
+        except sqlite3.Error:
+            # e.g. tables with spatial index triggers, which require functions only available within GDAL
+            return False
+
+        dest_meshblock_electorate_layer.reload()
+        return True
 
     def branch_scenario(self, scenario_id, new_scenario_name: str):
         """
-        Branches a scenario to a new scenario
+        Branches a scenario to a new scenario. If the registry supports lineages, the
+        new scenario inherits all meshblocks from the source scenario and no meshblock
+        records are copied. Otherwise all meshblock records are copied to the new scenario.
         :param scenario_id: scenario to branch
         :param new_scenario_name: name for new scenario
         :returns New scenario ID if branch was successful, and error message if not
@@ -220,17 +498,140 @@ class ScenarioRegistry():
         if not self.scenario_exists(scenario_id):
             return False, QCoreApplication.translate('LinzRedistrict', 'Scenario {} does not exist').format(scenario_id)
 
+        if self.supports_lineage():
+            new_id, error = self.__insert_new_scenario(new_scenario_name=new_scenario_name,
+                                                       parent_scenario_id=self.electorate_key(scenario_id))
+            if not new_id:
+                return False, error
+
+            if len(self.scenario_lineage(new_id)) > self.MAX_LINEAGE_DEPTH:
+                self.materialize_scenario(new_id)
+            return new_id, None
+
         # all good to go
         new_id, error = self.__insert_new_scenario(new_scenario_name=new_scenario_name)
         if not new_id:
             return False, error
 
-        ScenarioRegistry.__copy_records_from_scenario(source_meshblock_electorate_layer=self.meshblock_electorate_layer,
-                                                      source_scenario_id=scenario_id,
-                                                      dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
-                                                      new_scenario_id=new_id)
+        if not ScenarioRegistry.__copy_records_sql(source_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                                   source_scenario_id=scenario_id,
+                                                   dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                                   new_scenario_id=new_id):
+            ScenarioRegistry.__copy_records(records=self.scenario_features(scenario_id).values(),
+                                            dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                            new_scenario_id=new_id)
         return new_id, None
 
+    def materialize_scenario(self, scenario_id) -> bool:
+        """
+        Materializes a scenario, by copying all meshblock records inherited from its parent
+        scenarios to the scenario itself and detaching it from its parent
+        :param scenario_id: scenario to materialize
+        :returns True if scenario was successfully materialized
+        """
+        lineage = self.scenario_lineage(scenario_id)
+        if len(lineage) == 1:
+            return True
+
+        scenario_id_idx = self.meshblock_electorate_layer.fields().lookupField(self.MESHBLOCK_SCENARIO_ID_FIELD_NAME)
+        inherited = [f for f in self.scenario_features(scenario_id, lineage=lineage).values()
+                     if self.electorate_key(f[scenario_id_idx]) != lineage[0]]
+        if not ScenarioRegistry.__copy_records(records=inherited,
+                                               dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                               new_scenario_id=lineage[0]):
+            return False
+
+        scenario_feature = self.get_scenario(lineage[0])
+        success = self.source_layer.dataProvider().changeAttributeValues(
+            {scenario_feature.id(): {self.parent_field_index: NULL}})
+        self.invalidate()
+        return success
+
+    def materialize_all_scenarios(self) -> bool:
+        """
+        Materializes all scenarios with a parent scenario (see materialize_scenario()), so that
+        every scenario stores a full copy of its meshblock records. This should be done before
+        disabling lineages.
+        :returns True if all scenarios were successfully materialized
+        """
+        if not self.has_lineage_field():
+            return True
+
+        self._scenario_metadata()
+        branches = [scenario_id for scenario_id, parent in self._parents.items() if parent is not None]
+        success = True
+        for scenario_id in branches:
+            if not self.materialize_scenario(scenario_id):
+                success = False
+        return success
+
+    def prepare_scenario_changes(self, scenario_id, meshblock_numbers: Iterable[int],
+                                 own_records: Optional[Dict[int, int]] = None) -> bool:
+        """
+        Prepares the meshblock records for a scenario for changes to a set of meshblocks.
+
+        Any branches of the scenario which inherit the current records for these meshblocks
+        receive their own copy of the current records, so that they are unaffected by the
+        changes. Any of the meshblocks which the scenario itself inherits from its parents
+        are copied to the scenario, so that the changes can be written to them.
+        :param scenario_id: scenario which will be changed
+        :param meshblock_numbers: numbers of meshblocks which will be changed
+        :param own_records: optional dictionary of meshblock number to meshblock electorate feature ID
+        for the records stored by the scenario itself, e.g. a cached index maintained by the caller.
+        If set, only meshblocks missing from the dictionary are looked up in the scenario's lineage.
+        :returns True if the records were successfully prepared
+        """
+        # existing lineages must be protected even if new branches are no longer stored as lineages
+        if not self.has_lineage_field():
+            return True
+
+        meshblock_numbers = [int(n) for n in meshblock_numbers]
+        if not meshblock_numbers:
+            return True
+
+        scenario_id = self.electorate_key(scenario_id)
+        self._scenario_metadata()
+        branches = [branch for branch, parent in self._parents.items() if parent == scenario_id]
+
+        if own_records is None:
+            current = self.scenario_features(scenario_id, meshblock_numbers=meshblock_numbers)
+        else:
+            inherited_numbers = [n for n in meshblock_numbers if n not in own_records]
+            if not branches and not inherited_numbers:
+                # nothing to copy
+                return True
+
+            current = {}
+            own_ids = [own_records[n] for n in meshblock_numbers if n in own_records]
+            if branches and own_ids:
+                meshblock_number_idx = self.meshblock_electorate_layer.fields().lookupField('meshblock_number')
+                assert meshblock_number_idx >= 0
+                request = QgsFeatureRequest().setFilterFids(own_ids).setFlags(QgsFeatureRequest.NoGeometry)
+                current = {int(f[meshblock_number_idx]): f for f in
+                           self.meshblock_electorate_layer.getFeatures(request)}
+            current.update(self.scenario_features(scenario_id, meshblock_numbers=inherited_numbers))
+
+        success = True
+        for branch in branches:
+            own = self.scenario_features(branch, attributes=[], meshblock_numbers=meshblock_numbers,
+                                         lineage=[branch])
+            if not ScenarioRegistry.__copy_records(
+                    records=[f for number, f in current.items() if number not in own],
+                    dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                    new_scenario_id=branch):
+                success = False
+
+        scenario_id_idx = self.meshblock_electorate_layer.fields().lookupField(self.MESHBLOCK_SCENARIO_ID_FIELD_NAME)
+        assert scenario_id_idx >= 0
+        inherited = [f for f in current.values() if self.electorate_key(f[scenario_id_idx]) != scenario_id]
+        if inherited and not ScenarioRegistry.__copy_records(
+                records=inherited,
+                dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                new_scenario_id=scenario_id):
+            success = False
+
+        return success
+
     def import_scenario_from_other_registry(self, source_registry: 'ScenarioRegistry', source_scenario_id,
                                             new_scenario_name: str) -> (bool, str):
         """
@@ -255,11 +656,148 @@ class ScenarioRegistry():
         if not new_id:
             return False, error
 
-        ScenarioRegistry.__copy_records_from_scenario(
-            source_meshblock_electorate_layer=source_registry.meshblock_electorate_layer,
-            source_scenario_id=source_scenario_id,
-            dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
-            new_scenario_id=new_id)
+        # scenarios with a lineage must be resolved through the source registry
+        if len(source_registry.scenario_lineage(source_scenario_id)) > 1 or not ScenarioRegistry.__copy_records_sql(
+                source_meshblock_electorate_layer=source_registry.meshblock_electorate_layer,
+                source_scenario_id=source_scenario_id,
+                dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                new_scenario_id=new_id):
+            ScenarioRegistry.__copy_records(
+                records=source_registry.scenario_features(source_scenario_id).values(),
+                dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                new_scenario_id=new_id)
+        return new_id, None
+
+    def export_scenario_snapshot(self, scenario_id, path: str,
+                                 meshblock_numbers: Optional[Iterable[int]] = None) -> (bool, str):
+        """
+        Exports a scenario to a binary snapshot file (see ScenarioSnapshot)
+        :param scenario_id: scenario to export
+        :param path: destination snapshot file path
+        :param meshblock_numbers: optional meshblock ordering for the snapshot, e.g. the meshblock
+        numbers from a MeshblockStore. Snapshots with the same ordering can be compared without
+        matching meshblocks by number. If not set, meshblocks will be ordered by meshblock number.
+        :returns boolean for success, and error message if error encountered
+        """
+        if not self.scenario_exists(scenario_id):
+            return False, QCoreApplication.translate('LinzRedistrict', 'Scenario {} does not exist').format(scenario_id)
+
+        fields = self.meshblock_electorate_layer.fields()
+        type_field_indices = {electorate_type: fields.lookupField(self.electorate_field(electorate_type))
+                              for electorate_type in ScenarioSnapshot.ELECTORATE_TYPES}
+        records = self.scenario_features(scenario_id,
+                                         attributes=[idx for idx in type_field_indices.values() if idx >= 0])
+        numbers = array('q', sorted(records.keys()) if meshblock_numbers is None else
+                        [int(n) for n in meshblock_numbers])
+
+        electorates = {}
+        for electorate_type, idx in type_field_indices.items():
+            values = array('q')
+            for meshblock_number in numbers:
+                record = records.get(meshblock_number)
+                electorate_id = record[idx] if record is not None and idx >= 0 else NULL
+                if electorate_id is None or electorate_id == NULL:
+                    values.append(ScenarioSnapshot.NO_ELECTORATE)
+                    continue
+                try:
+                    values.append(int(electorate_id))
+                except (TypeError, ValueError):
+                    return False, QCoreApplication.translate('LinzRedistrict',
+                                                             'Electorate {} can not be stored in a snapshot').format(
+                        electorate_id)
+            electorates[electorate_type] = values
+
+        snapshot = ScenarioSnapshot(self.get_scenario_name(scenario_id), numbers, electorates)
+        try:
+            snapshot.write(path)
+        except OSError as e:
+            return False, QCoreApplication.translate('LinzRedistrict', 'Could not write snapshot: {}').format(e)
+        return True, None
+
+    @staticmethod
+    def __insert_records_sql(dest_meshblock_electorate_layer: QgsVectorLayer,
+                             columns: List[str], rows: List[tuple]) -> bool:
+        """
+        Inserts meshblock electorate records directly into the database, in a single
+        transaction. This is only possible when the layer is a GeoPackage table.
+        :param dest_meshblock_electorate_layer: destination layer for meshblock->electorate mappings
+        :param columns: names of columns to insert
+        :param rows: values to insert, in the same order as columns
+        :returns True if the records were inserted. If False, no records were inserted and
+        the records must be added through the layer instead.
+        """
+        dest = ScenarioRegistry.geopackage_table(dest_meshblock_electorate_layer)
+        if dest is None or dest_meshblock_electorate_layer.isEditable():
+            return False
+
+        dest_path, dest_table = dest
+        try:
+            with closing(sqlite3.connect(dest_path, timeout=5)) as connection:
+                connection.executemany(
+                    f'INSERT INTO {QgsExpression.quotedColumnRef(dest_table)} '
+                    f'({",".join(QgsExpression.quotedColumnRef(column) for column in columns)}) '
+                    f'VALUES ({",".join("?" * len(columns))})', rows)
+                connection.commit()
+        except sqlite3.Error:
+            return False
+
+        dest_meshblock_electorate_layer.reload()
+        return True
+
+    def import_scenario_snapshot(self, path: str, new_scenario_name: Optional[str] = None) -> (bool, str):
+        """
+        Imports a scenario from a binary snapshot file (see ScenarioSnapshot)
+        :param path: snapshot file path
+        :param new_scenario_name: name for imported scenario. If not set, the name
+        stored in the snapshot will be used.
+        :returns new scenario ID if import was successful, and error message if not
+        """
+        try:
+            snapshot = ScenarioSnapshot.read(path)
+        except (OSError, ValueError) as e:
+            return False, QCoreApplication.translate('LinzRedistrict', 'Could not read snapshot: {}').format(e)
+
+        try:
+            if not new_scenario_name:
+                new_scenario_name = snapshot.name
+            if self.scenario_name_exists(new_scenario_name):
+                return False, QCoreApplication.translate('LinzRedistrict', '{} already exists').format(
+                    new_scenario_name)
+
+            new_id, error = self.__insert_new_scenario(new_scenario_name=new_scenario_name)
+            if not new_id:
+                return False, error
+
+            fields = self.meshblock_electorate_layer.fields()
+            columns = [self.MESHBLOCK_SCENARIO_ID_FIELD_NAME, 'meshblock_number']
+            electorate_types = [electorate_type for electorate_type in ScenarioSnapshot.ELECTORATE_TYPES
+                                if fields.lookupField(self.electorate_field(electorate_type)) >= 0]
+            columns.extend(self.electorate_field(electorate_type) for electorate_type in electorate_types)
+            column_indices = [fields.lookupField(column) for column in columns]
+            assert all(idx >= 0 for idx in column_indices)
+
+            values = [snapshot.electorates(electorate_type) for electorate_type in electorate_types]
+            rows = [tuple([new_id, number] + [None if electorates[ordinal] == ScenarioSnapshot.NO_ELECTORATE
+                                              else electorates[ordinal] for electorates in values])
+                    for ordinal, number in enumerate(snapshot.meshblock_numbers)]
+        finally:
+            snapshot.close()
+
+        if not ScenarioRegistry.__insert_records_sql(self.meshblock_electorate_layer, columns, rows):
+            records = []
+            for row in rows:
+                f = QgsFeature(fields)
+                for idx, value in zip(column_indices, row):
+                    if value is None:
+                        f[idx] = NULL
+                    elif fields.at(idx).type() == QVariant.String:
+                        f[idx] = str(value)
+                    else:
+                        f[idx] = value
+                records.append(f)
+            ScenarioRegistry.__copy_records(records=records,
+                                            dest_meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                            new_scenario_id=new_id)
         return new_id, None
 
     @staticmethod
@@ -269,7 +807,7 @@ class ScenarioRegistry():
         """
         return f'{electorate_type.lower()}_id'
 
-    def electorate_meshblocks(self, electorate_id, electorate_type: str, scenario_id) -> QgsFeatureIterator:
+    def electorate_meshblocks(self, electorate_id, electorate_type: str, scenario_id) -> Iterator[QgsFeature]:
         """
         Returns meshblock features currently assigned to an electorate in a
         given scenario
@@ -283,17 +821,144 @@ class ScenarioRegistry():
         type_field_index = self.meshblock_electorate_layer.fields().lookupField(type_field)
         assert type_field_index >= 0
 
+        lineage = self.scenario_lineage(scenario_id)
+        if len(lineage) > 1:
+            # an inherited meshblock may have been reassigned in a descendant scenario, so records
+            # must be resolved against the lineage before filtering by electorate. Only meshblocks
+            # assigned to the electorate somewhere in the lineage can be assigned to it in the
+            # scenario, so only these meshblocks are resolved.
+            meshblock_number_idx = self.meshblock_electorate_layer.fields().lookupField('meshblock_number')
+            assert meshblock_number_idx >= 0
+            lineage_str = ','.join(QgsExpression.quotedValue(s) for s in lineage)
+            request.setFilterExpression(
+                f'{QgsExpression.quotedColumnRef(self.MESHBLOCK_SCENARIO_ID_FIELD_NAME)} IN ({lineage_str})')
+            request.combineFilterExpression(QgsExpression.createFieldEqualityExpression(type_field, electorate_id))
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([meshblock_number_idx])
+            candidates = {int(f[meshblock_number_idx]) for f in self.meshblock_electorate_layer.getFeatures(request)}
+
+            key = self.electorate_key(electorate_id)
+            return iter([f for f in self.scenario_features(scenario_id, meshblock_numbers=candidates,
+                                                           lineage=lineage).values()
+                         if self.electorate_key(f[type_field_index]) == key])
+
         request.setFilterExpression(QgsExpression.createFieldEqualityExpression(
             ScenarioRegistry.MESHBLOCK_SCENARIO_ID_FIELD_NAME, scenario_id))
         request.combineFilterExpression(QgsExpression.createFieldEqualityExpression(type_field, electorate_id))
 
         return self.meshblock_electorate_layer.getFeatures(request)
 
-    def meshblocks_for_scenarios(self, scenario_ids: List[int]) -> QgsFeatureIterator:
+    @staticmethod
+    def electorate_key(electorate_id):
         """
-        Returns an iterator for meshblock_electorate features which match any of the specified scenarios
+        Returns a normalized key for an electorate id, so that ids read from
+        integer and string typed fields can be matched
+        :param electorate_id: electorate id
+        """
+        try:
+            return int(electorate_id)
+        except (TypeError, ValueError):
+            return electorate_id
+
+    def scenario_electorate_meshblocks(self, scenario_id, meshblock_store,
+                                       electorate_types: Optional[List[str]] = None,
+                                       source=None,
+                                       lineage: Optional[List[int]] = None) -> Dict[str, Dict[object, array]]:
+        """
+        Returns the meshblocks assigned to every electorate in a scenario, read
+        in a single pass over the meshblock electorate table.
+
+        The result is a dictionary of electorate type to a dictionary of electorate key (see
+        electorate_key()) to an array of meshblock ordinals from the meshblock store. Meshblocks
+        which are not present in the store are skipped.
+        :param scenario_id: scenario id
+        :param meshblock_store: meshblock store to map meshblock numbers to ordinals
+        :param electorate_types: optional list of electorate types to include, e.g. ['GN']. If
+        not set, all types present in the meshblock electorate table will be returned.
+        :param source: optional feature source to read from, e.g. a thread safe snapshot
+        of the meshblock electorate layer. If not set, the layer will be read directly.
+        :param lineage: optional precalculated scenario lineage (see scenario_lineage()). This
+        should be set when reading from a background thread.
+        """
+        if electorate_types is None:
+            electorate_types = ['GN', 'GS', 'M']
+
+        fields = self.meshblock_electorate_layer.fields()
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        assert meshblock_number_idx >= 0
+        type_field_indices = {}
+        for electorate_type in electorate_types:
+            idx = fields.lookupField(self.electorate_field(electorate_type))
+            if idx >= 0:
+                type_field_indices[electorate_type] = idx
+
+        result = {electorate_type: {} for electorate_type in type_field_indices}
+
+        features = self.scenario_features(scenario_id,
+                                          attributes=[meshblock_number_idx] + list(type_field_indices.values()),
+                                          source=source, lineage=lineage)
+
+        number_to_ordinal = meshblock_store.ordinal_for_meshblock_number
+        for f in features.values():
+            ordinal = number_to_ordinal(f[meshblock_number_idx])
+            if ordinal is None:
+                continue
+
+            for electorate_type, idx in type_field_indices.items():
+                electorate_id = f[idx]
+                if electorate_id is None or electorate_id == NULL:
+                    continue
+
+                type_meshblocks = result[electorate_type]
+                key = self.electorate_key(electorate_id)
+                if key not in type_meshblocks:
+                    type_meshblocks[key] = array('l')
+                type_meshblocks[key].append(ordinal)
+
+        return result
+
+    def scenario_electorate_meshblock_numbers(self, scenario_id, electorate_type: str) -> Dict[object, List[int]]:
+        """
+        Returns the numbers of the meshblocks assigned to every electorate of a type in a scenario,
+        resolving the scenario's lineage once for all electorates
+        :param scenario_id: scenario id
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        :return: dictionary of electorate key (see electorate_key()) to list of meshblock numbers
+        """
+        fields = self.meshblock_electorate_layer.fields()
+        meshblock_number_idx = fields.lookupField('meshblock_number')
+        assert meshblock_number_idx >= 0
+        type_field_index = fields.lookupField(self.electorate_field(electorate_type))
+        assert type_field_index >= 0
+
+        result = {}
+        for meshblock_number, f in self.scenario_features(scenario_id,
+                                                          attributes=[meshblock_number_idx,
+                                                                      type_field_index]).items():
+            electorate_id = f[type_field_index]
+            if electorate_id is None or electorate_id == NULL:
+                continue
+            result.setdefault(self.electorate_key(electorate_id), []).append(meshblock_number)
+        return result
+
+    def meshblocks_for_scenarios(self, scenario_ids: List[int]) -> Iterator[QgsFeature]:
+        """
+        Returns an iterator for meshblock_electorate features which match any of the specified scenarios.
+        Meshblocks inherited by a scenario from its parents are returned with the scenario id set
+        to the inheriting scenario.
         :param scenario_ids: target scenario ids
         """
+        lineages = [self.scenario_lineage(scenario_id) for scenario_id in scenario_ids]
+        if any(len(lineage) > 1 for lineage in lineages):
+            scenario_id_idx = self.meshblock_electorate_layer.fields().lookupField(
+                ScenarioRegistry.MESHBLOCK_SCENARIO_ID_FIELD_NAME)
+            features = []
+            for lineage in lineages:
+                for f in self.scenario_features(lineage[0], lineage=lineage).values():
+                    f[scenario_id_idx] = lineage[0]
+                    features.append(f)
+            return iter(features)
+
         request = QgsFeatureRequest()
 
         scenario_ids_str = ','.join([str(_id) for _id in scenario_ids])
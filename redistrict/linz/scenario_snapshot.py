@@ -0,0 +1,249 @@
+"""
+LINZ Redistricting Plugin - Scenario snapshot
+"""
+
+from array import array
+import mmap
+import struct
+import sys
+import zlib
+from typing import (
+    Dict,
+    List,
+    Sequence
+)
+
+
+class ScenarioSnapshot:
+    """
+    A compact binary snapshot of the meshblock electorate assignments for a scenario.
+
+    A snapshot stores the meshblock numbers in ordinal order, followed by one array
+    per electorate type (GN, GS and M) holding the electorate id assigned to the meshblock
+    at each ordinal. All values are little-endian 64 bit integers, preceded by a header
+    containing the meshblock count, the scenario name and a CRC32 checksum of everything
+    which follows the header.
+
+    Snapshot files are memory mapped when read, so the arrays are not copied into
+    memory until required. Snapshots sharing the same meshblock ordering (e.g. exported
+    using the meshblock numbers from a MeshblockStore) can be compared block by block,
+    without matching meshblocks by number.
+    """
+
+    MAGIC = b'RDSNAP\x00\x00'
+    VERSION = 1
+    # magic, version, checksum, meshblock count, name length (bytes), padding
+    HEADER = struct.Struct('<8sIIQI4x')
+
+    ELECTORATE_TYPES = ('GN', 'GS', 'M')
+    # electorate id stored for meshblocks without an assigned electorate
+    NO_ELECTORATE = -1
+
+    # number of meshblocks compared in each block when diffing snapshots
+    DIFF_BLOCK_SIZE = 4096
+
+    def __init__(self, name: str, meshblock_numbers: Sequence[int], electorates: Dict[str, Sequence[int]]):
+        """
+        Constructor for ScenarioSnapshot
+        :param name: scenario name
+        :param meshblock_numbers: meshblock numbers, in ordinal order
+        :param electorates: dictionary of electorate type to electorate ids for each meshblock
+        ordinal. Types which are missing are stored as NO_ELECTORATE.
+        """
+        self.name = name
+        self.meshblock_numbers = meshblock_numbers
+        self._electorates = {}
+        for electorate_type in self.ELECTORATE_TYPES:
+            values = electorates.get(electorate_type)
+            if values is None:
+                values = array('q', [self.NO_ELECTORATE]) * len(meshblock_numbers)
+            assert len(values) == len(meshblock_numbers)
+            self._electorates[electorate_type] = values
+        self._mmap = None
+        self._buffer = None
+
+    def meshblock_count(self) -> int:
+        """
+        Returns the number of meshblocks in the snapshot
+        """
+        return len(self.meshblock_numbers)
+
+    def electorates(self, electorate_type: str) -> Sequence[int]:
+        """
+        Returns the electorate ids for each meshblock ordinal
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        return self._electorates[electorate_type.upper()]
+
+    def electorates_by_meshblock(self, electorate_type: str) -> Dict[int, int]:
+        """
+        Returns a dictionary of meshblock number to electorate id, for all meshblocks
+        with an assigned electorate
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        return {number: electorate for number, electorate in
+                zip(self.meshblock_numbers, self.electorates(electorate_type))
+                if electorate != self.NO_ELECTORATE}
+
+    @staticmethod
+    def _bytes(values: Sequence[int]) -> memoryview:
+        """
+        Returns a byte view of an integer array
+        """
+        return memoryview(values).cast('B')
+
+    @staticmethod
+    def _to_little_endian(values: Sequence[int]) -> bytes:
+        """
+        Returns the little-endian encoded bytes for an integer array
+        """
+        values = array('q', values)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tobytes()
+
+    def write(self, path: str):
+        """
+        Writes the snapshot to a file
+        :param path: destination file path
+        """
+        name = self.name.encode('utf-8')
+        # pad the name so that the arrays are 8 byte aligned
+        payload = [name + b'\x00' * (-len(name) % 8), self._to_little_endian(self.meshblock_numbers)]
+        payload.extend(self._to_little_endian(self._electorates[electorate_type])
+                       for electorate_type in self.ELECTORATE_TYPES)
+
+        checksum = 0
+        for part in payload:
+            checksum = zlib.crc32(part, checksum)
+
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, checksum, self.meshblock_count(), len(name)))
+            for part in payload:
+                f.write(part)
+
+    @staticmethod
+    def read(path: str, verify: bool = True) -> 'ScenarioSnapshot':
+        """
+        Reads a snapshot from a file. The file is memory mapped, and must not be modified
+        until the snapshot is closed.
+        :param path: snapshot file path
+        :param verify: if True, the snapshot checksum will be verified
+        :raises ValueError: if the file is not a valid snapshot
+        """
+        with open(path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # empty files can't be mapped
+                raise ValueError('Not a scenario snapshot') from e
+
+        try:
+            return ScenarioSnapshot._from_buffer(mapped, verify)
+        except ValueError:
+            mapped.close()
+            raise
+
+    @staticmethod
+    def _from_buffer(mapped: mmap.mmap, verify: bool) -> 'ScenarioSnapshot':
+        """
+        Creates a snapshot from a memory mapped snapshot file
+        """
+        header_size = ScenarioSnapshot.HEADER.size
+        if len(mapped) < header_size:
+            raise ValueError('Not a scenario snapshot')
+        magic, version, checksum, count, name_length = ScenarioSnapshot.HEADER.unpack_from(mapped)
+        if magic != ScenarioSnapshot.MAGIC:
+            raise ValueError('Not a scenario snapshot')
+        if version != ScenarioSnapshot.VERSION:
+            raise ValueError(f'Unsupported scenario snapshot version {version}')
+
+        array_offset = header_size + name_length + (-name_length % 8)
+        array_size = count * 8
+        if len(mapped) != array_offset + array_size * (1 + len(ScenarioSnapshot.ELECTORATE_TYPES)):
+            raise ValueError('Scenario snapshot is truncated')
+
+        buffer = memoryview(mapped)
+        if verify and zlib.crc32(buffer[header_size:]) != checksum:
+            buffer.release()
+            raise ValueError('Scenario snapshot checksum does not match')
+
+        def values(index: int) -> Sequence[int]:
+            start = array_offset + index * array_size
+            if sys.byteorder == 'little':
+                return buffer[start:start + array_size].cast('q')
+            copied = array('q', buffer[start:start + array_size].tobytes())
+            copied.byteswap()
+            return copied
+
+        name = bytes(buffer[header_size:header_size + name_length]).decode('utf-8')
+        snapshot = ScenarioSnapshot(name, values(0),
+                                    {electorate_type: values(i + 1) for i, electorate_type in
+                                     enumerate(ScenarioSnapshot.ELECTORATE_TYPES)})
+        snapshot._mmap = mapped  # pylint: disable=protected-access
+        snapshot._buffer = buffer  # pylint: disable=protected-access
+        return snapshot
+
+    def close(self):
+        """
+        Closes a snapshot read from a file. The snapshot's arrays can not be used after
+        the snapshot is closed.
+        """
+        if self._mmap is None:
+            return
+
+        for values in [self.meshblock_numbers] + list(self._electorates.values()):
+            if isinstance(values, memoryview):
+                values.release()
+        self._buffer.release()
+        self._buffer = None
+        self.meshblock_numbers = array('q')
+        self._electorates = {electorate_type: array('q') for electorate_type in self.ELECTORATE_TYPES}
+        self._mmap.close()
+        self._mmap = None
+
+    def has_same_meshblocks(self, other: 'ScenarioSnapshot') -> bool:
+        """
+        Returns True if another snapshot has the same meshblock ordering as this snapshot
+        :param other: snapshot to compare with
+        """
+        return self._bytes(self.meshblock_numbers) == self._bytes(other.meshblock_numbers)
+
+    @staticmethod
+    def changed_meshblocks(base: 'ScenarioSnapshot', secondary: 'ScenarioSnapshot',
+                           electorate_type: str) -> List[int]:
+        """
+        Returns the numbers of meshblocks assigned to a different electorate in two snapshots.
+
+        If the snapshots share the same meshblock ordering, the electorate arrays are compared
+        in blocks of raw bytes, and only the meshblocks within differing blocks are compared
+        individually. Otherwise meshblocks are matched by number, and meshblocks missing
+        from either snapshot are treated as having no assigned electorate.
+        :param base: base snapshot
+        :param secondary: secondary snapshot
+        :param electorate_type: electorate type, e.g. 'GN','GS','M'
+        """
+        base_electorates = base.electorates(electorate_type)
+        secondary_electorates = secondary.electorates(electorate_type)
+
+        changed = []
+        if base.has_same_meshblocks(secondary):
+            base_bytes = ScenarioSnapshot._bytes(base_electorates)
+            secondary_bytes = ScenarioSnapshot._bytes(secondary_electorates)
+            numbers = base.meshblock_numbers
+            count = base.meshblock_count()
+            for start in range(0, count, ScenarioSnapshot.DIFF_BLOCK_SIZE):
+                end = min(start + ScenarioSnapshot.DIFF_BLOCK_SIZE, count)
+                if base_bytes[start * 8:end * 8] == secondary_bytes[start * 8:end * 8]:
+                    continue
+                changed.extend(numbers[ordinal] for ordinal in range(start, end)
+                               if base_electorates[ordinal] != secondary_electorates[ordinal])
+            return changed
+
+        secondary_by_number = dict(zip(secondary.meshblock_numbers, secondary_electorates))
+        for number, electorate in zip(base.meshblock_numbers, base_electorates):
+            if secondary_by_number.pop(number, ScenarioSnapshot.NO_ELECTORATE) != electorate:
+                changed.append(number)
+        changed.extend(number for number, electorate in secondary_by_number.items()
+                       if electorate != ScenarioSnapshot.NO_ELECTORATE)
+        return changed
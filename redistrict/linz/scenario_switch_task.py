@@ -13,9 +13,13 @@ __copyright__ = 'Copyright 2018, LINZ'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
+from typing import Optional
 from qgis.core import (QgsVectorLayer,
+                       QgsFeatureRequest,
                        NULL)
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -30,7 +34,9 @@ class ScenarioSwitchTask(ScenarioBaseTask):
     MESHBLOCKS = 'MESHBLOCKS'
 
     def __init__(self, task_name: str, electorate_layer: QgsVectorLayer, meshblock_layer: QgsVectorLayer,
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario,
+                 meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None, current_scenario=None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -39,10 +45,16 @@ class ScenarioSwitchTask(ScenarioBaseTask):
         :param meshblock_number_field_name: name of meshblock number field
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
+        :param meshblock_store: shared meshblock store
+        :param geometry_cache: optional electorate geometry cache
+        :param current_scenario: if set, the switch will be incremental. Only electorates
+        whose meshblocks differ between this scenario and the target scenario will be
+        recalculated, and all other electorates will be left unchanged.
         """
         super().__init__(task_name=task_name, electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=None)
+                         scenario=scenario, task=None, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
 
         self.stats_nz_pop_field = 'stats_nz_pop'
         self.stats_nz_var_20_field = 'stats_nz_var_20'
@@ -55,6 +67,66 @@ class ScenarioSwitchTask(ScenarioBaseTask):
         self.stats_nz_var_23_field_index = self.electorate_layer.fields().lookupField(self.stats_nz_var_23_field)
         assert self.stats_nz_var_23_field_index >= 0
 
+        self.current_scenario = current_scenario
+        self.current_lineage = scenario_registry.scenario_lineage(
+            current_scenario) if current_scenario is not None else None
+        # feature ids of electorates which are identical in the current and target scenarios
+        self.unchanged_electorates = set()
+
+    def prepare(self):
+        """
+        Reads the electorates to process, skipping any which are unchanged between
+        the current and target scenarios when switching incrementally
+        """
+        super().prepare()
+        if self.current_scenario is not None:
+            self.unchanged_electorates = self.find_unchanged_electorates()
+            self.electorates_to_process = {electorate_id: params for electorate_id, params in
+                                           self.electorates_to_process.items()
+                                           if params[self.ELECTORATE_FEATURE_ID] not in self.unchanged_electorates}
+
+    def find_unchanged_electorates(self) -> set:
+        """
+        Returns the feature ids of electorates which have the same meshblocks assigned in
+        the current and target scenarios, and which currently store the results for the
+        current scenario
+        """
+        current_meshblocks = self.scenario_registry.scenario_electorate_meshblocks(
+            scenario_id=self.current_scenario, meshblock_store=self.meshblock_store,
+            source=self.meshblock_electorate_source, lineage=self.current_lineage)
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.scenario_id_idx])
+        request.setFilterFids([params[self.ELECTORATE_FEATURE_ID] for params in self.electorates_to_process.values()])
+        electorate_scenarios = {f.id(): f[self.scenario_id_idx] for f in self.electorate_source.getFeatures(request)}
+
+        unchanged = set()
+        for electorate_id, params in self.electorates_to_process.items():
+            electorate_feature_id = params[self.ELECTORATE_FEATURE_ID]
+            if electorate_scenarios.get(electorate_feature_id) != self.current_scenario:
+                # electorate doesn't reflect the current scenario, so must be rebuilt
+                continue
+
+            current = current_meshblocks.get(params[self.ELECTORATE_TYPE], {}).get(
+                ScenarioRegistry.electorate_key(electorate_id), [])
+            if sorted(current) == sorted(params[self.MESHBLOCKS]):
+                unchanged.add(electorate_feature_id)
+
+        return unchanged
+
+    def scenario_attribute_changes(self) -> dict:
+        """
+        Returns the attribute changes required for any electorate switched to the
+        target scenario, resetting all values which are specific to a scenario
+        """
+        return {self.scenario_id_idx: self.scenario,
+                self.invalid_idx: NULL,
+                self.invalid_reason_idx: None,
+                self.stats_nz_pop_field_index: NULL,
+                self.stats_nz_var_20_field_index: NULL,
+                self.stats_nz_var_23_field_index: NULL}
+
     def run(self):  # pylint: disable=missing-docstring
         try:
             electorate_geometries, electorate_attributes = self.calculate_new_electorates()
@@ -66,19 +138,18 @@ class ScenarioSwitchTask(ScenarioBaseTask):
         for params in self.electorates_to_process.values():
             electorate_feature_id = params[self.ELECTORATE_FEATURE_ID]
 
-            attribute_change_map[electorate_feature_id] = {self.scenario_id_idx: self.scenario,
-                                                           self.estimated_pop_idx:
-                                                               electorate_attributes[electorate_feature_id][
-                                                                   self.ESTIMATED_POP],
-                                                           self.invalid_idx: NULL,
-                                                           self.invalid_reason_idx: None,
-                                                           self.stats_nz_pop_field_index: NULL,
-                                                           self.stats_nz_var_20_field_index: NULL,
-                                                           self.stats_nz_var_23_field_index: NULL}
+            attribute_change_map[electorate_feature_id] = self.scenario_attribute_changes()
+            attribute_change_map[electorate_feature_id][self.estimated_pop_idx] = \
+                electorate_attributes[electorate_feature_id][self.ESTIMATED_POP]
 
             electorate_geometry = electorate_geometries[electorate_feature_id]
             geometry_change_map[electorate_feature_id] = electorate_geometry
 
+        for electorate_feature_id in self.unchanged_electorates:
+            # geometry and population are unchanged, but validation results and
+            # statistics must still be reset for the new scenario
+            attribute_change_map[electorate_feature_id] = self.scenario_attribute_changes()
+
         # commit changes
         if not self.electorate_layer.dataProvider().changeAttributeValues(attribute_change_map):
             return False
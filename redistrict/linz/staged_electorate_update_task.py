@@ -2,14 +2,16 @@
 LINZ Redistricting Plugin - Staged electorate updating task
 """
 
+from typing import Optional
 from qgis.core import (
     NULL,
     QgsTask,
     QgsFeatureRequest,
     QgsVectorLayer,
-    QgsExpression
+    QgsVectorLayerFeatureSource
 )
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
 
 
 class UpdateStagedElectoratesTask(QgsTask):
@@ -18,7 +20,8 @@ class UpdateStagedElectoratesTask(QgsTask):
     """
 
     def __init__(self, task_name: str, meshblock_layer: QgsVectorLayer,  # pylint: disable=too-many-locals
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str,
+                 meshblock_store: Optional[MeshblockStore] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -28,6 +31,8 @@ class UpdateStagedElectoratesTask(QgsTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current task
+        :param meshblock_store: optional shared meshblock store. If set, meshblock
+        numbers will be read from the store instead of the meshblock layer.
         """
         super().__init__(task_name)
 
@@ -46,31 +51,56 @@ class UpdateStagedElectoratesTask(QgsTask):
         self.meshblock_number_idx = meshblock_layer.fields().lookupField(meshblock_number_field_name)
         assert self.meshblock_number_idx >= 0
         self.meshblock_layer = meshblock_layer
+        self.meshblock_store = meshblock_store
+        self.scenario_registry = scenario_registry
+        # resolved on the main thread, as the scenario layer isn't safe to read in the background
+        self.lineage = scenario_registry.scenario_lineage(scenario)
 
-        request = QgsFeatureRequest()
-        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('scenario_id', scenario))
-        request.setSubsetOfAttributes([self.mb_number_idx, self.electorate_field_idx])
-        self.meshblocks_for_scenario = scenario_registry.meshblock_electorate_layer.getFeatures(request)
+        # thread safe snapshots of the layers, read in the background
+        self.meshblock_source = QgsVectorLayerFeatureSource(meshblock_layer)
+        self.meshblock_count = meshblock_layer.featureCount()
+        self.meshblock_electorate_source = QgsVectorLayerFeatureSource(scenario_registry.meshblock_electorate_layer)
 
         self.setDependentLayers([meshblock_layer])
 
+    def meshblock_number(self, meshblock) -> Optional[int]:
+        """
+        Returns the meshblock number for a meshblock feature
+        :param meshblock: meshblock feature
+        """
+        if self.meshblock_store is not None:
+            ordinal = self.meshblock_store.ordinal_for_feature_id(meshblock.id())
+            return self.meshblock_store.meshblock_numbers[ordinal] if ordinal is not None else None
+        return int(meshblock[self.meshblock_number_idx])
+
     def run(self):  # pylint: disable=missing-docstring
+        if self.meshblock_store is not None:
+            self.meshblock_store.ensure_built(self.meshblock_source)
+
         # build dictionary of meshblock number to electorate field
-        meshblock_electorate = {m[self.mb_number_idx]: m[self.electorate_field_idx] for m in
-                                self.meshblocks_for_scenario}
+        meshblock_electorate = {meshblock_number: m[self.electorate_field_idx] for meshblock_number, m in
+                                self.scenario_registry.scenario_features(self.scenario,
+                                                                         attributes=[self.electorate_field_idx],
+                                                                         source=self.meshblock_electorate_source,
+                                                                         lineage=self.lineage).items()}
 
         attribute_change_map = {}
         request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([self.meshblock_number_idx,
-                                       self.staged_electorate_field_idx])
+        if self.meshblock_store is not None:
+            # meshblock numbers come from the store, so only the staged electorate needs to be read
+            request.setSubsetOfAttributes([self.staged_electorate_field_idx])
+        else:
+            request.setSubsetOfAttributes([self.meshblock_number_idx,
+                                           self.staged_electorate_field_idx])
         request.setFlags(QgsFeatureRequest.NoGeometry)
-        to_process = self.meshblock_layer.featureCount()
-        for i, m in enumerate(self.meshblock_layer.getFeatures(request)):
+        to_process = self.meshblock_count
+        for i, m in enumerate(self.meshblock_source.getFeatures(request)):
             self.setProgress(80 * i / to_process)
-            if not int(m[self.meshblock_number_idx]) in meshblock_electorate:
+            meshblock_number = self.meshblock_number(m)
+            if meshblock_number not in meshblock_electorate:
                 electorate = NULL
             else:
-                electorate = meshblock_electorate[int(m[self.meshblock_number_idx])]
+                electorate = meshblock_electorate[meshblock_number]
             current_electorate = m[self.staged_electorate_field_idx]
             if current_electorate != electorate:
                 attribute_change_map[m.id()] = {self.staged_electorate_field_idx: electorate}
@@ -0,0 +1,96 @@
+"""
+LINZ Redistricting Plugin - User log writer
+"""
+
+from typing import (
+    Dict,
+    List
+)
+
+from qgis.core import (
+    QgsFeature,
+    QgsVectorLayer
+)
+
+
+class UserLogWriter:
+    """
+    Writes user log entries to the user log layer.
+
+    If buffered, entries are held in memory (and can be removed again when
+    the associated changes are undone) until flush() is called, at which
+    point all buffered entries are written to the layer in a single call.
+    Otherwise entries are immediately written to the layer's provider.
+    """
+
+    def __init__(self, user_log_layer: QgsVectorLayer, buffered: bool = False):
+        """
+        Constructor
+        :param user_log_layer: user log layer
+        :param buffered: True if entries should be buffered until flushed
+        """
+        self.user_log_layer = user_log_layer
+        self.buffered = buffered
+
+        self._next_handle = 0
+        # handle to buffered entry, in order of addition
+        self._entries: Dict[int, QgsFeature] = {}
+
+    def add_entries(self, entries: List[QgsFeature]) -> List[int]:
+        """
+        Adds new log entries
+        :param entries: log entries to add
+        :return: list of handles for the added entries, to use with remove_entries(). If
+        the entries could not be written to the layer an empty list will be returned.
+        """
+        if not self.buffered:
+            success, added = self.user_log_layer.dataProvider().addFeatures(entries)
+            if not success:
+                # the returned feature ids are not valid, and must never be deleted
+                return []
+            return [f.id() for f in added]
+
+        handles = []
+        for entry in entries:
+            self._entries[self._next_handle] = entry
+            handles.append(self._next_handle)
+            self._next_handle += 1
+        return handles
+
+    def remove_entries(self, handles: List[int]):
+        """
+        Removes previously added log entries
+        :param handles: handles for entries, as returned by add_entries()
+        """
+        if not self.buffered:
+            if handles:
+                self.user_log_layer.dataProvider().deleteFeatures(handles)
+            return
+
+        for handle in handles:
+            self._entries.pop(handle, None)
+
+    def pending_entries(self) -> List[QgsFeature]:
+        """
+        Returns a list of all buffered entries which have not yet been written
+        """
+        return list(self._entries.values())
+
+    def flush(self) -> bool:
+        """
+        Writes all buffered entries to the user log layer
+        :return: True if entries were successfully written
+        """
+        if not self._entries:
+            return True
+
+        success, _ = self.user_log_layer.dataProvider().addFeatures(list(self._entries.values()))
+        if success:
+            self._entries = {}
+        return success
+
+    def discard(self):
+        """
+        Discards all buffered entries without writing them
+        """
+        self._entries = {}
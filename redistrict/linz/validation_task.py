@@ -2,12 +2,23 @@
 LINZ Redistricting Plugin - Electorate validation task
 """
 
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional
+)
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsVectorLayer,
                        QgsGeometry,
+                       QgsExpression,
+                       QgsFeatureRequest,
                        NULL)
 from redistrict.linz.linz_district_registry import LinzElectoralDistrictRegistry
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
+from redistrict.linz.meshblock_adjacency_graph import MeshblockAdjacencyGraph
 from redistrict.linz.scenario_base_task import (ScenarioBaseTask,
                                                 CanceledException)
 
@@ -23,7 +34,10 @@ class ValidationTask(ScenarioBaseTask):
 
     def __init__(self, task_name: str, electorate_registry: LinzElectoralDistrictRegistry,
                  meshblock_layer: QgsVectorLayer,
-                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str):
+                 meshblock_number_field_name: str, scenario_registry: ScenarioRegistry, scenario, task: str,
+                 meshblock_store: Optional[MeshblockStore] = None,
+                 geometry_cache: Optional[ElectorateGeometryCache] = None,
+                 meshblock_graph: Optional[MeshblockAdjacencyGraph] = None):
         """
         Constructor for ScenarioSwitchTask
         :param task_name: user-visible, translated name for task
@@ -33,86 +47,148 @@ class ValidationTask(ScenarioBaseTask):
         :param scenario_registry: scenario registry
         :param scenario: target scenario id to switch to
         :param task: current task
+        :param meshblock_store: shared meshblock store
+        :param geometry_cache: optional electorate geometry cache
+        :param meshblock_graph: optional meshblock adjacency graph. If set (and the graph
+        is up to date), contiguity will be checked using the graph and electorate geometries
+        will only be calculated for invalid electorates.
         """
         self.electorate_registry = electorate_registry
         super().__init__(task_name=task_name, electorate_layer=self.electorate_registry.source_layer,
                          meshblock_layer=meshblock_layer,
                          meshblock_number_field_name=meshblock_number_field_name, scenario_registry=scenario_registry,
-                         scenario=scenario, task=task)
+                         scenario=scenario, task=task, meshblock_store=meshblock_store,
+                         geometry_cache=geometry_cache)
+        self.meshblock_graph = meshblock_graph
         self.results = []
 
         # immediately clear existing validation results
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setNoAttributes()
+        request.setFilterExpression(QgsExpression.createFieldEqualityExpression('type', task))
         attribute_change_map = {}
-        for e in self.electorates_to_process.values():
-            attribute_change_map[e[self.ELECTORATE_FEATURE_ID]] = {
+        for e in self.electorate_layer.getFeatures(request):
+            attribute_change_map[e.id()] = {
                 self.invalid_idx: NULL,
                 self.invalid_reason_idx: NULL
             }
         self.electorate_layer.dataProvider().changeAttributeValues(attribute_change_map)
 
-    def run(self):  # pylint: disable=missing-docstring, too-many-locals
+    def use_meshblock_graph(self) -> bool:
+        """
+        Returns True if contiguity can be checked using the meshblock adjacency graph
+        """
+        return self.meshblock_graph is not None and self.meshblock_graph.is_valid() and \
+            self.meshblock_graph.meshblock_numbers == self.meshblock_store.meshblock_numbers
+
+    def count_components(self, meshblocks: Iterable[int]) -> int:
+        """
+        Counts the number of contiguous components within a set of meshblocks, using
+        union-find over the meshblock adjacency graph
+        :param meshblocks: meshblock ordinals
+        """
+        parent = {m: m for m in meshblocks}
+
+        def find(m):
+            while parent[m] != m:
+                parent[m] = parent[parent[m]]
+                m = parent[m]
+            return m
+
+        components = len(parent)
+        for m in parent:
+            for neighbour in self.meshblock_graph.neighbours_for(m):
+                if neighbour <= m or neighbour not in parent:
+                    continue
+                root_a = find(m)
+                root_b = find(neighbour)
+                if root_a != root_b:
+                    parent[root_a] = root_b
+                    components -= 1
+        return components
+
+    @staticmethod
+    def geometry_part_count(geometry: QgsGeometry) -> int:
+        """
+        Returns the number of parts in an electorate geometry
+        """
+        if geometry.isNull() or geometry.isEmpty():
+            return 0
+        if geometry.isMultipart():
+            return geometry.constGet().numGeometries()
+        return 1
+
+    def electorate_errors(self, attributes: dict, part_count: int) -> List[str]:
+        """
+        Returns a list of the validation errors for an electorate
+        :param attributes: electorate attributes
+        :param part_count: number of contiguous parts in electorate
+        """
+        # prefer stats nz pop if available
+        pop = attributes[self.STATS_NZ_POP] if attributes[self.STATS_NZ_POP] is not None and attributes[self.STATS_NZ_POP] != NULL else attributes[self.ESTIMATED_POP]
+        expected_regions = attributes[self.EXPECTED_REGIONS]
+        deprecated = attributes[self.DEPRECATED]
+        quota = self.electorate_registry.get_quota_for_district_type(attributes[self.ELECTORATE_TYPE])
+
+        errors = []
+        # quota check
+        if not deprecated and self.electorate_registry.variation_exceeds_allowance(quota=quota, population=pop):
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Outside quota tolerance'))
+
+        # contiguity check
+        if deprecated and part_count > 0:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Deprecated electorate has meshblocks assigned'))
+        elif part_count > 1 and part_count > expected_regions:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Electorate is non-contiguous'))
+        elif part_count <= 1 and expected_regions > 1:
+            errors.append(QCoreApplication.translate('LinzRedistrict', 'Electorate has less parts than expected'))
+        return errors
+
+    def run(self):  # pylint: disable=missing-docstring, too-many-locals, too-many-branches
         try:
-            electorate_geometries, electorate_attributes = self.calculate_new_electorates()
+            electorate_attributes = self.calculate_electorate_attributes()
+            part_counts: Dict[int, int] = {}
+            if self.use_meshblock_graph():
+                electorate_errors = {}
+                for electorate_feature_id, attributes in electorate_attributes.items():
+                    part_counts[electorate_feature_id] = self.count_components(attributes[self.MESHBLOCKS])
+                    electorate_errors[electorate_feature_id] = self.electorate_errors(
+                        attributes, part_counts[electorate_feature_id])
+
+                # geometries are only required for reporting invalid electorates
+                electorate_geometries = self.calculate_electorate_geometries(
+                    {electorate_feature_id: attributes for electorate_feature_id, attributes in
+                     electorate_attributes.items() if electorate_errors[electorate_feature_id]})
+            else:
+                electorate_geometries = self.calculate_electorate_geometries(electorate_attributes)
+                electorate_errors = {}
+                for electorate_feature_id, attributes in electorate_attributes.items():
+                    part_counts[electorate_feature_id] = self.geometry_part_count(
+                        electorate_geometries[electorate_feature_id])
+                    electorate_errors[electorate_feature_id] = self.electorate_errors(
+                        attributes, part_counts[electorate_feature_id])
         except CanceledException:
             return False
 
+        non_contiguous_error = QCoreApplication.translate('LinzRedistrict', 'Electorate is non-contiguous')
         attribute_change_map = {}
         for electorate_feature_id, attributes in electorate_attributes.items():
             if self.isCanceled():
                 return False
 
             electorate_id = attributes[self.ELECTORATE_ID]
-            # prefer stats nz pop if available
-            pop = attributes[self.STATS_NZ_POP] if attributes[self.STATS_NZ_POP] is not None and attributes[self.STATS_NZ_POP] != NULL else attributes[self.ESTIMATED_POP]
-            electorate_type = attributes[self.ELECTORATE_TYPE]
-            expected_regions = attributes[self.EXPECTED_REGIONS]
-            deprecated = attributes[self.DEPRECATED]
-
-            quota = self.electorate_registry.get_quota_for_district_type(electorate_type)
-            name = self.electorate_registry.get_district_title(electorate_id)
-            geometry = electorate_geometries[electorate_feature_id]
 
             # clear any existing validation result
             attribute_change_map[electorate_feature_id] = {self.invalid_idx: 0,
                                                            self.invalid_reason_idx: NULL,
                                                            self.scenario_id_idx: self.scenario,
                                                            self.estimated_pop_idx: attributes[self.ESTIMATED_POP]}
-            # quota check
-            if not deprecated and self.electorate_registry.variation_exceeds_allowance(quota=quota, population=pop):
-                error = QCoreApplication.translate('LinzRedistrict', 'Outside quota tolerance')
-                self.results.append({self.ELECTORATE_ID: electorate_id,
-                                     self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
-                                     self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
+            if not electorate_errors[electorate_feature_id]:
+                continue
 
-            # contiguity check
-            if deprecated and not geometry.isEmpty():
-                error = QCoreApplication.translate('LinzRedistrict', 'Deprecated electorate has meshblocks assigned')
-                self.results.append({self.ELECTORATE_ID: electorate_id,
-                                     self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
-                                     self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
-            elif geometry.isMultipart() and geometry.constGet().numGeometries() > expected_regions:
-                error = QCoreApplication.translate('LinzRedistrict', 'Electorate is non-contiguous')
-                self.results.append({self.ELECTORATE_ID: electorate_id,
-                                     self.ELECTORATE_NAME: name,
-                                     self.ELECTORATE_GEOMETRY: geometry,
-                                     self.ERROR: error})
-                attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
-                                                               self.invalid_reason_idx: error}
-                for p in range(geometry.constGet().numGeometries()):
-                    part = QgsGeometry(geometry.constGet().geometryN(p).clone())
-                    error = f'Contiguous part {p + 1}'
-                    self.results.append({self.ELECTORATE_ID: electorate_id,
-                                         self.ELECTORATE_NAME: name,
-                                         self.ELECTORATE_GEOMETRY: part,
-                                         self.ERROR: error})
-            elif not geometry.isMultipart() and expected_regions > 1:
-                error = QCoreApplication.translate('LinzRedistrict', 'Electorate has less parts than expected')
+            name = self.electorate_registry.get_district_title(electorate_id)
+            geometry = electorate_geometries[electorate_feature_id]
+            for error in electorate_errors[electorate_feature_id]:
                 self.results.append({self.ELECTORATE_ID: electorate_id,
                                      self.ELECTORATE_NAME: name,
                                      self.ELECTORATE_GEOMETRY: geometry,
@@ -120,6 +196,14 @@ class ValidationTask(ScenarioBaseTask):
                 attribute_change_map[electorate_feature_id] = {self.invalid_idx: 1,
                                                                self.invalid_reason_idx: error}
 
+                if error == non_contiguous_error and geometry.isMultipart():
+                    for p in range(geometry.constGet().numGeometries()):
+                        part = QgsGeometry(geometry.constGet().geometryN(p).clone())
+                        self.results.append({self.ELECTORATE_ID: electorate_id,
+                                             self.ELECTORATE_NAME: name,
+                                             self.ELECTORATE_GEOMETRY: part,
+                                             self.ERROR: f'Contiguous part {p + 1}'})
+
         if self.isCanceled():
             return False
 
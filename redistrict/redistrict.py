@@ -4,6 +4,7 @@ LINZ Redistricting Plugin
 
 # pylint: disable=too-many-lines,too-many-statements
 
+import hashlib
 import os.path
 from functools import partial
 from typing import (
@@ -29,6 +30,7 @@ from qgis.PyQt.QtGui import (
 from qgis.PyQt.QtWidgets import (
     QToolBar,
     QAction,
+    QCheckBox,
     QMessageBox,
     QToolButton,
     QMenu,
@@ -58,6 +60,8 @@ from qgis.gui import (
     QgsNewNameDialog,
     QgsMapCanvas
 )
+from .core import ProcessPoolDissolver
+from .core.district_boundary_index import DistrictBoundaryIndex
 from .linz.linz_district_registry import (
     LinzElectoralDistrictRegistry)
 from .linz.linz_redistrict_handler import LinzRedistrictHandler
@@ -73,7 +77,12 @@ from .gui.gui_utils import (GuiUtils,
                             ConfirmationDialog)
 from .gui.audio_utils import AudioUtils
 from .gui.district_settings_dialog import (DistrictSettingsDialog,  # pylint: disable=unused-import
-                                           SETTINGS_AUTH_CONFIG_KEY)
+                                           SETTINGS_AUTH_CONFIG_KEY,
+                                           get_dissolve_backend,
+                                           get_use_background_boundaries,
+                                           get_use_graph_validation,
+                                           get_undo_history_memory_limit,
+                                           get_use_scenario_lineage)
 from .linz.interactive_redistrict_decorator import CentroidDecoratorFactory
 from .linz.linz_redistricting_dock_widget import LinzRedistrictingDockWidget
 from .linz.linz_validation_results_dock_widget import LinzValidationResultsDockWidget
@@ -86,6 +95,13 @@ from .linz.deprecate_electorate_dialog import DeprecateElectorateDialog
 from .linz.scenario_switch_task import ScenarioSwitchTask
 from .linz.staged_electorate_update_task import UpdateStagedElectoratesTask
 from .linz.linz_mb_scenario_bridge import LinzMeshblockScenarioBridge
+from .linz.user_log_writer import UserLogWriter
+from .linz.meshblock_store import MeshblockStore
+from .linz.electorate_geometry_cache import ElectorateGeometryCache
+from .linz.meshblock_adjacency_graph import MeshblockAdjacencyGraph
+from .linz.meshblock_graph_task import MeshblockGraphTask
+from .linz.database_index_manager import DatabaseIndexManager
+from .linz.database_index_task import DatabaseIndexTask
 from .linz.validation_task import ValidationTask
 from .linz.export_task import ExportTask
 from .linz.nz_electoral_api import ConcordanceItem, BoundaryRequest, get_api_connector
@@ -93,6 +109,7 @@ from .linz.api_request_queue import ApiRequestQueue
 from .linz.electorate_changes_queue import ElectorateEditQueue
 from .linz.population_dock_widget import SelectedPopulationDockWidget
 from .linz.compare_scenarios_task import CompareScenariosTask
+from .linz.scenario_snapshot import ScenarioSnapshot
 
 
 VERSION = '0.1'
@@ -187,6 +204,13 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.user_log_layer = None
         self.scenario_registry = None
         self.meshblock_scenario_bridge = None
+        self.user_log_writer = None
+        self.meshblock_store = None
+        self.geometry_cache = None
+        self.meshblock_graph = None
+        self.meshblock_graph_task = None
+        self.database_index_task = None
+        self.district_boundary_index = None
         self.db_source = os.path.join(self.plugin_dir,
                                       'db', 'nz_db.gpkg')
         self.electorate_edit_queue = None
@@ -427,6 +451,12 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         import_scenario_action = QAction(self.tr('Import Scenario from Database...'), parent=self.scenarios_menu)
         import_scenario_action.triggered.connect(self.import_scenario)
         self.scenarios_menu.addAction(import_scenario_action)
+        import_snapshot_action = QAction(self.tr('Import Scenario from Snapshot...'), parent=self.scenarios_menu)
+        import_snapshot_action.triggered.connect(self.import_scenario_snapshot)
+        self.scenarios_menu.addAction(import_snapshot_action)
+        export_snapshot_action = QAction(self.tr('Export Scenario to Snapshot...'), parent=self.scenarios_menu)
+        export_snapshot_action.triggered.connect(self.export_scenario_snapshot)
+        self.scenarios_menu.addAction(export_snapshot_action)
 
         compare_scenarios_action = QAction(self.tr('Compare Scenarios...'), parent=self.scenarios_menu)
         compare_scenarios_action.triggered.connect(self.compare_scenarios)
@@ -463,6 +493,19 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         load_meshblocks_action = QAction(self.tr('Load New Meshblocks...'), parent=self.database_menu)
         load_meshblocks_action.triggered.connect(self.load_meshblocks)
         self.database_menu.addAction(load_meshblocks_action)
+        clear_geometry_cache_action = QAction(self.tr('Clear Geometry Cache'), parent=self.database_menu)
+        clear_geometry_cache_action.triggered.connect(self.clear_geometry_cache)
+        self.database_menu.addAction(clear_geometry_cache_action)
+        check_indexes_action = QAction(self.tr('Create Missing Indexes...'), parent=self.database_menu)
+        check_indexes_action.triggered.connect(partial(self.check_database_indexes, True))
+        self.database_menu.addAction(check_indexes_action)
+        self.database_menu.addSeparator()
+        enable_lineage_action = QAction(self.tr('Enable Scenario Lineages...'), parent=self.database_menu)
+        enable_lineage_action.triggered.connect(self.enable_scenario_lineages)
+        self.database_menu.addAction(enable_lineage_action)
+        materialize_scenarios_action = QAction(self.tr('Materialize All Scenarios...'), parent=self.database_menu)
+        materialize_scenarios_action.triggered.connect(self.materialize_all_scenarios)
+        self.database_menu.addAction(materialize_scenarios_action)
 
         options_menu.addMenu(self.database_menu)
 
@@ -587,7 +630,18 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.scenario_registry = ScenarioRegistry(source_layer=self.scenario_layer,
                                                   id_field='scenario_id',
                                                   name_field='name',
-                                                  meshblock_electorate_layer=self.meshblock_electorate_layer)
+                                                  meshblock_electorate_layer=self.meshblock_electorate_layer,
+                                                  use_lineage=get_use_scenario_lineage())
+        self.meshblock_store = MeshblockStore(meshblock_layer=self.meshblock_layer,
+                                              meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD)
+        if ElectorateGeometryCache.is_enabled():
+            self.geometry_cache = ElectorateGeometryCache(self.db_source)
+            # cached geometries are invalid as soon as meshblocks change
+            self.meshblock_store.invalidated.connect(self.geometry_cache.clear)
+        self.meshblock_graph = MeshblockAdjacencyGraph(self.db_source, meshblock_layer=self.meshblock_layer)
+        self.meshblock_graph.invalidated.connect(partial(self.build_meshblock_graph, True))
+        self.build_meshblock_graph()
+        self.district_boundary_index = DistrictBoundaryIndex(self.meshblock_layer, 'staged_electorate')
 
         self.context = LinzRedistrictingContext(scenario_registry=self.scenario_registry)
         self.context.task = QgsSettings().value('redistricting/last_task', self.TASK_GN)
@@ -607,10 +661,15 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.meshblock_layer.editingStopped.connect(self.toggle_redistrict_actions)
         self.meshblock_layer.selectionChanged.connect(self.toggle_redistrict_actions)
 
+        # user log entries are kept in memory until the meshblock changes are saved
+        self.user_log_writer = UserLogWriter(self.user_log_layer, buffered=True)
         self.meshblock_scenario_bridge = LinzMeshblockScenarioBridge(meshblock_layer=self.meshblock_layer,
                                                                      meshblock_scenario_layer=self.meshblock_electorate_layer,
-                                                                     meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD)
+                                                                     meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
+                                                                     user_log_writer=self.user_log_writer,
+                                                                     scenario_registry=self.scenario_registry)
         self.meshblock_scenario_bridge.scenario = self.context.scenario
+        self.meshblock_scenario_bridge.save_failed.connect(self.report_failure)
 
         self.create_redistricting_ui()
 
@@ -620,9 +679,15 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.switch_task.progressChanged.connect(self.progress_item.set_progress)
         self.switch_task.taskCompleted.connect(self.progress_item.close)
         self.switch_task.taskCompleted.connect(partial(self.start_editing_action.setEnabled, True))
+        self.switch_task.taskCompleted.connect(self.check_scenario_lineage)
+        # don't interrupt loading with questions about the database
+        self.switch_task.taskCompleted.connect(self.check_database_indexes)
         self.switch_task.taskTerminated.connect(self.progress_item.close)
-        self.electorate_edit_queue = ElectorateEditQueue(electorate_layer=self.electorate_layer,
-                                                         user_log_layer=self.user_log_layer)
+        self.electorate_edit_queue = ElectorateEditQueue(
+            electorate_layer=self.electorate_layer,
+            user_log_layer=self.user_log_layer,
+            history_memory_limit=get_undo_history_memory_limit() * 1024 * 1024,
+            user_log_writer=self.user_log_writer)
 
         self.meshblock_layer.undoStack().indexChanged.connect(
             self.electorate_edit_queue.sync_to_meshblock_undostack_index)
@@ -639,6 +704,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         """Removes the plugin menu item and icon from QGIS GUI."""
 
         self.begin_redistricting(False)
+        ProcessPoolDissolver.shutdown_instance()
 
         if self.redistricting_toolbar is not None:
             self.redistricting_toolbar.deleteLater()
@@ -703,6 +769,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         """
         Open the settings dialog
         """
+        use_lineage = get_use_scenario_lineage()
         dlg = DistrictSettingsDialog()
         dlg.exec_()
 
@@ -710,6 +777,13 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             QgsSettings().value('redistrict/check_every', '30', int, QgsSettings.Plugins))
         AudioUtils.update_settings()
 
+        if self.scenario_registry is not None and get_use_scenario_lineage() != use_lineage:
+            self.scenario_registry.use_lineage = get_use_scenario_lineage()
+            if get_use_scenario_lineage() and not self.scenario_registry.has_lineage_field():
+                self.enable_scenario_lineages()
+            elif not get_use_scenario_lineage() and self.scenario_registry.has_lineages():
+                self.materialize_all_scenarios()
+
     def save_edits(self):
         """Saves pending edits"""
         tools = self.iface.vectorLayerTools()
@@ -774,9 +848,6 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.enable_task_switches(False)
         self.meshblock_scenario_bridge.task = task
-        progress_dialog = BlockingDialog(self.tr('Switch Task'), self.tr('Preparing switch...'))
-        progress_dialog.force_show_and_paint()
-
         task_name = self.context.get_name_for_task(task)
         description = self.tr('Switching to task {}').format(task_name)
 
@@ -785,9 +856,11 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                                        meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                                        scenario_registry=self.scenario_registry,
                                                        scenario=self.context.scenario,
-                                                       task=task)
-        progress_dialog.deleteLater()
+                                                       task=task,
+                                                       meshblock_store=self.meshblock_store)
 
+        # staged electorates are updated directly in the provider, so aren't tracked by the boundary index
+        self.switch_task.taskCompleted.connect(self.district_boundary_index.invalidate)
         self.switch_task.taskCompleted.connect(
             partial(self.task_set, task))
         self.switch_task.taskCompleted.connect(self.refresh_canvases)
@@ -867,7 +940,8 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                         electorate_layer_field='electorate_id',
                                         task=self.context.task,
                                         user_log_layer=self.user_log_layer,
-                                        scenario=self.context.scenario)
+                                        scenario=self.context.scenario,
+                                        background_boundaries=get_use_background_boundaries())
         handler.redistrict_occured.connect(self.refresh_dock_stats)
         handler.operation_ended.connect(self.redistrict_occurred)
         return handler
@@ -977,7 +1051,8 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                                     electorate_layer=self.electorate_layer,
                                                     meshblock_layer=self.meshblock_layer,
                                                     task=self.context.task,
-                                                    quota=quota))
+                                                    quota=quota),
+                                                boundary_index=self.district_boundary_index)
             self.set_current_tool(tool=tool)
             tool.setAction(self.interactive_redistrict_action)
         else:
@@ -1073,13 +1148,18 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         dlg = ScenarioSelectionDialog(scenario_registry=self.scenario_registry, parent=self.iface.mainWindow())
         dlg.set_selected_scenario(self.context.scenario)
         if dlg.exec_():
-            self.switch_scenario(dlg.selected_scenario())
+            self.switch_scenario(dlg.selected_scenario(), incremental=True)
         dlg.deleteLater()
 
-    def switch_scenario(self, scenario: int, title=None, description=None):
+    def switch_scenario(self, scenario: int, title=None, incremental: bool = False,
+                        reuse_cached_geometries: bool = True):
         """
         Switches the current scenario to a new scenario
         :param scenario: new scenario ID
+        :param incremental: if True, only electorates which differ between the current
+        and new scenarios will be rebuilt
+        :param reuse_cached_geometries: if False, all electorate geometries will be
+        recalculated instead of being read from the geometry cache
         """
         if self.is_editing():
             QMessageBox.warning(self.iface.mainWindow(), self.tr('Switch Scenario'),
@@ -1094,33 +1174,29 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         scenario_name = self.scenario_registry.get_scenario_name(scenario)
         task_name = title if title is not None else self.tr('Switching to {}').format(scenario_name)
 
-        if title is None:
-            title = self.tr('Switch Scenario')
-        if description is None:
-            description = self.tr('Preparing switch...')
-
         for canvas in self.iface.mapCanvases():
             canvas.freeze(True)
 
-        progress_dialog = BlockingDialog(title, description)
-        progress_dialog.force_show_and_paint()
-
         self.switch_task = ScenarioSwitchTask(task_name,
                                               electorate_layer=electorate_registry.source_layer,
                                               meshblock_layer=self.meshblock_layer,
                                               meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                               scenario_registry=self.scenario_registry,
-                                              scenario=scenario)
+                                              scenario=scenario,
+                                              meshblock_store=self.meshblock_store,
+                                              geometry_cache=self.geometry_cache,
+                                              current_scenario=self.context.scenario if incremental else None)
+        self.switch_task.dissolve_backend = get_dissolve_backend()
+        self.switch_task.reuse_cached_geometries = reuse_cached_geometries
         self.staged_task = UpdateStagedElectoratesTask(task_name,
                                                        meshblock_layer=self.meshblock_layer,
                                                        meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                                        scenario_registry=self.scenario_registry,
                                                        scenario=scenario,
-                                                       task=self.context.task)
+                                                       task=self.context.task,
+                                                       meshblock_store=self.meshblock_store)
         self.staged_task.addSubTask(self.switch_task, subTaskDependency=QgsTask.ParentDependsOnSubTask)
 
-        progress_dialog.deleteLater()
-
         def reenable_actions():
             """
             Reenables the disabled menu actions
@@ -1132,6 +1208,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.staged_task.taskCompleted.connect(
             partial(self.report_success, self.tr('Successfully switched to “{}”').format(scenario_name)))
         self.staged_task.taskCompleted.connect(reenable_actions)
+        self.staged_task.taskCompleted.connect(self.district_boundary_index.invalidate)
         self.staged_task.taskTerminated.connect(
             partial(self.report_failure, self.tr('Error while switching to “{}”').format(scenario_name)))
         self.staged_task.taskTerminated.connect(reenable_actions)
@@ -1264,6 +1341,68 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
             self.report_success(
                 self.tr('Successfully imported “{}” to “{}”').format(source_scenario_name, new_scenario_name))
 
+    def export_scenario_snapshot(self):
+        """
+        Exports the current scenario to a snapshot file
+        """
+        last_path = QgsSettings().value('redistricting/last_snapshot_path', QDir.homePath())
+        destination, _filter = QFileDialog.getSaveFileName(self.iface.mainWindow(),  # pylint: disable=unused-variable
+                                                           self.tr('Export Scenario to Snapshot'), last_path,
+                                                           filter='Scenario Snapshots (*.rdsnap)')
+        if not destination:
+            return
+
+        QgsSettings().setValue('redistricting/last_snapshot_path', destination)
+
+        self.meshblock_store.ensure_built()
+        result, error = self.scenario_registry.export_scenario_snapshot(
+            scenario_id=self.context.scenario, path=destination,
+            meshblock_numbers=self.meshblock_store.meshblock_numbers)
+        if not result:
+            self.report_failure(error)
+        else:
+            self.report_success(self.tr('Exported “{}” to snapshot').format(
+                self.context.get_name_for_current_scenario()))
+
+    def import_scenario_snapshot(self):
+        """
+        Imports a scenario from a snapshot file
+        """
+        last_path = QgsSettings().value('redistricting/last_snapshot_path', QDir.homePath())
+        source, _filter = QFileDialog.getOpenFileName(self.iface.mainWindow(),  # pylint: disable=unused-variable
+                                                      self.tr('Import Scenario from Snapshot'), last_path,
+                                                      filter='Scenario Snapshots (*.rdsnap)')
+        if not source:
+            return
+
+        QgsSettings().setValue('redistricting/last_snapshot_path', source)
+
+        try:
+            snapshot = ScenarioSnapshot.read(source)
+        except (OSError, ValueError) as e:
+            self.report_failure(self.tr('Could not read snapshot: {}').format(e))
+            return
+        snapshot_name = snapshot.name
+        snapshot.close()
+
+        dlg = self.create_new_scenario_name_dlg(existing_name=None,
+                                                initial_scenario_name=snapshot_name)
+        dlg.setWindowTitle(self.tr('Import Scenario from Snapshot'))
+        dlg.setHintString(self.tr('Enter name for imported scenario'))
+        if not dlg.exec_():
+            return
+
+        self.clear_current_views()
+
+        new_scenario_name = dlg.name()
+        result, error = self.scenario_registry.import_scenario_snapshot(path=source,
+                                                                        new_scenario_name=new_scenario_name)
+        if not result:
+            self.report_failure(error)
+        else:
+            self.report_success(
+                self.tr('Successfully imported “{}” to “{}”').format(snapshot_name, new_scenario_name))
+
     def compare_scenarios(self):
         """
         Allows user to compare two scenarios
@@ -1488,6 +1627,16 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         self.scenario_registry = None
         self.context = None
         self.meshblock_scenario_bridge = None
+        if self.user_log_writer is not None:
+            # entries for unsaved changes must never be written
+            self.user_log_writer.discard()
+        self.user_log_writer = None
+        self.meshblock_store = None
+        self.geometry_cache = None
+        self.meshblock_graph = None
+        self.meshblock_graph_task = None
+        self.database_index_task = None
+        self.district_boundary_index = None
         self.scenarios_menu = None
         self.electorate_menu = None
         self.database_menu = None
@@ -1582,6 +1731,168 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         """
         return self.meshblock_layer.source().split('|')[0]
 
+    def build_meshblock_graph(self, rebuild: bool = False):
+        """
+        Loads or builds the meshblock adjacency graph in a background task
+        :param rebuild: if True, the graph will be rebuilt from the meshblock geometries
+        """
+        self.meshblock_graph_task = MeshblockGraphTask(self.tr('Building meshblock adjacency'),
+                                                       meshblock_layer=self.meshblock_layer,
+                                                       meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
+                                                       meshblock_graph=self.meshblock_graph,
+                                                       rebuild=rebuild)
+        QgsApplication.taskManager().addTask(self.meshblock_graph_task)
+
+    def skip_index_check_setting_key(self) -> str:
+        """
+        Returns the settings key used to skip the missing index check for the current database
+        """
+        return f'redistrict/skip_index_check/{hashlib.sha1(self.db_source.encode("utf-8")).hexdigest()}'
+
+    def check_database_indexes(self, force: bool = False):
+        """
+        Checks for missing attribute indexes in the database, and offers to create
+        them in a background task
+        :param force: if True, the check is made even if the user has chosen to skip
+        the check for the current database
+        """
+        if not self.is_redistricting or self.db_source is None or self.database_index_task is not None:
+            return
+        if not force and QgsSettings().value(self.skip_index_check_setting_key(), False, bool, QgsSettings.Plugins):
+            return
+
+        meshblock_electorate_table = ScenarioRegistry.geopackage_table(self.meshblock_electorate_layer)
+        electorate_table = ScenarioRegistry.geopackage_table(self.electorate_layer)
+        if meshblock_electorate_table is None or electorate_table is None:
+            return
+
+        index_manager = DatabaseIndexManager(self.db_source,
+                                             meshblock_electorate_table=meshblock_electorate_table[1],
+                                             electorate_table=electorate_table[1])
+        missing = index_manager.missing_indexes()
+        if not missing:
+            if force:
+                self.report_info(self.tr('No database indexes are missing'))
+            return
+
+        message_box = QMessageBox(QMessageBox.Question,
+                                  self.tr('Missing Database Indexes'),
+                                  self.tr(
+                                      'The database is missing {} indexes which are required for fast scenario and electorate queries.\n\nCreate the missing indexes now?'
+                                  ).format(len(missing)),
+                                  QMessageBox.Yes | QMessageBox.No,
+                                  self.iface.mainWindow())
+        message_box.setDefaultButton(QMessageBox.Yes)
+        dont_ask_check_box = QCheckBox(self.tr('Don’t ask again for this database'))
+        message_box.setCheckBox(dont_ask_check_box)
+        result = message_box.exec_()
+        if dont_ask_check_box.isChecked():
+            QgsSettings().setValue(self.skip_index_check_setting_key(), True, QgsSettings.Plugins)
+        if result != QMessageBox.Yes:
+            return
+
+        self.database_index_task = DatabaseIndexTask(self.tr('Creating database indexes'),
+                                                     index_manager=index_manager,
+                                                     indexes=missing)
+        self.database_index_task.taskCompleted.connect(self.database_indexes_created)
+        self.database_index_task.taskTerminated.connect(self.database_indexes_failed)
+        QgsApplication.taskManager().addTask(self.database_index_task)
+
+    def database_indexes_created(self):
+        """
+        Triggered when the missing database indexes have been created
+        """
+        self.report_success(self.tr('Created database indexes ({})').format(
+            self.database_index_task.timing_summary()))
+        self.database_index_task = None
+
+    def database_indexes_failed(self):
+        """
+        Triggered when the missing database indexes could not be created
+        """
+        self.report_failure(self.tr('Could not create database indexes'))
+        self.database_index_task = None
+
+    def check_scenario_lineage(self):
+        """
+        Checks whether the database matches the scenario lineage setting, and
+        suggests the required database action if not
+        """
+        if not self.is_redistricting or self.scenario_registry is None:
+            return
+
+        if get_use_scenario_lineage() and not self.scenario_registry.has_lineage_field():
+            self.report_info(self.tr(
+                'Branched scenarios will be stored as full copies until scenario lineages are enabled for this database (Database → Enable Scenario Lineages...)'))
+        elif not get_use_scenario_lineage() and self.scenario_registry.has_lineages():
+            self.report_info(self.tr(
+                'Some scenarios are still stored as changes from their parent scenario. Use Database → Materialize All Scenarios... to store full copies of these scenarios.'))
+
+    def enable_scenario_lineages(self):
+        """
+        Enables storing branched scenarios as changes from their parent scenario, after
+        confirming the required change to the scenarios table with the user
+        """
+        if not self.scenario_registry.has_lineage_field():
+            if QMessageBox.question(self.iface.mainWindow(),
+                                    self.tr('Enable Scenario Lineages'),
+                                    self.tr(
+                                        'Storing branched scenarios as changes from their parent scenario requires adding a “{}” field to the scenarios table of this database. This change is permanent.\n\nOther tools reading the meshblock_electorates table directly will see incomplete meshblocks for branched scenarios.\n\nAdd the field now?'
+                                    ).format(ScenarioRegistry.PARENT_SCENARIO_ID_FIELD_NAME),
+                                    QMessageBox.Yes | QMessageBox.No,
+                                    QMessageBox.No) != QMessageBox.Yes:
+                return
+
+            if not self.scenario_registry.add_lineage_field():
+                self.report_failure(self.tr('Could not add the parent scenario field to the scenarios table'))
+                return
+
+        QgsSettings().setValue('redistrict/scenario_lineage', True, QgsSettings.Plugins)
+        self.scenario_registry.use_lineage = True
+        self.report_success(self.tr('Enabled scenario lineages'))
+
+    def materialize_all_scenarios(self):
+        """
+        Stores a full copy of the meshblocks for every scenario which currently inherits
+        meshblocks from a parent scenario, and disables scenario lineages
+        """
+        if self.meshblock_layer.editBuffer() is not None and self.meshblock_layer.editBuffer().isModified():
+            self.report_failure(self.tr(
+                'Cannot materialize scenarios while unsaved changes are present. Save or cancel the current edits and try again.'))
+            return
+
+        if QMessageBox.question(self.iface.mainWindow(),
+                                self.tr('Materialize All Scenarios'),
+                                self.tr(
+                                    'Copy all inherited meshblocks to each branched scenario, and store future branches as full copies?'),
+                                QMessageBox.Yes | QMessageBox.No,
+                                QMessageBox.Yes) != QMessageBox.Yes:
+            return
+
+        progress_dialog = BlockingDialog(self.tr('Materialize All Scenarios'), self.tr('Materializing scenarios...'))
+        progress_dialog.force_show_and_paint()
+        success = self.scenario_registry.materialize_all_scenarios()
+        self.meshblock_scenario_bridge.invalidate()
+        if not success:
+            self.report_failure(self.tr('Could not materialize all scenarios'))
+            return
+
+        QgsSettings().setValue('redistrict/scenario_lineage', False, QgsSettings.Plugins)
+        self.scenario_registry.use_lineage = False
+        self.report_success(self.tr('Materialized all scenarios'))
+
+    def clear_geometry_cache(self):
+        """
+        Clears the cache of calculated electorate geometries
+        """
+        if self.geometry_cache is None:
+            ElectorateGeometryCache(self.db_source).clear()
+        elif not self.geometry_cache.clear():
+            self.report_failure(self.tr('Could not clear the geometry cache'))
+            return
+
+        self.report_success(self.tr('Cleared geometry cache'))
+
     def import_master_database(self):
         """
         Imports a new master database, replacing the current database
@@ -1708,17 +2019,17 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.validation_results_dock.clear()
 
-        progress_dialog = BlockingDialog(self.tr('Validating Electorates'), self.tr('Preparing validation...'))
-        progress_dialog.force_show_and_paint()
-
         self.validation_task = ValidationTask(task_name,
                                               electorate_registry=electorate_registry,
                                               meshblock_layer=self.meshblock_layer,
                                               meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                               scenario_registry=self.scenario_registry,
                                               scenario=self.context.scenario,
-                                              task=self.context.task)
-        progress_dialog.deleteLater()
+                                              task=self.context.task,
+                                              meshblock_store=self.meshblock_store,
+                                              geometry_cache=self.geometry_cache,
+                                              meshblock_graph=self.meshblock_graph if get_use_graph_validation() else None)
+        self.validation_task.dissolve_backend = get_dissolve_backend()
         # refresh views, in case any are showing invalid electorates view
         self.refresh_canvases()
 
@@ -1768,7 +2079,7 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         self.clear_current_views()
         self.switch_scenario(self.context.scenario, title=self.tr('Rebuild Electorates'),
-                             description=self.tr('Preparing rebuild...'))
+                             reuse_cached_geometries=False)
 
     def export_electorates(self):
         """
@@ -1796,15 +2107,15 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
         electorate_registry = self.get_district_registry()
         task_name = self.tr('Exporting Electorates')
 
-        progress_dialog = BlockingDialog(self.tr('Exporting Electorates'), self.tr('Preparing export...'))
-        progress_dialog.force_show_and_paint()
-
         self.export_task = ExportTask(task_name=task_name, dest_file=destination,
                                       electorate_registry=electorate_registry,
                                       meshblock_layer=self.meshblock_layer,
                                       meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
                                       scenario_registry=self.scenario_registry,
-                                      scenario=self.context.scenario, user_log_layer=self.user_log_layer)
+                                      scenario=self.context.scenario, user_log_layer=self.user_log_layer,
+                                      meshblock_store=self.meshblock_store,
+                                      geometry_cache=self.geometry_cache)
+        self.export_task.dissolve_backend = get_dissolve_backend()
 
         self.export_task.taskCompleted.connect(self.__export_complete)
         self.export_task.taskTerminated.connect(self.__export_failed)
@@ -1967,6 +2278,19 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
                                      len(errors), errors[0]))
             return
 
+        # cached electorate geometries and populations were calculated from the previous meshblocks
+        ElectorateGeometryCache(prev_source).clear()
+
+        # the previous adjacency graph is no longer valid, so build a new one from the new meshblocks
+        meshblock_graph = MeshblockAdjacencyGraph(prev_source)
+        meshblock_graph.clear()
+        self.meshblock_graph_task = MeshblockGraphTask(self.tr('Building meshblock adjacency'),
+                                                       meshblock_layer=dest_layer,
+                                                       meshblock_number_field_name=self.MESHBLOCK_NUMBER_FIELD,
+                                                       meshblock_graph=meshblock_graph,
+                                                       rebuild=True)
+        QgsApplication.taskManager().addTask(self.meshblock_graph_task)
+
         QMessageBox.warning(self.iface.mainWindow(), self.tr('Load New Meshblocks'),
                             self.tr(
                                 'Please run a full scenario rebuild after re-loading the plugin'))
@@ -2031,15 +2355,15 @@ class LinzRedistrict(QObject):  # pylint: disable=too-many-public-methods
 
         electorate_ids = [f['electorate_id'] for f in self.electorate_layer.getFeatures() if
                           f['type'] == self.context.task]
+        # resolve the scenario once for all electorates
+        electorate_meshblocks = self.scenario_registry.scenario_electorate_meshblock_numbers(
+            scenario_id=self.context.scenario, electorate_type=self.context.task)
         concordance = []
         for electorate_id in electorate_ids:
             district_registry.flag_stats_nz_updating(electorate_id)
-            electorate_meshblocks = self.scenario_registry.electorate_meshblocks(electorate_id=electorate_id,
-                                                                                 electorate_type=self.context.task,
-                                                                                 scenario_id=self.context.scenario)
             concordance.extend(
-                [ConcordanceItem(str(m['meshblock_number']), str(electorate_id), self.context.task) for m in
-                 electorate_meshblocks])
+                [ConcordanceItem(str(meshblock_number), str(electorate_id), self.context.task) for meshblock_number in
+                 electorate_meshblocks.get(ScenarioRegistry.electorate_key(electorate_id), [])])
 
         self.refresh_dock_stats()
 
@@ -2,6 +2,8 @@
 Compare scenarios task test.
 """
 
+import os
+import tempfile
 import unittest
 
 from qgis._core import QgsGeometry
@@ -11,6 +13,7 @@ from qgis.core import (
 )
 from redistrict.linz.scenario_registry import ScenarioRegistry
 from redistrict.linz.compare_scenarios_task import CompareScenariosTask
+from redistrict.linz.scenario_snapshot import ScenarioSnapshot
 from redistrict.test.test_linz_scenario_registry import (
     make_scenario_layer
 )
@@ -90,6 +93,32 @@ class CompareScenariosTaskTest(unittest.TestCase):
         self.assertCountEqual([f.geometry().asWkt() for f in task.changed_meshblocks_layer.getFeatures()],
                               ['Polygon ((0 0, 1 0, 1 1, 0 1, 0 0))', 'Polygon ((1 0, 2 0, 2 1, 1 1, 1 0))'])
 
+        # compare snapshots
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshots = []
+            for scenario_id in (1, 3):
+                path = os.path.join(temp_dir, f'{scenario_id}.rdsnap')
+                self.assertTrue(reg.export_scenario_snapshot(scenario_id, path, meshblock_numbers=[11, 12, 13])[0])
+                snapshots.append(ScenarioSnapshot.read(path))
+
+            task = CompareScenariosTask('', reg, meshblock_layer, 'meshblock_number', 'GN', None, None,
+                                        base_snapshot=snapshots[0], secondary_snapshot=snapshots[1])
+            self.assertTrue(task.run())
+            self.assertEqual(task.base_electorates, {11: 1, 12: 3})
+            self.assertEqual(task.secondary_electorates, {11: 2, 12: 9})
+            self.assertEqual(task.changed_meshblocks, {11, 12})
+            self.assertCountEqual([f.attributes() for f in task.changed_meshblocks_layer.getFeatures()],
+                                  [['0000011', 'GN01', 'GN02'], ['0000012', 'GN03', 'GN09']])
+
+            # snapshot compared with a registry scenario
+            task = CompareScenariosTask('', reg, meshblock_layer, 'meshblock_number', 'GN', None, 2,
+                                        base_snapshot=snapshots[0])
+            self.assertTrue(task.run())
+            self.assertFalse(task.changed_meshblocks)
+
+            for snapshot in snapshots:
+                snapshot.close()
+
         task = CompareScenariosTask('', reg, meshblock_layer, 'meshblock_number', 'GN', 2, 3)
         self.assertTrue(task.run())
         self.assertEqual(task.base_electorates, {11: 1, 12: 3})
@@ -0,0 +1,194 @@
+"""
+District Boundary Index Test.
+"""
+
+import time
+import unittest
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+    QgsFeature,
+    QgsPointXY,
+    QgsRectangle,
+    QgsGeometry
+)
+from redistrict.core.district_boundary_index import (
+    DistrictBoundaries,
+    DistrictBoundaryIndex
+)
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def make_layer():
+    """
+    Makes a layer of target features for testing
+    """
+    layer = QgsVectorLayer("Polygon?crs=epsg:4326&field=fldtxt:string",
+                           "layer", "memory")
+    features = []
+    for x, district in ((0, 'a'), (5, 'a'), (10, 'b'), (15, 'b')):
+        f = QgsFeature()
+        f.setAttributes([district])
+        f.setGeometry(QgsGeometry.fromRect(QgsRectangle(x, 0, x + 5, 5)))
+        features.append(f)
+    success, features = layer.dataProvider().addFeatures(features)
+    assert success
+    return layer, [f.id() for f in features]
+
+
+class DistrictBoundaryIndexTest(unittest.TestCase):
+    """Test DistrictBoundaryIndex."""
+
+    def testBuild(self):
+        """
+        Test building the index
+        """
+        layer, (f1, f2, f3, f4) = make_layer()
+        index = DistrictBoundaryIndex(layer, 'fldtxt')
+        self.assertFalse(index.is_built())
+        index.build()
+        self.assertTrue(index.is_built())
+        self.assertEqual(index.boundary_count(), 1)
+
+        self.assertEqual(index.district(f1), 'a')
+        self.assertEqual(index.district(f4), 'b')
+        self.assertIsNone(index.district(-1))
+        self.assertCountEqual(index.features_near(QgsPointXY(7, 2), 0.5), [f2])
+        self.assertCountEqual(index.features_near(QgsPointXY(5, 2), 0.5), [f1, f2])
+
+        # not a district boundary
+        self.assertFalse(index.boundary_matches(QgsPointXY(5, 2), 0.5))
+        self.assertFalse(index.boundary_matches(QgsPointXY(12, 2), 0.5))
+
+        matches = index.boundary_matches(QgsPointXY(10.2, 2), 0.5)
+        self.assertCountEqual([m[0] for m in matches], [f2, f3])
+        self.assertAlmostEqual(matches[0][1], 0.2, 5)
+        self.assertEqual(matches[0][2], QgsPointXY(10, 2))
+        self.assertFalse(index.boundary_matches(QgsPointXY(10.2, 2), 0.1))
+
+    def testBuildFromSource(self):
+        """
+        Test building boundaries from a feature source
+        """
+        layer, (f1, f2, f3, _) = make_layer()
+        boundaries = DistrictBoundaries.from_source(QgsVectorLayerFeatureSource(layer), 0)
+        self.assertEqual(len(boundaries.boundaries), 1)
+        self.assertEqual(boundaries.districts[f1], 'a')
+        self.assertCountEqual(boundaries.feature_boundaries[f2], boundaries.feature_boundaries[f3])
+
+        # canceled
+        self.assertIsNone(DistrictBoundaries.from_source(layer, 0, is_canceled=lambda: True))
+
+    def testBackgroundBuild(self):
+        """
+        Test building the index in a background task
+        """
+        layer, (f1, f2, f3, _) = make_layer()
+        index = DistrictBoundaryIndex(layer, 'fldtxt')
+
+        # lookups start a build, and fall back to the layer until it completes
+        self.assertFalse(index.boundary_matches(QgsPointXY(10, 2), 0.5))
+        self.assertTrue(index.is_building())
+        self.assertEqual(index.district(f1), 'a')
+        self.assertCountEqual(index.features_near(QgsPointXY(7, 2), 0.5), [f2])
+
+        # changes made during the build are applied once it completes
+        layer.startEditing()
+        self.assertTrue(layer.changeAttributeValue(f2, 0, 'c'))
+
+        timeout = time.time() + 10
+        while index.is_building() and time.time() < timeout:
+            QCoreApplication.processEvents()
+        self.assertTrue(index.is_built())
+        self.assertEqual(index.district(f2), 'c')
+        self.assertEqual(index.boundary_count(), 2)
+        self.assertCountEqual([m[0] for m in index.boundary_matches(QgsPointXY(10, 2), 0.5)], [f2, f3])
+        layer.rollBack()
+
+    def testIncrementalUpdate(self):
+        """
+        Test that the index is updated when districts are changed
+        """
+        layer, (f1, f2, f3, _) = make_layer()
+        index = DistrictBoundaryIndex(layer, 'fldtxt')
+        index.build()
+        self.assertEqual(index.boundary_count(), 1)
+
+        layer.startEditing()
+        self.assertTrue(layer.changeAttributeValue(f2, 0, 'b'))
+        self.assertEqual(index.district(f2), 'b')
+        self.assertEqual(index.boundary_count(), 1)
+        self.assertCountEqual([m[0] for m in index.boundary_matches(QgsPointXY(5, 2), 0.5)], [f1, f2])
+        self.assertFalse(index.boundary_matches(QgsPointXY(10, 2), 0.5))
+
+        self.assertTrue(layer.changeAttributeValue(f2, 0, 'c'))
+        self.assertEqual(index.boundary_count(), 2)
+        self.assertCountEqual([m[0] for m in index.boundary_matches(QgsPointXY(10, 2), 0.5)], [f2, f3])
+
+        # undone changes are also tracked
+        layer.undoStack().undo()
+        self.assertEqual(index.district(f2), 'b')
+        self.assertEqual(index.boundary_count(), 1)
+
+        layer.rollBack()
+        self.assertEqual(index.district(f2), 'a')
+        self.assertCountEqual([m[0] for m in index.boundary_matches(QgsPointXY(10, 2), 0.5)], [f2, f3])
+
+    def testGeometryChanges(self):
+        """
+        Test that the index is updated when features are added, deleted or have their geometry changed
+        """
+        layer, (_, f2, f3, _) = make_layer()
+        index = DistrictBoundaryIndex(layer, 'fldtxt')
+        index.build()
+        self.assertEqual(index.boundary_count(), 1)
+
+        layer.startEditing()
+        # move f2 away from f3
+        self.assertTrue(layer.changeGeometry(f2, QgsGeometry.fromRect(QgsRectangle(5, 0, 9, 5))))
+        self.assertTrue(index.is_built())
+        self.assertEqual(index.boundary_count(), 0)
+        self.assertCountEqual(index.features_near(QgsPointXY(9.7, 2), 0.5), [f3])
+
+        self.assertTrue(layer.changeGeometry(f2, QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5))))
+        self.assertEqual(index.boundary_count(), 1)
+
+        f = QgsFeature(layer.fields())
+        f.setAttributes(['c'])
+        f.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 5, 20, 10)))
+        self.assertTrue(layer.addFeature(f))
+        self.assertEqual(index.boundary_count(), 5)
+        self.assertEqual(index.district(f.id()), 'c')
+
+        self.assertTrue(layer.deleteFeature(f.id()))
+        self.assertIsNone(index.district(f.id()))
+        self.assertEqual(index.boundary_count(), 1)
+        self.assertTrue(index.is_built())
+        layer.rollBack()
+
+    def testInvalidate(self):
+        """
+        Test invalidating the index
+        """
+        layer, (_, f2, _, _) = make_layer()
+        index = DistrictBoundaryIndex(layer, 'fldtxt')
+        index.build()
+        self.assertEqual(index.boundary_count(), 1)
+
+        # provider changes aren't tracked
+        layer.dataProvider().changeAttributeValues({f2: {0: 'c'}})
+        self.assertEqual(index.boundary_count(), 1)
+        index.invalidate()
+        self.assertFalse(index.is_built())
+        index.build()
+        self.assertEqual(index.boundary_count(), 2)
+        self.assertEqual(index.district(f2), 'c')
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DistrictBoundaryIndexTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -83,22 +83,28 @@ class InteractiveRedistrictTest(unittest.TestCase):
         self.assertFalse(tool.get_districts_from_matches([]))
         self.assertFalse(tool.matches_are_valid_for_boundary([]))
 
-        # point directly on boundary
+        # point directly on boundary - not a district boundary, both features have same district!
+        self.assertFalse(tool.get_district_boundary_matches(QgsPointXY(15, 30)))
+        self.assertFalse(tool.get_district_boundary_matches(QgsPointXY(15.1, 30)))
+
+        # district boundaries are updated as features are redistricted
+        layer.startEditing()
+        self.assertTrue(handler.assign_district([f2.id()], 'c'))
         matches = tool.get_district_boundary_matches(QgsPointXY(15, 30))
         self.assertTrue(matches)
         self.assertCountEqual([match.featureId() for match in matches], [f.id(), f2.id()])
         self.assertCountEqual([f.id() for f in tool.get_target_features_from_matches(matches)], [f.id(), f2.id()])
-        self.assertCountEqual(tool.get_districts_from_matches(matches), ['a'])
-        # not a valid boundary match - both features have same district!
-        self.assertFalse(tool.matches_are_valid_for_boundary(matches))
+        self.assertCountEqual(tool.get_districts_from_matches(matches), ['a', 'c'])
+        self.assertTrue(tool.matches_are_valid_for_boundary(matches))
 
         # point just offset from boundary
         matches = tool.get_district_boundary_matches(QgsPointXY(15.1, 30))
-        self.assertTrue(matches)
         self.assertCountEqual([match.featureId() for match in matches], [f.id(), f2.id()])
-        self.assertCountEqual([f.id() for f in tool.get_target_features_from_matches(matches)], [f.id(), f2.id()])
-        self.assertCountEqual(tool.get_districts_from_matches(matches), ['a'])
-        self.assertFalse(tool.matches_are_valid_for_boundary(matches))
+        self.assertEqual(matches[0].point(), QgsPointXY(15, 30))
+        self.assertAlmostEqual(matches[0].distance(), 0.1, 5)
+        self.assertTrue(tool.matches_are_valid_for_boundary(matches))
+        layer.rollBack()
+        self.assertFalse(tool.get_district_boundary_matches(QgsPointXY(15, 30)))
 
         # unique matches only
         matches = tool.get_district_boundary_matches(QgsPointXY(18, 30))
@@ -157,6 +163,59 @@ class InteractiveRedistrictTest(unittest.TestCase):
         self.assertCountEqual(tool.get_districts_from_matches([match]), ['b'])
         self.assertFalse(tool.matches_are_valid_for_boundary([match]))
 
+    def testFeatureCache(self):
+        """
+        Test caching target features during an operation
+        """
+        canvas = QgsMapCanvas()
+        canvas.setDestinationCrs(QgsCoordinateReferenceSystem(4326))
+        canvas.setFrameStyle(0)
+        canvas.resize(600, 400)
+
+        layer = QgsVectorLayer("Polygon?crs=epsg:4326&field=fldtxt:string",
+                               "layer", "memory")
+        f = QgsFeature()
+        f.setAttributes(['a'])
+        f.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 25, 15, 45)))
+        f2 = QgsFeature()
+        f2.setAttributes(['b'])
+        f2.setGeometry(QgsGeometry.fromRect(QgsRectangle(15, 25, 18, 45)))
+        success, (f, f2) = layer.dataProvider().addFeatures([f, f2])
+        self.assertTrue(success)
+
+        canvas.setLayers([layer])
+        canvas.setExtent(QgsRectangle(10, 30, 20, 35))
+        canvas.show()
+
+        handler = RedistrictHandler(layer, 'fldtxt')
+        registry = DistrictRegistry(districts=['a', 'b'])
+        tool = InteractiveRedistrictingTool(canvas, handler, district_registry=registry)
+        self.assertFalse(tool.get_cached_targets([QgsPointLocator.Match()]))
+        self.assertFalse(tool.feature_cache)
+
+        match = tool.get_district_area_match(QgsPointXY(10, 30))
+        match2 = tool.get_district_area_match(QgsPointXY(16, 30))
+        targets = tool.get_cached_targets([match, match2])
+        self.assertCountEqual(targets.keys(), [f.id(), f2.id()])
+        self.assertEqual(targets[f.id()][0], 'a')
+        self.assertEqual(targets[f2.id()][0], 'b')
+        self.assertTrue(targets[f.id()][2].intersects(QgsGeometry.fromPointXY(QgsPointXY(10, 30)).constGet()))
+        self.assertFalse(targets[f.id()][2].intersects(QgsGeometry.fromPointXY(QgsPointXY(16, 30)).constGet()))
+        self.assertCountEqual(tool.feature_cache.keys(), [f.id(), f2.id()])
+
+        # districts are read from the cache while an operation is active
+        tool.is_active = True
+        layer.startEditing()
+        layer.changeAttributeValue(f.id(), 0, 'b')
+        self.assertCountEqual(tool.get_districts_from_matches([match]), ['a'])
+
+        # cache is invalidated when the operation ends
+        handler.begin_operation()
+        tool.finalize_operation()
+        self.assertFalse(tool.feature_cache)
+        self.assertCountEqual(tool.get_districts_from_matches([match]), ['b'])
+        layer.rollBack()
+
     def testInteraction(self):  # pylint: disable=too-many-statements
         """
         Test tool interaction
@@ -0,0 +1,106 @@
+"""
+LINZ Database Index Manager test.
+"""
+
+from contextlib import closing
+import os
+import sqlite3
+import tempfile
+import unittest
+from redistrict.linz.database_index_manager import DatabaseIndexManager
+from redistrict.linz.database_index_task import DatabaseIndexTask
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class DatabaseIndexManagerTest(unittest.TestCase):
+    """Test DatabaseIndexManager."""
+
+    def setUp(self):
+        """
+        Creates a temporary database for each test
+        """
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.database = os.path.join(self.temp_dir.name, 'test.gpkg')
+        with closing(sqlite3.connect(self.database)) as connection:
+            connection.execute('CREATE TABLE meshblock_electorates (fid INTEGER PRIMARY KEY, scenario_id INTEGER, '
+                               'meshblock_number INTEGER, gn_id INTEGER, gs_id INTEGER, m_id INTEGER)')
+            connection.execute('CREATE TABLE electorates (fid INTEGER PRIMARY KEY, electorate_id INTEGER, type TEXT)')
+            connection.executemany('INSERT INTO meshblock_electorates '
+                                   '(scenario_id, meshblock_number, gn_id, gs_id, m_id) VALUES (?, ?, ?, ?, ?)',
+                                   [(s, mb, mb % 3, mb % 2, 1) for s in (1, 2) for mb in range(20)])
+            connection.executemany('INSERT INTO electorates (electorate_id, type) VALUES (?, ?)',
+                                   [(0, 'GN'), (1, 'GN'), (2, 'GN'), (3, 'GS'), (4, 'M')])
+            connection.commit()
+
+    def tearDown(self):
+        """
+        Removes temporary database
+        """
+        self.temp_dir.cleanup()
+
+    def testMissingIndexes(self):
+        """
+        Test checking for missing indexes
+        """
+        manager = DatabaseIndexManager(self.database)
+        self.assertCountEqual([columns for _, _, columns in manager.missing_indexes()],
+                              [('scenario_id', 'gn_id'), ('scenario_id', 'gs_id'), ('scenario_id', 'm_id'),
+                               ('scenario_id', 'meshblock_number'), ('type', 'electorate_id'), ('electorate_id',)])
+
+        # existing indexes with different names, and indexes with additional trailing columns, are used
+        with closing(sqlite3.connect(self.database)) as connection:
+            connection.execute('CREATE INDEX my_index ON meshblock_electorates (scenario_id, gn_id, meshblock_number)')
+            connection.execute('CREATE INDEX my_index2 ON electorates (electorate_id)')
+            # wrong column order
+            connection.execute('CREATE INDEX my_index3 ON meshblock_electorates (gs_id, scenario_id)')
+            connection.commit()
+        self.assertCountEqual([columns for _, _, columns in manager.missing_indexes()],
+                              [('scenario_id', 'gs_id'), ('scenario_id', 'm_id'),
+                               ('scenario_id', 'meshblock_number'), ('type', 'electorate_id')])
+
+        # tables without the indexed columns are skipped
+        manager = DatabaseIndexManager(self.database, electorate_table='missing')
+        self.assertCountEqual([table for _, table, _ in manager.missing_indexes()],
+                              ['meshblock_electorates'] * 3)
+
+    def testCreateIndexes(self):
+        """
+        Test creating indexes
+        """
+        manager = DatabaseIndexManager(self.database)
+        self.assertTrue(manager.create_indexes(manager.missing_indexes()))
+        self.assertFalse(manager.missing_indexes())
+        # creating again is harmless
+        self.assertTrue(manager.create_indexes(manager.required_indexes()))
+
+        self.assertFalse(DatabaseIndexManager(os.path.join(self.temp_dir.name, 'missing', 'x.gpkg')).create_indexes(
+            manager.required_indexes()))
+
+    def testTimeQueries(self):
+        """
+        Test timing representative queries
+        """
+        manager = DatabaseIndexManager(self.database)
+        timings = manager.time_queries()
+        self.assertCountEqual(timings.keys(), ['meshblock_electorates.gn_id', 'meshblock_electorates.gs_id',
+                                               'meshblock_electorates.m_id', 'electorates.electorate_id'])
+        self.assertTrue(all(t >= 0 for t in timings.values()))
+
+    def testTask(self):
+        """
+        Test creating indexes in a task
+        """
+        manager = DatabaseIndexManager(self.database)
+        task = DatabaseIndexTask('index', index_manager=manager, indexes=manager.missing_indexes())
+        self.assertTrue(task.run())
+        self.assertFalse(manager.missing_indexes())
+        self.assertCountEqual(task.timings_after.keys(), task.timings_before.keys())
+        self.assertIn('electorates.electorate_id', task.timing_summary())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DatabaseIndexManagerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
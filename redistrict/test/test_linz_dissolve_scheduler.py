@@ -0,0 +1,82 @@
+"""
+LINZ Dissolve Scheduler Test.
+"""
+
+import unittest
+from concurrent.futures import Future
+from qgis.core import (QgsGeometry,
+                       QgsRectangle)
+from redistrict.core import CoreUtils
+from redistrict.linz.dissolve_scheduler import DissolveScheduler
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class DissolveSchedulerTest(unittest.TestCase):
+    """Test DissolveScheduler."""
+
+    def setUp(self):
+        """
+        Prepares a synchronous submission function for tests
+        """
+        self.submitted = []
+
+        def submit(geometries):
+            self.submitted.append(len(geometries))
+            future = Future()
+            future.set_result(CoreUtils.union_geometries(geometries) if geometries else QgsGeometry())
+            return future
+
+        self.submit = submit
+
+    def testChunks(self):
+        """
+        Test splitting geometries into chunks
+        """
+        scheduler = DissolveScheduler(self.submit, chunk_size=2)
+        geometries = [QgsGeometry.fromRect(QgsRectangle(x, 0, x + 1, 1)) for x in (4, 0, 3, 1, 2)]
+        chunks = scheduler.chunks(geometries)
+        self.assertEqual([len(c) for c in chunks], [2, 2, 1])
+        # chunks should be spatially sorted
+        self.assertEqual([[g.boundingBox().xMinimum() for g in c] for c in chunks], [[0, 1], [2, 3], [4]])
+
+        scheduler = DissolveScheduler(self.submit, chunk_size=10)
+        self.assertEqual([len(c) for c in scheduler.chunks(geometries)], [5])
+
+    def testRun(self):
+        """
+        Test running jobs with reduction of chunks
+        """
+        scheduler = DissolveScheduler(self.submit, chunk_size=2)
+        scheduler.add_job(1, [QgsGeometry.fromRect(QgsRectangle(x, 0, x + 1, 1)) for x in range(5)])
+        scheduler.add_job(2, [QgsGeometry.fromRect(QgsRectangle(0, 5, 1, 6))])
+        scheduler.add_job(3, [])
+
+        finished = []
+        results = scheduler.run(is_canceled=lambda: False,
+                                job_finished=lambda job_id, geometry: finished.append(job_id))
+        self.assertCountEqual(finished, [1, 2, 3])
+        self.assertCountEqual(results.keys(), [1, 2, 3])
+        self.assertAlmostEqual(results[1].area(), 5, 5)
+        self.assertEqual(results[1].boundingBox(), QgsRectangle(0, 0, 5, 1))
+        self.assertAlmostEqual(results[2].area(), 1, 5)
+        self.assertTrue(results[3].isNull())
+        # 3 chunks and 2 merges for job 1
+        self.assertEqual(self.submitted.count(2), 4)
+
+    def testCancel(self):
+        """
+        Test canceling scheduled jobs
+        """
+        pending = Future()
+        scheduler = DissolveScheduler(lambda geometries: pending)
+        scheduler.add_job(1, [QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))])
+        self.assertIsNone(scheduler.run(is_canceled=lambda: True))
+        self.assertTrue(pending.cancelled())
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DissolveSchedulerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
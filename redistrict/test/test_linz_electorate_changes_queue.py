@@ -11,6 +11,7 @@ from qgis.core import (QgsVectorLayer,
 from redistrict.linz.electorate_changes_queue import (
     ElectorateEditQueue
 )
+from redistrict.linz.electorate_boundary_task import ElectorateBoundaryTask
 from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
 from redistrict.test.utilities import normalized_wkt
 
@@ -234,6 +235,132 @@ class LINZElectorateQueueTest(unittest.TestCase):
                           ''])
         self.assertEqual([f['username'] for f in user_log_layer.getFeatures()], ['test user', 'test user2'])
 
+    def testJump(self):
+        """
+        Test jumping multiple steps through the queue
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+        d2 = QgsFeature()
+        d2.setAttributes(["test2", 2])
+        d2.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        success, [d, d2] = district_layer.dataProvider().addFeatures([d, d2])
+        self.assertTrue(success)
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        self.assertFalse(queue.jump_to(0))
+        for i in range(1, 4):
+            log_entry = QgsFeature(user_log_layer.fields())
+            log_entry['username'] = f'user {i}'
+            queue.push_changes({d.id(): {1: 10 * i}, d2.id(): {0: f'x{i}'}},
+                               {d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5 + i))}, [log_entry])
+
+        self.assertTrue(queue.jump_to(0))
+        self.assertEqual(queue.index(), 0)
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 1], ['test2', 2]])
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))')
+        self.assertEqual(user_log_layer.featureCount(), 0)
+
+        self.assertTrue(queue.jump_to(2))
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 20], ['x2', 2]])
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((0 0, 0 7, 5 7, 5 0, 0 0))')
+        self.assertCountEqual([f['username'] for f in user_log_layer.getFeatures()], ['user 1', 'user 2'])
+
+        # single steps must still work after a jump
+        self.assertTrue(queue.forward())
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 30], ['x3', 2]])
+        self.assertCountEqual([f['username'] for f in user_log_layer.getFeatures()], ['user 1', 'user 2', 'user 3'])
+        self.assertTrue(queue.back())
+        self.assertTrue(queue.back())
+        self.assertCountEqual([f['username'] for f in user_log_layer.getFeatures()], ['user 1'])
+
+        queue.forward()
+        queue.forward()
+        queue.rollback()
+        self.assertEqual(queue.index(), 0)
+        self.assertEqual([f.attributes() for f in district_layer.getFeatures()], [['test1', 1], ['test2', 2]])
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))')
+        self.assertEqual(user_log_layer.featureCount(), 0)
+
+    def testClearPendingBoundaries(self):
+        """
+        Test clearing the queue while boundaries are pending
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+        success, [d] = district_layer.dataProvider().addFeatures([d])
+        self.assertTrue(success)
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        item = queue.push_changes({d.id(): {1: 10}}, {}, [], pending_geometry_ids=[d.id()])
+        self.assertEqual(queue.pending_boundary_ids(), [d.id()])
+        task = ElectorateBoundaryTask('', meshblock_layer=district_layer, electorate_changes_queue=queue,
+                                      queue_item=item,
+                                      original_geometries={d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5))},
+                                      added_meshblocks={}, removed_meshblocks={})
+        queue.add_boundary_task(task)
+
+        queue.clear()
+        self.assertTrue(task.isCanceled())
+        self.assertFalse(queue.pending_boundary_ids())
+        self.assertFalse(queue.boundary_tasks)
+
+        # results calculated before the queue was cleared are discarded
+        task.geometries = {d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))}
+        task.finished(True)
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))')
+
+    def testGeometryVersions(self):
+        """
+        Test tracking versions of electorate geometries changed by the queue
+        """
+        user_log_layer = make_user_log_layer()
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:string&field=estimated_pop:int",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1", 1])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+        success, [d] = district_layer.dataProvider().addFeatures([d])
+        self.assertTrue(success)
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        changed = []
+        queue.geometries_changed.connect(changed.append)
+        self.assertEqual(queue.geometry_version(d.id()), 0)
+
+        # attribute only changes don't change the version
+        queue.push_changes({d.id(): {1: 10}}, {}, [])
+        self.assertEqual(queue.geometry_version(d.id()), 0)
+        self.assertFalse(changed)
+
+        item = queue.push_changes({}, {}, [], pending_geometry_ids=[d.id()])
+        self.assertEqual(queue.geometry_version(d.id()), 1)
+        queue.set_pending_geometries(item, {d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))})
+        self.assertEqual(queue.geometry_version(d.id()), 2)
+        self.assertEqual(changed, [[d.id()], [d.id()]])
+
+        self.assertTrue(queue.back())
+        self.assertEqual(queue.geometry_version(d.id()), 3)
+        self.assertTrue(queue.forward())
+        self.assertEqual(queue.geometry_version(d.id()), 4)
+        self.assertTrue(queue.jump_to(0))
+        self.assertEqual(queue.geometry_version(d.id()), 5)
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(LINZElectorateQueueTest)
@@ -0,0 +1,105 @@
+"""
+LINZ Electorate Geometry Cache test.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from qgis.core import (QgsGeometry,
+                       QgsRectangle)
+from redistrict.linz.electorate_geometry_cache import ElectorateGeometryCache
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class ElectorateGeometryCacheTest(unittest.TestCase):
+    """Test ElectorateGeometryCache."""
+
+    def setUp(self):
+        """
+        Creates a temporary database for each test
+        """
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.database = os.path.join(self.temp_dir.name, 'test.gpkg')
+
+    def tearDown(self):
+        """
+        Removes temporary database
+        """
+        self.temp_dir.cleanup()
+
+    def testFingerprint(self):
+        """
+        Test meshblock fingerprints
+        """
+        self.assertEqual(ElectorateGeometryCache.fingerprint([3, 1, 2]),
+                         ElectorateGeometryCache.fingerprint(['1', '2', '3']))
+        self.assertNotEqual(ElectorateGeometryCache.fingerprint([1, 2, 3]),
+                            ElectorateGeometryCache.fingerprint([1, 2]))
+        self.assertEqual(ElectorateGeometryCache.fingerprint([]), ElectorateGeometryCache.fingerprint([]))
+        # fingerprints for different meshblock datasets never match
+        self.assertEqual(ElectorateGeometryCache.fingerprint([1, 2], meshblock_version='a'),
+                         ElectorateGeometryCache.fingerprint([2, 1], meshblock_version='a'))
+        self.assertNotEqual(ElectorateGeometryCache.fingerprint([1, 2], meshblock_version='a'),
+                            ElectorateGeometryCache.fingerprint([1, 2], meshblock_version='b'))
+
+    def testStoreAndRetrieve(self):
+        """
+        Test storing and retrieving cached geometries
+        """
+        cache = ElectorateGeometryCache(self.database, max_age_days=30, max_entries=100)
+        self.assertEqual(cache.entries_for_scenario(1), {})
+
+        cache.store(1, [('GN', '1', 'aaa', 100, QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))),
+                        ('GS', '2', 'bbb', 200, QgsGeometry())])
+        cache.store(2, [('GN', '1', 'ccc', 300, QgsGeometry.fromRect(QgsRectangle(0, 0, 2, 2)))])
+        self.assertEqual(cache.count(), 3)
+
+        entries = cache.entries_for_scenario(1)
+        self.assertCountEqual(entries.keys(), [('GN', '1'), ('GS', '2')])
+        self.assertEqual(entries[('GN', '1')][0], 'aaa')
+        self.assertEqual(entries[('GN', '1')][1], 100)
+        self.assertEqual(entries[('GN', '1')][2].asWkt(), 'Polygon ((0 0, 1 0, 1 1, 0 1, 0 0))')
+        self.assertEqual(entries[('GS', '2')][1], 200)
+        self.assertTrue(entries[('GS', '2')][2].isNull())
+
+        # replace existing entry
+        cache.store(1, [('GN', '1', 'ddd', 150, QgsGeometry.fromRect(QgsRectangle(0, 0, 3, 3)))])
+        entries = cache.entries_for_scenario(1)
+        self.assertEqual(entries[('GN', '1')][0], 'ddd')
+        self.assertEqual(entries[('GN', '1')][1], 150)
+        self.assertEqual(cache.count(), 3)
+
+        self.assertTrue(cache.clear(scenario_id=1))
+        self.assertEqual(cache.entries_for_scenario(1), {})
+        self.assertEqual(cache.count(), 1)
+        self.assertTrue(cache.clear())
+        self.assertEqual(cache.count(), 0)
+
+    def testEviction(self):
+        """
+        Test evicting cached geometries
+        """
+        cache = ElectorateGeometryCache(self.database, max_age_days=30, max_entries=2)
+        cache.store(1, [('GN', '1', 'aaa', 100, QgsGeometry())])
+        time.sleep(0.01)
+        cache.store(1, [('GN', '2', 'bbb', 100, QgsGeometry())])
+        time.sleep(0.01)
+        cache.touch(1, [('GN', '1')])
+        time.sleep(0.01)
+        cache.store(1, [('GN', '3', 'ccc', 100, QgsGeometry())])
+        # least recently used entry should be evicted
+        self.assertCountEqual(cache.entries_for_scenario(1).keys(), [('GN', '1'), ('GN', '3')])
+
+        cache = ElectorateGeometryCache(self.database, max_age_days=0, max_entries=100)
+        time.sleep(0.01)
+        cache.evict()
+        self.assertEqual(cache.count(), 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ElectorateGeometryCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
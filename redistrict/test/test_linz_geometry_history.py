@@ -0,0 +1,104 @@
+"""
+LINZ Geometry History test.
+"""
+
+import unittest
+from qgis.core import (QgsGeometry,
+                       QgsRectangle,
+                       QgsVectorLayer,
+                       QgsFeature,
+                       NULL)
+from redistrict.linz.geometry_history import GeometryHistory
+from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
+from redistrict.test.utilities import (get_qgis_app,
+                                       normalized_wkt)
+
+QGIS_APP = get_qgis_app()
+
+
+class GeometryHistoryTest(unittest.TestCase):
+    """Test GeometryHistory."""
+
+    def testHistory(self):
+        """
+        Test storing and retrieving geometries
+        """
+        history = GeometryHistory()
+        self.assertEqual(history.count(), 0)
+        key = history.add(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+        key2 = history.add(QgsGeometry())
+        self.assertNotEqual(key, key2)
+        self.assertEqual(history.count(), 2)
+        self.assertGreater(history.memory_size(), 0)
+
+        self.assertEqual(normalized_wkt(history.geometry(key)), 'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))')
+        self.assertTrue(history.geometry(key2).isNull())
+        self.assertEqual({k: normalized_wkt(g) for k, g in history.geometries({1: key}).items()},
+                         {1: 'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))'})
+
+        # reference counting
+        history.retain(key)
+        history.release(key)
+        self.assertEqual(history.count(), 2)
+        history.release(key)
+        self.assertEqual(history.count(), 1)
+        history.release(key2)
+        self.assertEqual(history.count(), 0)
+        self.assertEqual(history.memory_size(), 0)
+
+    def testSpill(self):
+        """
+        Test spilling geometries to disk
+        """
+        history = GeometryHistory(memory_limit=1)
+        keys = [history.add(QgsGeometry.fromRect(QgsRectangle(x, 0, x + 5, 5))) for x in range(5)]
+        self.assertEqual(history.spilled_count(), 5)
+        self.assertEqual(history.memory_size(), 0)
+        self.assertEqual(normalized_wkt(history.geometry(keys[3])), 'Polygon ((3 0, 3 5, 8 5, 8 0, 3 0))')
+        self.assertEqual(normalized_wkt(history.geometry(keys[0])), 'Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))')
+
+        history.release(keys[0])
+        self.assertEqual(history.spilled_count(), 4)
+
+        history.clear()
+        self.assertEqual(history.count(), 0)
+        self.assertEqual(history.spilled_count(), 0)
+
+    def testQueueHistory(self):
+        """
+        Test that the electorate changes queue releases discarded geometries
+        """
+        district_layer = QgsVectorLayer("Polygon?crs=EPSG:4326&field=fld1:string", "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1"])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        success, [d] = district_layer.dataProvider().addFeatures([d])
+        self.assertTrue(success)
+
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=make_user_log_layer(),
+                                    history_memory_limit=1)
+        queue.push_changes({d.id(): {0: 'xtest1'}}, {d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 10, 5))}, [])
+        queue.push_changes({d.id(): {0: 'xtest2'}}, {d.id(): QgsGeometry.fromRect(QgsRectangle(0, 0, 20, 5))}, [])
+        self.assertEqual(queue.geometry_history.count(), 4)
+
+        self.assertTrue(queue.back())
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((0 0, 0 5, 10 5, 10 0, 0 0))')
+        self.assertTrue(queue.back())
+        self.assertEqual(normalized_wkt(district_layer.getFeature(d.id()).geometry()),
+                         'Polygon ((5 0, 5 5, 10 5, 10 0, 5 0))')
+        self.assertTrue(queue.forward())
+
+        # pushing a new change discards the undone change
+        queue.push_changes({d.id(): {0: NULL}}, {}, [])
+        self.assertEqual(queue.geometry_history.count(), 2)
+
+        queue.clear()
+        self.assertEqual(queue.geometry_history.count(), 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(GeometryHistoryTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -3,8 +3,12 @@ LINZ Scenario - Meshblock Bridge Test.
 """
 
 import unittest
-from redistrict.linz.linz_mb_scenario_bridge import LinzMeshblockScenarioBridge
+from qgis.core import QgsFeature
+from redistrict.linz.linz_mb_scenario_bridge import (LinzMeshblockScenarioBridge,
+                                                     ScenarioSaveError)
+from redistrict.linz.user_log_writer import UserLogWriter
 from redistrict.test.test_linz_scenario_registry import make_meshblock_layer, make_meshblock_electorate_layer
+from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
 
 
 class ScenarioMeshblockBridgeTest(unittest.TestCase):
@@ -44,6 +48,33 @@ class ScenarioMeshblockBridgeTest(unittest.TestCase):
         bridge.scenario = 2
         mb_ids = bridge.get_target_meshblock_ids_from_numbers([0, 1])
         self.assertEqual(mb_ids, {0: 1, 1: 2})
+        self.assertEqual(bridge.get_target_meshblock_ids_from_numbers([1]), {1: 2})
+        self.assertEqual(bridge.get_target_meshblock_ids_from_numbers([5]), {})
+
+    def testMeshblockIdIndex(self):
+        """
+        Test the cached index of target meshblock feature ids
+        """
+        meshblock_layer = make_meshblock_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        bridge = LinzMeshblockScenarioBridge(
+            meshblock_layer=meshblock_layer,
+            meshblock_scenario_layer=mb_electorate_layer,
+            meshblock_number_field_name='MeshblockNumber'
+        )
+        bridge.scenario = 1
+        self.assertEqual(bridge.get_target_meshblock_ids_from_numbers([0, 1]), {0: 3, 1: 4})
+
+        # changing scenario must invalidate index
+        bridge.scenario = 2
+        self.assertEqual(bridge.get_target_meshblock_ids_from_numbers([0, 1]), {0: 1, 1: 2})
+
+        # meshblocks added after the index was built must be found
+        f = QgsFeature()
+        f.setAttributes([5, 2, 2, 'c', 'w'])
+        self.assertTrue(mb_electorate_layer.dataProvider().addFeatures([f]))
+        self.assertEqual(bridge.get_target_meshblock_ids_from_numbers([0, 2]), {0: 1, 2: 5})
 
     def testGetNewElectorates(self):
         """
@@ -133,6 +164,121 @@ class ScenarioMeshblockBridgeTest(unittest.TestCase):
                                    [3, 1, 0, 'd', 'z'],
                                    [4, 1, 1, 'c', 'zz']])
 
+    def testUserLogFlush(self):
+        """
+        Test that buffered user log entries are only written when changes are saved
+        """
+        meshblock_layer = make_meshblock_layer()
+        user_log_layer = make_user_log_layer()
+        writer = UserLogWriter(user_log_layer, buffered=True)
+        bridge = LinzMeshblockScenarioBridge(
+            meshblock_layer=meshblock_layer,
+            meshblock_scenario_layer=make_meshblock_electorate_layer(),
+            meshblock_number_field_name='MeshblockNumber',
+            user_log_writer=writer
+        )
+        bridge.task = 'GN'
+        bridge.scenario = 1
+
+        entry = QgsFeature(user_log_layer.fields())
+        entry['username'] = 'a'
+        writer.add_entries([entry])
+        self.assertTrue(meshblock_layer.startEditing())
+        feature = next(meshblock_layer.getFeatures())
+        self.assertTrue(meshblock_layer.changeAttributeValues(feature.id(), {1: 'c'}))
+
+        # nothing is written before the commit succeeds
+        bridge.meshblock_layer_saved()
+        self.assertEqual(user_log_layer.featureCount(), 0)
+        self.assertTrue(meshblock_layer.commitChanges())
+        self.assertEqual([f['username'] for f in user_log_layer.getFeatures()], ['a'])
+        self.assertFalse(writer.pending_entries())
+
+    def testUserLogRollBackAfterFailedCommit(self):
+        """
+        Test that user log entries kept after a failed commit are discarded on rollback
+        """
+        meshblock_layer = make_meshblock_layer()
+        user_log_layer = make_user_log_layer()
+        writer = UserLogWriter(user_log_layer, buffered=True)
+        bridge = LinzMeshblockScenarioBridge(
+            meshblock_layer=meshblock_layer,
+            meshblock_scenario_layer=make_meshblock_electorate_layer(),
+            meshblock_number_field_name='MeshblockNumber',
+            user_log_writer=writer
+        )
+        bridge.task = 'GN'
+        bridge.scenario = 1
+
+        entry = QgsFeature(user_log_layer.fields())
+        entry['username'] = 'a'
+        writer.add_entries([entry])
+        self.assertTrue(meshblock_layer.startEditing())
+        feature = next(meshblock_layer.getFeatures())
+        self.assertTrue(meshblock_layer.changeAttributeValues(feature.id(), {1: 'c'}))
+
+        # failed commit: changes are prepared for saving, but the commit never completes
+        bridge.meshblock_layer_saved()
+        self.assertEqual(len(writer.pending_entries()), 1)
+        self.assertTrue(meshblock_layer.rollBack())
+        self.assertFalse(writer.pending_entries())
+
+        # a later successful commit only logs its own changes
+        entry = QgsFeature(user_log_layer.fields())
+        entry['username'] = 'b'
+        writer.add_entries([entry])
+        self.assertTrue(meshblock_layer.startEditing())
+        self.assertTrue(meshblock_layer.changeAttributeValues(feature.id(), {1: 'd'}))
+        self.assertTrue(meshblock_layer.commitChanges())
+        self.assertEqual([f['username'] for f in user_log_layer.getFeatures()], ['b'])
+
+    def testFailedPrepare(self):
+        """
+        Test that scenario records are not changed if the records could not be prepared
+        """
+
+        class FailingRegistry:
+            """
+            Registry which can't copy records
+            """
+
+            @staticmethod
+            def has_lineage_field():  # pylint: disable=missing-docstring
+                return True
+
+            @staticmethod
+            def prepare_scenario_changes(*_, **__):  # pylint: disable=missing-docstring
+                return False
+
+        meshblock_layer = make_meshblock_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+        bridge = LinzMeshblockScenarioBridge(
+            meshblock_layer=meshblock_layer,
+            meshblock_scenario_layer=mb_electorate_layer,
+            meshblock_number_field_name='MeshblockNumber',
+            scenario_registry=FailingRegistry()
+        )
+        bridge.task = 'GN'
+        bridge.scenario = 1
+        messages = []
+        bridge.save_failed.connect(messages.append)
+
+        self.assertTrue(meshblock_layer.startEditing())
+        feature = next(meshblock_layer.getFeatures())
+        self.assertTrue(meshblock_layer.changeAttributeValues(feature.id(), {1: 'c'}))
+        if hasattr(meshblock_layer, 'setAllowCommit'):
+            bridge.meshblock_layer_saved()
+        else:
+            with self.assertRaises(ScenarioSaveError):
+                bridge.meshblock_layer_saved()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual([f.attributes() for f in mb_electorate_layer.getFeatures()],
+                         [[1, 2, 0, 'a', 'x'],
+                          [2, 2, 1, 'b', 'y'],
+                          [3, 1, 0, 'c', 'z'],
+                          [4, 1, 1, 'd', 'zz']])
+        meshblock_layer.rollBack()
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(ScenarioMeshblockBridgeTest)
@@ -0,0 +1,157 @@
+"""
+LINZ Meshblock Adjacency Graph test.
+"""
+
+import os
+import tempfile
+import unittest
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsVectorLayer)
+from redistrict.linz.meshblock_adjacency_graph import MeshblockAdjacencyGraph
+from redistrict.linz.meshblock_graph_task import MeshblockGraphTask
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def make_meshblock_layer() -> QgsVectorLayer:
+    """
+    Creates a test meshblock layer, with meshblocks arranged as:
+
+        14  15
+    11  12  13
+
+    Meshblock 14 only touches 11 and 13 at their corners.
+    """
+    layer = QgsVectorLayer(
+        "Polygon?crs=EPSG:2193&field=meshblock_no:string", "source", "memory")
+    features = []
+    for number, rect in (('13', QgsRectangle(2, 0, 3, 1)),
+                         ('11', QgsRectangle(0, 0, 1, 1)),
+                         ('12', QgsRectangle(1, 0, 2, 1)),
+                         ('14', QgsRectangle(1, 1, 2, 3)),
+                         ('15', QgsRectangle(2, 1, 3, 2))):
+        f = QgsFeature()
+        f.setAttributes([number])
+        f.setGeometry(QgsGeometry.fromRect(rect))
+        features.append(f)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+class MeshblockAdjacencyGraphTest(unittest.TestCase):
+    """Test MeshblockAdjacencyGraph."""
+
+    def setUp(self):
+        """
+        Creates a temporary database for each test
+        """
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.database = os.path.join(self.temp_dir.name, 'test.gpkg')
+
+    def tearDown(self):
+        """
+        Removes temporary database
+        """
+        self.temp_dir.cleanup()
+
+    def testCalculateEdges(self):
+        """
+        Test calculating graph edges from geometries
+        """
+        layer = make_meshblock_layer()
+        edges = MeshblockAdjacencyGraph.calculate_edges(layer, 0)
+        self.assertCountEqual([(a, b, round(length, 5)) for a, b, length in edges],
+                              [(11, 12, 1), (12, 13, 1), (12, 14, 1), (13, 15, 1), (14, 15, 1)])
+        self.assertIsNone(MeshblockAdjacencyGraph.calculate_edges(layer, 0, is_canceled=lambda: True))
+
+    def testGraph(self):
+        """
+        Test graph lookups
+        """
+        graph = MeshblockAdjacencyGraph(self.database)
+        self.assertFalse(graph.is_valid())
+        graph.set_edges([15, 13, 11, 12, 14, 16], [(11, 12, 1.0), (12, 13, 2.0), (12, 14, 3.0), (13, 15, 1.5),
+                                                   (14, 15, 1.0), (99, 11, 1.0)])
+        self.assertTrue(graph.is_valid())
+        self.assertEqual(graph.count(), 6)
+        self.assertEqual(graph.edge_count(), 5)
+        self.assertEqual(graph.ordinal_for_meshblock_number(11), 0)
+        self.assertEqual(graph.ordinal_for_meshblock_number('13'), 2)
+        self.assertIsNone(graph.ordinal_for_meshblock_number(17))
+        self.assertEqual(list(graph.neighbours_for(1)), [0, 2, 3])
+        self.assertEqual(list(graph.shared_lengths_for(1)), [1.0, 2.0, 3.0])
+        self.assertEqual(list(graph.neighbours_for(4)), [2, 3])
+        # isolated meshblock
+        self.assertEqual(list(graph.neighbours_for(5)), [])
+        self.assertCountEqual(list(graph.edges()),
+                              [(11, 12, 1.0), (12, 13, 2.0), (12, 14, 3.0), (13, 15, 1.5), (14, 15, 1.0)])
+
+    def testPersistence(self):
+        """
+        Test saving and loading the graph
+        """
+        graph = MeshblockAdjacencyGraph(self.database)
+        self.assertFalse(graph.load([11, 12]))
+        graph.set_edges([11, 12, 13], [(11, 12, 1.0), (12, 13, 2.0)])
+        self.assertTrue(graph.save())
+
+        graph2 = MeshblockAdjacencyGraph(self.database)
+        # different meshblocks, so persisted graph is stale
+        self.assertFalse(graph2.load([11, 12]))
+        self.assertTrue(graph2.load([13, 12, 11]))
+        self.assertEqual(list(graph2.edges()), [(11, 12, 1.0), (12, 13, 2.0)])
+
+        self.assertTrue(graph.clear())
+        self.assertFalse(MeshblockAdjacencyGraph(self.database).load([11, 12, 13]))
+
+    def testTask(self):
+        """
+        Test building the graph in a task
+        """
+        layer = make_meshblock_layer()
+        graph = MeshblockAdjacencyGraph(self.database, meshblock_layer=layer)
+        task = MeshblockGraphTask('', meshblock_layer=layer, meshblock_number_field_name='meshblock_no',
+                                  meshblock_graph=graph)
+        self.assertTrue(task.run())
+        self.assertTrue(graph.is_valid())
+        self.assertEqual(graph.edge_count(), 5)
+
+        # should be loaded from database
+        graph2 = MeshblockAdjacencyGraph(self.database)
+        task = MeshblockGraphTask('', meshblock_layer=layer, meshblock_number_field_name='meshblock_no',
+                                  meshblock_graph=graph2)
+        self.assertTrue(task.run())
+        self.assertEqual(list(graph2.edges()), list(graph.edges()))
+
+    def testInvalidation(self):
+        """
+        Test that geometry edits invalidate the graph
+        """
+        layer = make_meshblock_layer()
+        graph = MeshblockAdjacencyGraph(self.database, meshblock_layer=layer)
+        graph.set_edges([11, 12], [(11, 12, 1.0)])
+        graph.save()
+        invalidated = []
+        graph.invalidated.connect(lambda: invalidated.append(True))
+
+        layer.startEditing()
+        f = next(layer.getFeatures())
+        layer.changeAttributeValue(f.id(), 0, '16')
+        layer.commitChanges()
+        self.assertTrue(graph.is_valid())
+
+        layer.startEditing()
+        layer.changeGeometry(f.id(), QgsGeometry.fromRect(QgsRectangle(5, 5, 6, 6)))
+        layer.commitChanges()
+        self.assertFalse(graph.is_valid())
+        self.assertEqual(invalidated, [True])
+        self.assertFalse(MeshblockAdjacencyGraph(self.database).load([11, 12]))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MeshblockAdjacencyGraphTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,127 @@
+"""
+LINZ Meshblock Store test.
+"""
+
+import unittest
+from qgis.core import (QgsVectorLayer,
+                       QgsFeature,
+                       NULL)
+from redistrict.linz.meshblock_store import MeshblockStore
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def make_meshblock_layer() -> QgsVectorLayer:
+    """
+    Makes a dummy meshblock layer for testing
+    """
+    layer = QgsVectorLayer(
+        "NoGeometry?field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+        "source", "memory")
+    f = QgsFeature()
+    f.setAttributes(["13", 1, 2, 3, 1, 0])
+    f2 = QgsFeature()
+    f2.setAttributes(["11", 11, NULL, 13, 1, 1])
+    f3 = QgsFeature()
+    f3.setAttributes(["12", 21, 22, 23, 2, 0])
+    layer.dataProvider().addFeatures([f, f2, f3])
+    return layer
+
+
+class MeshblockStoreTest(unittest.TestCase):
+    """Test MeshblockStore."""
+
+    def testBuild(self):
+        """
+        Test building the store
+        """
+        layer = make_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        self.assertFalse(store.is_valid())
+        store.ensure_built()
+        self.assertTrue(store.is_valid())
+        self.assertEqual(store.count(), 3)
+
+        # sorted by meshblock number
+        self.assertEqual(list(store.meshblock_numbers), [11, 12, 13])
+        self.assertEqual(store.meshblock_number_values, ['11', '12', '13'])
+        fids = {f['MeshblockNumber']: f.id() for f in layer.getFeatures()}
+        self.assertEqual(list(store.feature_ids), [fids['11'], fids['12'], fids['13']])
+        self.assertEqual(list(store.offline_pop_gn), [0, 22, 2])
+        self.assertEqual(list(store.offline_pop_gs), [13, 23, 3])
+        self.assertEqual(list(store.offline_pop_m), [11, 21, 1])
+        self.assertEqual(list(store.offshore), [1, 0, 0])
+        self.assertEqual(list(store.ns_island), [0, 0, 0])
+
+        # content hash changes with the stored meshblocks
+        content_hash = store.content_hash()
+        self.assertEqual(store.content_hash(), content_hash)
+        layer.dataProvider().changeAttributeValues({fids['12']: {layer.fields().lookupField('offline_pop_gn'): 0}})
+        store.build()
+        self.assertNotEqual(store.content_hash(), content_hash)
+
+    def testLookups(self):
+        """
+        Test store lookups
+        """
+        layer = make_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        store.ensure_built()
+
+        self.assertEqual(store.ordinal_for_meshblock_number(12), 1)
+        self.assertEqual(store.ordinal_for_meshblock_number('13'), 2)
+        self.assertIsNone(store.ordinal_for_meshblock_number(14))
+        fids = {f['MeshblockNumber']: f.id() for f in layer.getFeatures()}
+        self.assertEqual(store.ordinal_for_feature_id(fids['11']), 0)
+        self.assertIsNone(store.ordinal_for_feature_id(-100))
+
+        # unknown meshblocks are skipped, order is retained
+        ordinals = store.ordinals_for_meshblock_numbers(['13', 11, 14])
+        self.assertEqual(list(ordinals), [2, 0])
+        self.assertEqual(store.feature_ids_for_ordinals(ordinals), [fids['13'], fids['11']])
+
+        self.assertEqual(store.population_sum([0, 1, 2], 'GN'), 24)
+        self.assertEqual(store.population_sum([0, 1, 2], 'GS'), 39)
+        self.assertEqual(store.population_sum([0, 2], 'M'), 12)
+        self.assertEqual(store.split_offshore([0, 1, 2]), ([0], [1, 2]))
+
+    def testInvalidation(self):
+        """
+        Test that the store is invalidated by meshblock edits
+        """
+        layer = make_meshblock_layer()
+        store = MeshblockStore(meshblock_layer=layer, meshblock_number_field_name='MeshblockNumber')
+        store.ensure_built()
+
+        # staged electorate changes must not invalidate the store
+        self.assertTrue(layer.startEditing())
+        f = next(layer.getFeatures())
+        self.assertTrue(layer.changeAttributeValue(f.id(), 4, 5))
+        self.assertTrue(layer.commitChanges())
+        self.assertTrue(store.is_valid())
+
+        # but population changes do
+        self.assertTrue(layer.startEditing())
+        self.assertTrue(layer.changeAttributeValue(f.id(), 1, 50))
+        self.assertTrue(layer.commitChanges())
+        self.assertFalse(store.is_valid())
+        store.ensure_built()
+        self.assertTrue(store.is_valid())
+        self.assertEqual(store.population_sum([store.ordinal_for_feature_id(f.id())], 'M'), 50)
+
+        # as do added features
+        self.assertTrue(layer.startEditing())
+        f4 = QgsFeature(layer.fields())
+        f4.setAttributes(["14", 31, 32, 33, 1, 0])
+        self.assertTrue(layer.addFeature(f4))
+        self.assertTrue(layer.commitChanges())
+        self.assertFalse(store.is_valid())
+        store.ensure_built()
+        self.assertEqual(list(store.meshblock_numbers), [11, 12, 13, 14])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MeshblockStoreTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -2,7 +2,9 @@
 LINZ Redistricting Handler test.
 """
 
+import time
 import unittest
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsVectorLayer,
     QgsFeature,
@@ -14,7 +16,12 @@ from redistrict.linz.linz_redistrict_handler import (
     LinzRedistrictHandler
 )
 from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
-from redistrict.test.utilities import normalized_wkt
+from redistrict.test.utilities import (
+    get_qgis_app,
+    normalized_wkt
+)
+
+QGIS_APP = get_qgis_app()
 
 
 def make_user_log_layer() -> QgsVectorLayer:
@@ -90,10 +97,10 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
         self.assertTrue(handler.assign_district([f5.id()], 'aaa'))
 
         # pending changes should be recorded
-        self.assertEqual(handler.pending_affected_districts, {'aaa': {'ADD': [f.id(), f3.id(), f5.id()], 'REMOVE': []},
-                                                              'test2': {'ADD': [], 'REMOVE': [f5.id()]},
-                                                              'test3': {'ADD': [], 'REMOVE': [f3.id()]},
-                                                              'test4': {'ADD': [], 'REMOVE': [f.id()]}})
+        self.assertEqual(handler.pending_affected_districts, {'aaa': {'ADD': {f.id(), f3.id(), f5.id()}, 'REMOVE': set()},
+                                                              'test2': {'ADD': set(), 'REMOVE': {f5.id()}},
+                                                              'test3': {'ADD': set(), 'REMOVE': {f3.id()}},
+                                                              'test4': {'ADD': set(), 'REMOVE': {f.id()}}})
         self.assertEqual(handler.create_affected_district_filter(), "fld1 IN ('aaa','test2','test3','test4')")
 
         self.assertEqual([f.attributes() for f in user_log_layer.getFeatures()], [])
@@ -141,9 +148,9 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
         handler.begin_edit_group('test2')
         self.assertTrue(handler.assign_district([f2.id()], 'aaa'))
         self.assertTrue(handler.assign_district([f4.id()], 'aaa'))
-        self.assertEqual(handler.pending_affected_districts, {'aaa': {'ADD': [f2.id(), f4.id()], 'REMOVE': []},
-                                                              'test2': {'ADD': [], 'REMOVE': [f2.id()]},
-                                                              'test1': {'ADD': [], 'REMOVE': [f4.id()]}})
+        self.assertEqual(handler.pending_affected_districts, {'aaa': {'ADD': {f2.id(), f4.id()}, 'REMOVE': set()},
+                                                              'test2': {'ADD': set(), 'REMOVE': {f2.id()}},
+                                                              'test1': {'ADD': set(), 'REMOVE': {f4.id()}}})
         self.assertEqual(handler.create_affected_district_filter(), "fld1 IN ('aaa','test1','test2')")
         self.assertCountEqual([f["fld1"] for f in handler.get_affected_districts()], ['test2', 'aaa', 'test1'])
         self.assertCountEqual([f.id() for f in handler.get_added_meshblocks('aaa')], [2, 4])
@@ -235,10 +242,10 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
 
         # pending changes should be recorded
         self.assertEqual(handler.pending_affected_districts,
-                         {5: {'ADD': [f.id(), f3.id(), f6.id(), f5.id()], 'REMOVE': []},
-                          2: {'ADD': [], 'REMOVE': [f5.id()]},
-                          3: {'ADD': [], 'REMOVE': [f3.id()]},
-                          4: {'ADD': [], 'REMOVE': [f.id()]}})
+                         {5: {'ADD': {f.id(), f3.id(), f6.id(), f5.id()}, 'REMOVE': set()},
+                          2: {'ADD': set(), 'REMOVE': {f5.id()}},
+                          3: {'ADD': set(), 'REMOVE': {f3.id()}},
+                          4: {'ADD': set(), 'REMOVE': {f.id()}}})
         self.assertEqual(handler.create_affected_district_filter(), "fld1 IN (2,3,4,5)")
 
         self.assertCountEqual([f["fld1"] for f in handler.get_affected_districts()], [4, 3, 5, 2])
@@ -280,9 +287,9 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
         handler.begin_edit_group('test2')
         self.assertTrue(handler.assign_district([f2.id()], 5))
         self.assertTrue(handler.assign_district([f4.id()], 5))
-        self.assertEqual(handler.pending_affected_districts, {5: {'ADD': [f2.id(), f4.id()], 'REMOVE': []},
-                                                              2: {'ADD': [], 'REMOVE': [f2.id()]},
-                                                              1: {'ADD': [], 'REMOVE': [f4.id()]}})
+        self.assertEqual(handler.pending_affected_districts, {5: {'ADD': {f2.id(), f4.id()}, 'REMOVE': set()},
+                                                              2: {'ADD': set(), 'REMOVE': {f2.id()}},
+                                                              1: {'ADD': set(), 'REMOVE': {f4.id()}}})
         self.assertEqual(handler.create_affected_district_filter(), "fld1 IN (1,2,5)")
         self.assertCountEqual([f["fld1"] for f in handler.get_affected_districts()], [2, 5, 1])
         self.assertCountEqual([f.id() for f in handler.get_added_meshblocks(5)], [2, 4])
@@ -307,6 +314,139 @@ class LINZRedistrictHandlerTest(unittest.TestCase):
                           [1, '3', 'GN', '3', '5'],
                           [1, '2', 'GN', '2', '5']])
 
+    def testPopulationLedger(self):  # pylint: disable=too-many-locals
+        """
+        Test tracking populations with the handler's ledger
+        """
+        meshblock_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:int&field=offline_pop_gn:int",
+            "source", "memory")
+        features = []
+        for district, pop, x in ((1, 10, 0), (1, 20, 5), (2, 30, 10), (NULL, 40, 15)):
+            f = QgsFeature()
+            f.setAttributes([district, pop])
+            f.setGeometry(QgsGeometry.fromRect(QgsRectangle(x, 0, x + 5, 5)))
+            features.append(f)
+        success, [f, f2, f3, f4] = meshblock_layer.dataProvider().addFeatures(features)
+        self.assertTrue(success)
+
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:int&field=estimated_pop:int&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=invalid:int&field=invalid_reason:string",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes([1, 30, NULL])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 10, 5)))
+        d2 = QgsFeature()
+        d2.setAttributes([2, 25, 32])
+        d2.setGeometry(QgsGeometry.fromRect(QgsRectangle(10, 0, 15, 5)))
+        success, [d, d2] = district_layer.dataProvider().addFeatures([d, d2])
+        self.assertTrue(success)
+
+        user_log_layer = make_user_log_layer()
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        handler = LinzRedistrictHandler(meshblock_layer=meshblock_layer, meshblock_number_field_name='fld1',
+                                        target_field='fld1', electorate_changes_queue=queue,
+                                        electorate_layer=district_layer, electorate_layer_field='fld1', task='GN',
+                                        user_log_layer=user_log_layer, scenario=1)
+        ledger = handler.population_ledger
+        self.assertEqual(ledger.populations_by_feature_id(), {d.id(): 30, d2.id(): 32})
+
+        self.assertTrue(meshblock_layer.startEditing())
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([f2.id(), f4.id()], 2))
+        # already in district
+        self.assertTrue(handler.assign_district([f3.id()], 2))
+        self.assertEqual(ledger.population(1), 10)
+        self.assertEqual(ledger.population(2), 92)
+        self.assertEqual(ledger.committed_population(2), 32)
+
+        handler.discard_edit_group()
+        self.assertEqual(ledger.populations_by_feature_id(), {d.id(): 30, d2.id(): 32})
+
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([f2.id(), f4.id()], 2))
+        handler.end_edit_group()
+        self.assertEqual(ledger.populations_by_feature_id(), {d.id(): 10, d2.id(): 92})
+        self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [10, 92])
+
+        # ledger must follow undo/redo of electorate changes
+        self.assertTrue(queue.back())
+        self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [30, 25])
+        self.assertEqual(ledger.populations_by_feature_id(), {d.id(): 30, d2.id(): 32})
+        self.assertTrue(queue.forward())
+        self.assertEqual(ledger.populations_by_feature_id(), {d.id(): 10, d2.id(): 92})
+
+    def testBackgroundBoundaries(self):  # pylint: disable=too-many-locals
+        """
+        Test recalculating electorate boundaries in a background task
+        """
+        meshblock_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:int&field=offline_pop_gn:int",
+            "source", "memory")
+        features = []
+        for district, pop, x in ((1, 10, 0), (2, 20, 5), (2, 30, 10), (2, 40, 15)):
+            f = QgsFeature()
+            f.setAttributes([district, pop])
+            f.setGeometry(QgsGeometry.fromRect(QgsRectangle(x, 0, x + 5, 5)))
+            features.append(f)
+        success, [f, f2, f3, f4] = meshblock_layer.dataProvider().addFeatures(features)
+        self.assertTrue(success)
+
+        district_layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326&field=fld1:int&field=estimated_pop:int&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=invalid:int&field=invalid_reason:string",
+            "source", "memory")
+        d = QgsFeature()
+        d.setAttributes([1, 10, NULL])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(0, 0, 5, 5)))
+        d2 = QgsFeature()
+        d2.setAttributes([2, 90, NULL])
+        d2.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 20, 5)))
+        success, [d, d2] = district_layer.dataProvider().addFeatures([d, d2])
+        self.assertTrue(success)
+
+        user_log_layer = make_user_log_layer()
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=user_log_layer)
+        handler = LinzRedistrictHandler(meshblock_layer=meshblock_layer, meshblock_number_field_name='fld1',
+                                        target_field='fld1', electorate_changes_queue=queue,
+                                        electorate_layer=district_layer, electorate_layer_field='fld1', task='GN',
+                                        user_log_layer=user_log_layer, scenario=1, background_boundaries=True)
+
+        self.assertTrue(meshblock_layer.startEditing())
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([f2.id()], 1))
+        handler.end_edit_group()
+        # two consecutive operations, the second depending on the boundaries calculated for the first
+        handler.begin_edit_group('test')
+        self.assertTrue(handler.assign_district([f3.id()], 1))
+        handler.end_edit_group()
+
+        # attributes are updated immediately
+        self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [60, 40])
+        self.assertCountEqual(queue.pending_boundary_ids(), [d.id(), d2.id()])
+
+        deadline = time.time() + 30
+        while queue.pending_boundary_ids() and time.time() < deadline:
+            QCoreApplication.processEvents()
+        self.assertFalse(queue.pending_boundary_ids())
+
+        self.assertTrue(district_layer.getFeature(d.id()).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(0, 0, 15, 5))))
+        self.assertTrue(district_layer.getFeature(d2.id()).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(15, 0, 20, 5))))
+
+        # undo must restore the boundaries calculated for the first operation
+        self.assertTrue(queue.back())
+        self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [30, 70])
+        self.assertTrue(district_layer.getFeature(d.id()).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(0, 0, 10, 5))))
+        self.assertTrue(district_layer.getFeature(d2.id()).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(10, 0, 20, 5))))
+        self.assertTrue(queue.back())
+        self.assertEqual([f['estimated_pop'] for f in district_layer.getFeatures()], [10, 90])
+        self.assertTrue(district_layer.getFeature(d2.id()).geometry().isGeosEqual(
+            QgsGeometry.fromRect(QgsRectangle(5, 0, 20, 5))))
+
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(LINZRedistrictHandlerTest)
@@ -0,0 +1,52 @@
+"""
+LINZ Scenario Base Task Test.
+"""
+
+import unittest
+from qgis.PyQt.QtCore import QThreadPool
+from qgis.core import (QgsGeometry,
+                       QgsRectangle)
+from redistrict.linz.scenario_base_task import MergedGeometryWorker
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class ScenarioBaseTaskTest(unittest.TestCase):
+    """Test ScenarioBaseTask components."""
+
+    def testMergedGeometryWorker(self):
+        """
+        Test merging geometries using MergedGeometryWorker
+        """
+        worker = MergedGeometryWorker(1, [QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)),
+                                          QgsGeometry.fromRect(QgsRectangle(1, 0, 2, 1))])
+        self.assertFalse(worker.future.done())
+        pool = QThreadPool()
+        pool.start(worker)
+        res = worker.future.result(timeout=30)
+        self.assertAlmostEqual(res.area(), 2, 5)
+        self.assertEqual(res.boundingBox(), QgsRectangle(0, 0, 2, 1))
+        self.assertEqual(res.constGet().partCount(), 1)
+        pool.waitForDone()
+
+        # empty result
+        worker = MergedGeometryWorker(2, [])
+        worker.run()
+        self.assertTrue(worker.future.result().isNull())
+
+    def testCanceledWorker(self):
+        """
+        Test that workers canceled before starting are skipped
+        """
+        worker = MergedGeometryWorker(1, [QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))])
+        self.assertTrue(worker.future.cancel())
+        worker.run()
+        self.assertTrue(worker.future.cancelled())
+        self.assertIsNone(worker.output)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ScenarioBaseTaskTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -2,6 +2,8 @@
 LINZ Scenario Registry Test.
 """
 
+import os
+import tempfile
 import unittest
 from collections import OrderedDict
 
@@ -17,14 +19,18 @@ from qgis.core import (
     QgsVectorLayer,
     QgsGeometry,
     QgsPointXY,
-    QgsFeature
+    QgsFeature,
+    QgsVectorFileWriter
 )
 
 from redistrict.linz.scenario_registry import ScenarioRegistry
+from redistrict.linz.scenario_snapshot import ScenarioSnapshot
+from redistrict.linz.meshblock_store import MeshblockStore
 from redistrict.linz.scenario_switch_task import ScenarioSwitchTask
 from redistrict.linz.staged_electorate_update_task import \
     UpdateStagedElectoratesTask
 from redistrict.test.utilities import normalized_wkt, get_qgis_app
+from redistrict.test.test_linz_meshblock_store import make_meshblock_layer as make_store_meshblock_layer
 
 QGIS_APP = get_qgis_app()
 
@@ -84,6 +90,22 @@ def make_meshblock_layer() -> QgsVectorLayer:
     return layer
 
 
+def write_geopackage_layer(layer: QgsVectorLayer, path: str, layer_name: str) -> QgsVectorLayer:
+    """
+    Writes a layer to a GeoPackage table, and returns the written layer
+    """
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = layer_name
+    options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer if os.path.exists(
+        path) else QgsVectorFileWriter.CreateOrOverwriteFile
+    error, message = QgsVectorFileWriter.writeAsVectorFormat(layer, path, options)
+    assert not error, message
+    written = QgsVectorLayer(f'{path}|layername={layer_name}', layer_name)
+    assert written.isValid()
+    return written
+
+
 class ScenarioRegistryTest(unittest.TestCase):
     """Test ScenarioRegistry."""
 
@@ -206,6 +228,49 @@ class ScenarioRegistryTest(unittest.TestCase):
         self.assertTrue(reg.scenario_exists(3))
         self.assertFalse(reg.scenario_exists(5))
 
+    def testMetadataCache(self):
+        """
+        Test that cached scenario metadata is invalidated when the scenarios change
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        self.assertEqual(reg.scenario_list(), [1, 2, 3])
+        self.assertEqual(reg.get_scenario_name('2'), 'scenario B')
+        with self.assertRaises(KeyError):
+            reg.get_scenario_name(5)
+
+        # provider changes aren't tracked
+        f = QgsFeature()
+        f.setAttributes([5, "scenario 5", QDateTime(QDate(2018, 9, 9), QTime(12, 13, 14)), 'user 5'])
+        self.assertTrue(layer.dataProvider().addFeatures([f]))
+        self.assertFalse(reg.scenario_exists(5))
+        reg.invalidate()
+        self.assertTrue(reg.scenario_exists(5))
+        self.assertEqual(reg.get_scenario_name(5), 'scenario 5')
+
+        # but changes made through the layer are
+        layer.startEditing()
+        self.assertTrue(layer.changeAttributeValue(next(layer.getFeatures('id=5')).id(), 1, 'a scenario'))
+        self.assertEqual(reg.get_scenario_name(5), 'a scenario')
+        self.assertTrue(reg.scenario_name_exists('a scenario'))
+        self.assertFalse(reg.scenario_name_exists('scenario 5'))
+        self.assertEqual(reg.scenario_titles(), OrderedDict([('Scenario 1', 1), ('a scenario', 5), ('scenario 3', 3),
+                                                              ('scenario B', 2)]))
+        f = QgsFeature(layer.fields())
+        f.setAttributes([6, "scenario 6", NULL, NULL])
+        self.assertTrue(layer.addFeature(f))
+        self.assertEqual(reg.scenario_list(), [1, 2, 3, 5, 6])
+        layer.rollBack()
+        self.assertEqual(reg.scenario_list(), [1, 2, 3, 5])
+        self.assertEqual(reg.get_scenario_name(5), 'scenario 5')
+
     def testBranch(self):
         """
         Test branching scenario
@@ -285,6 +350,278 @@ class ScenarioRegistryTest(unittest.TestCase):
                              [1, 5, 0, 'a', 'x'],
                              [2, 5, 1, 'b', 'y']])
 
+    def testBranchLineage(self):  # pylint: disable=too-many-statements
+        """
+        Test branching scenarios with a lineage
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        self.assertFalse(reg.supports_lineage())
+        self.assertTrue(reg.add_lineage_field())
+        self.assertTrue(reg.supports_lineage())
+        self.assertIsNone(reg.parent_scenario(1))
+        self.assertEqual(reg.scenario_lineage(1), [1])
+
+        # no meshblock records should be copied
+        res, error = reg.branch_scenario(1, 'Scenario 5')
+        self.assertFalse(error)
+        self.assertEqual(res, 4)
+        self.assertEqual(mb_electorate_layer.featureCount(), 4)
+        self.assertEqual(reg.parent_scenario(4), 1)
+        self.assertEqual(reg.scenario_lineage(4), [4, 1])
+
+        res, error = reg.branch_scenario(4, 'Scenario 6')
+        self.assertFalse(error)
+        self.assertEqual(res, 5)
+        self.assertEqual(reg.scenario_lineage(5), [5, 4, 1])
+        self.assertEqual(mb_electorate_layer.featureCount(), 4)
+
+        # inherited meshblocks
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(5).items()}, {0: 'c', 1: 'd'})
+        self.assertEqual([f['meshblock_number'] for f in
+                          reg.electorate_meshblocks(electorate_id='c', electorate_type='GN', scenario_id=5)], [0])
+        self.assertCountEqual([(f['scenario_id'], f['meshblock_number']) for f in
+                               reg.meshblocks_for_scenarios(scenario_ids=[2, 4])],
+                              [(2, 0), (2, 1), (4, 0), (4, 1)])
+
+        # preparing for changes copies records to the changed scenario and its branches
+        self.assertTrue(reg.prepare_scenario_changes(4, [0]))
+        self.assertCountEqual([(f['scenario_id'], f['meshblock_number'], f['gn_id']) for f in
+                               mb_electorate_layer.getFeatures() if f['scenario_id'] in (4, 5)],
+                              [(4, 0, 'c'), (5, 0, 'c')])
+        changed_id = [f.id() for f in mb_electorate_layer.getFeatures() if f['scenario_id'] == 4][0]
+        self.assertTrue(mb_electorate_layer.dataProvider().changeAttributeValues({changed_id: {3: 'e'}}))
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(4).items()}, {0: 'e', 1: 'd'})
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(5).items()}, {0: 'c', 1: 'd'})
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(1).items()}, {0: 'c', 1: 'd'})
+        self.assertEqual([f['meshblock_number'] for f in
+                          reg.electorate_meshblocks(electorate_id='e', electorate_type='GN', scenario_id=4)], [0])
+        self.assertFalse([f for f in
+                          reg.electorate_meshblocks(electorate_id='c', electorate_type='GN', scenario_id=4)])
+        self.assertEqual([f['meshblock_number'] for f in
+                          reg.electorate_meshblocks(electorate_id='c', electorate_type='GN', scenario_id=5)], [0])
+        self.assertEqual(reg.scenario_electorate_meshblock_numbers(4, 'GN'), {'e': [0], 'd': [1]})
+        self.assertEqual(reg.scenario_electorate_meshblock_numbers(5, 'GN'), {'c': [0], 'd': [1]})
+
+        # using a known index of the scenario's own records
+        count = mb_electorate_layer.featureCount()
+        own_5 = {f['meshblock_number']: f.id() for f in mb_electorate_layer.getFeatures() if f['scenario_id'] == 5}
+        self.assertEqual(list(own_5.keys()), [0])
+        self.assertTrue(reg.prepare_scenario_changes(5, [0], own_records=own_5))
+        self.assertEqual(mb_electorate_layer.featureCount(), count)
+        self.assertTrue(reg.prepare_scenario_changes(4, [0], own_records={0: changed_id}))
+        self.assertEqual(mb_electorate_layer.featureCount(), count)
+        # meshblock 1 is inherited by scenario 4, so is copied to both scenario 4 and its branch
+        self.assertTrue(reg.prepare_scenario_changes(4, [0, 1], own_records={0: changed_id}))
+        self.assertCountEqual([(f['scenario_id'], f['meshblock_number'], f['gn_id']) for f in
+                               mb_electorate_layer.getFeatures() if f['scenario_id'] in (4, 5)],
+                              [(4, 0, 'e'), (4, 1, 'd'), (5, 0, 'c'), (5, 1, 'd')])
+
+        # materialize
+        self.assertTrue(reg.materialize_scenario(5))
+        self.assertIsNone(reg.parent_scenario(5))
+        self.assertEqual(reg.scenario_lineage(5), [5])
+        self.assertCountEqual([(f['meshblock_number'], f['gn_id']) for f in
+                               mb_electorate_layer.getFeatures() if f['scenario_id'] == 5],
+                              [(0, 'c'), (1, 'd')])
+
+        # deep lineages are materialized when branched
+        parent = 4
+        depths = []
+        for i in range(ScenarioRegistry.MAX_LINEAGE_DEPTH + 1):
+            parent, error = reg.branch_scenario(parent, f'Deep {i}')
+            self.assertFalse(error)
+            depths.append(len(reg.scenario_lineage(parent)))
+        self.assertIn(1, depths)
+        self.assertLessEqual(max(depths), ScenarioRegistry.MAX_LINEAGE_DEPTH)
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(parent).items()}, {0: 'e', 1: 'd'})
+
+    def testDisabledLineage(self):
+        """
+        Test disabling lineages for a scenario layer with existing lineages
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = make_meshblock_electorate_layer()
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        self.assertTrue(reg.add_lineage_field())
+        self.assertFalse(reg.has_lineages())
+        res, error = reg.branch_scenario(1, 'Scenario 5')
+        self.assertFalse(error)
+        self.assertTrue(reg.has_lineages())
+        self.assertEqual(mb_electorate_layer.featureCount(), 4)
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer,
+            use_lineage=False
+        )
+        self.assertTrue(reg.has_lineage_field())
+        self.assertFalse(reg.supports_lineage())
+        # existing lineages are still resolved
+        self.assertEqual(reg.scenario_lineage(res), [res, 1])
+        self.assertEqual({n: f['gn_id'] for n, f in reg.scenario_features(res).items()}, {0: 'c', 1: 'd'})
+
+        # new branches are full copies
+        res2, error = reg.branch_scenario(1, 'Scenario 6')
+        self.assertFalse(error)
+        self.assertEqual(reg.scenario_lineage(res2), [res2])
+        self.assertEqual(mb_electorate_layer.featureCount(), 6)
+
+        self.assertTrue(reg.materialize_all_scenarios())
+        self.assertFalse(reg.has_lineages())
+        self.assertEqual(reg.scenario_lineage(res), [res])
+        self.assertCountEqual([(f['meshblock_number'], f['gn_id']) for f in
+                               mb_electorate_layer.getFeatures() if f['scenario_id'] == res],
+                              [(0, 'c'), (1, 'd')])
+
+    def testGeoPackageCopy(self):
+        """
+        Test branching and importing scenarios stored in GeoPackages
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = os.path.join(temp_dir, 'test.gpkg')
+            layer = write_geopackage_layer(make_scenario_layer(), database, 'scenarios')
+            mb_electorate_layer = write_geopackage_layer(make_meshblock_electorate_layer(), database,
+                                                         'meshblock_electorates')
+            self.assertEqual(ScenarioRegistry.geopackage_table(mb_electorate_layer),
+                             (database, 'meshblock_electorates'))
+            self.assertIsNone(ScenarioRegistry.geopackage_table(make_meshblock_electorate_layer()))
+
+            reg = ScenarioRegistry(
+                source_layer=layer,
+                id_field='id',
+                name_field='name',
+                meshblock_electorate_layer=mb_electorate_layer
+            )
+            res, error = reg.branch_scenario(1, 'Scenario 5')
+            self.assertFalse(error)
+            self.assertEqual(res, 4)
+            self.assertEqual(mb_electorate_layer.featureCount(), 6)
+            self.assertCountEqual([(f['scenario_id'], f['meshblock_number'], f['gn_id'], f['gs_id']) for f in
+                                   mb_electorate_layer.getFeatures() if f['scenario_id'] == 4],
+                                  [(4, 0, 'c', 'z'), (4, 1, 'd', 'zz')])
+            self.assertEqual(len({f.id() for f in mb_electorate_layer.getFeatures()}), 6)
+
+            # import from another database
+            other_database = os.path.join(temp_dir, 'other.gpkg')
+            other_reg = ScenarioRegistry(
+                source_layer=write_geopackage_layer(make_scenario_layer(), other_database, 'scenarios'),
+                id_field='id',
+                name_field='name',
+                meshblock_electorate_layer=write_geopackage_layer(make_meshblock_electorate_layer(), other_database,
+                                                                  'meshblock_electorates')
+            )
+            res, error = reg.import_scenario_from_other_registry(source_registry=other_reg,
+                                                                 source_scenario_id=2,
+                                                                 new_scenario_name='imported')
+            self.assertFalse(error)
+            self.assertEqual(res, 5)
+            self.assertCountEqual([(f['scenario_id'], f['meshblock_number'], f['gn_id'], f['gs_id']) for f in
+                                   mb_electorate_layer.getFeatures() if f['scenario_id'] == 5],
+                                  [(5, 0, 'a', 'x'), (5, 1, 'b', 'y')])
+            self.assertEqual(other_reg.meshblock_electorate_layer.featureCount(), 4)
+
+            # uncommitted changes must be respected
+            mb_electorate_layer.startEditing()
+            res, error = reg.branch_scenario(5, 'Scenario 6')
+            self.assertFalse(error)
+            self.assertCountEqual([(f['scenario_id'], f['meshblock_number'], f['gn_id']) for f in
+                                   mb_electorate_layer.getFeatures() if f['scenario_id'] == res],
+                                  [(res, 0, 'a'), (res, 1, 'b')])
+
+            del reg
+            del other_reg
+            del layer
+            del mb_electorate_layer
+
+    def testSnapshots(self):
+        """
+        Test exporting and importing scenario snapshots
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int",
+            "source", "memory")
+        features = []
+        for attributes in ([1, 2, 0, 5, 7], [2, 2, 1, 6, NULL], [3, 1, 0, 8, 9], [4, 2, 3, 5, 7]):
+            f = QgsFeature()
+            f.setAttributes(attributes)
+            features.append(f)
+        mb_electorate_layer.dataProvider().addFeatures(features)
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'test.rdsnap')
+            res, error = reg.export_scenario_snapshot(2, path)
+            self.assertTrue(res)
+            self.assertFalse(error)
+            snapshot = ScenarioSnapshot.read(path)
+            self.assertEqual(snapshot.name, 'scenario B')
+            self.assertEqual(list(snapshot.meshblock_numbers), [0, 1, 3])
+            self.assertEqual(snapshot.electorates_by_meshblock('GN'), {0: 5, 1: 6, 3: 5})
+            self.assertEqual(snapshot.electorates_by_meshblock('GS'), {0: 7, 3: 7})
+            self.assertEqual(snapshot.electorates_by_meshblock('M'), {})
+            snapshot.close()
+
+            # custom meshblock ordering
+            res, error = reg.export_scenario_snapshot(2, path, meshblock_numbers=[3, 2, 0])
+            self.assertTrue(res)
+            snapshot = ScenarioSnapshot.read(path)
+            self.assertEqual(list(snapshot.meshblock_numbers), [3, 2, 0])
+            self.assertEqual(list(snapshot.electorates('GN')), [5, ScenarioSnapshot.NO_ELECTORATE, 5])
+            snapshot.close()
+
+            res, error = reg.export_scenario_snapshot(5, path)
+            self.assertFalse(res)
+            self.assertTrue(error)
+
+            # import
+            res, error = reg.import_scenario_snapshot(path)
+            self.assertFalse(res)
+            self.assertIn('already exists', error)
+            res, error = reg.import_scenario_snapshot(path, 'imported')
+            self.assertFalse(error)
+            self.assertEqual(res, 4)
+            self.assertEqual(reg.get_scenario_name(4), 'imported')
+            self.assertCountEqual([(f['meshblock_number'], f['gn_id'], f['gs_id']) for f in
+                                   mb_electorate_layer.getFeatures() if f['scenario_id'] == 4],
+                                  [(3, 5, 7), (2, NULL, NULL), (0, 5, 7)])
+
+            res, error = reg.import_scenario_snapshot(os.path.join(temp_dir, 'missing.rdsnap'), 'x')
+            self.assertFalse(res)
+            self.assertTrue(error)
+
+            # string electorate ids can't be stored
+            reg = ScenarioRegistry(
+                source_layer=make_scenario_layer(),
+                id_field='id',
+                name_field='name',
+                meshblock_electorate_layer=make_meshblock_electorate_layer()
+            )
+            res, error = reg.export_scenario_snapshot(1, path)
+            self.assertFalse(res)
+            self.assertTrue(error)
+
     def testCopyScenarios(self):
         """
         Test copying scenarios between registries
@@ -441,6 +778,51 @@ class ScenarioRegistryTest(unittest.TestCase):
                reg.meshblocks_for_scenarios(scenario_ids=[4])]
         self.assertFalse(res)
 
+    def testScenarioElectorateMeshblocks(self):
+        """
+        Test retrieving all electorate meshblocks for a scenario in a single pass
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:string",
+            "source", "memory")
+        f = QgsFeature()
+        f.setAttributes([1, 1, 13, 1, 'x'])
+        f2 = QgsFeature()
+        f2.setAttributes([2, 1, 11, 1, NULL])
+        f3 = QgsFeature()
+        f3.setAttributes([3, 1, 12, 2, '3'])
+        f4 = QgsFeature()
+        f4.setAttributes([4, 2, 12, 1, 'x'])
+        f5 = QgsFeature()
+        f5.setAttributes([5, 1, 99, 2, 'x'])
+        mb_electorate_layer.dataProvider().addFeatures([f, f2, f3, f4, f5])
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        store = MeshblockStore(meshblock_layer=make_store_meshblock_layer(),
+                               meshblock_number_field_name='MeshblockNumber')
+        store.ensure_built()
+
+        # meshblock 99 is not in the store, and m_id field is missing
+        res = reg.scenario_electorate_meshblocks(scenario_id=1, meshblock_store=store)
+        self.assertEqual({t: {e: list(m) for e, m in v.items()} for t, v in res.items()},
+                         {'GN': {1: [2, 0], 2: [1]},
+                          'GS': {'x': [2], 3: [1]}})
+        res = reg.scenario_electorate_meshblocks(scenario_id=2, meshblock_store=store, electorate_types=['GN'])
+        self.assertEqual({t: {e: list(m) for e, m in v.items()} for t, v in res.items()},
+                         {'GN': {1: [1]}})
+        res = reg.scenario_electorate_meshblocks(scenario_id=3, meshblock_store=store, electorate_types=['GS', 'M'])
+        self.assertEqual(res, {'GS': {}})
+
+        self.assertEqual(ScenarioRegistry.electorate_key('3'), 3)
+        self.assertEqual(ScenarioRegistry.electorate_key(3), 3)
+        self.assertEqual(ScenarioRegistry.electorate_key('x'), 'x')
+
     def testElectorateHasMeshblocks(self):
         """
         Test checking whether an electorate has meshblocks assigned
@@ -615,6 +997,96 @@ class ScenarioRegistryTest(unittest.TestCase):
         self.assertEqual([f['staged_electorate'] for f in meshblock_layer.getFeatures()], [7, 8, 7, 8, 7, 8])
 
 
+    def testIncrementalSwitchTask(self):  # pylint: disable=too-many-locals
+        """
+        Test incremental scenario switch task
+        """
+        layer = make_scenario_layer()
+        mb_electorate_layer = QgsVectorLayer(
+            "NoGeometry?field=id:int&field=scenario_id:int&field=meshblock_number:int&field=gn_id:int&field=gs_id:int&field=m_id:int",
+            "source", "memory")
+        features = []
+        for i, (scenario, meshblock, gn, gs, m) in enumerate([(1, 11, 1, 0, 7),
+                                                               (1, 12, 2, 0, 7),
+                                                               (1, 13, 2, 0, 7),
+                                                               (1, 14, 0, 4, 8),
+                                                               (1, 15, 0, 5, 8),
+                                                               (2, 11, 1, 0, 7),
+                                                               (2, 12, 2, 0, 7),
+                                                               (2, 13, 3, 0, 7),
+                                                               (2, 14, 0, 4, 8),
+                                                               (2, 15, 0, 5, 8)]):
+            f = QgsFeature()
+            f.setAttributes([i + 1, scenario, meshblock, gn, gs, m])
+            features.append(f)
+        mb_electorate_layer.dataProvider().addFeatures(features)
+
+        reg = ScenarioRegistry(
+            source_layer=layer,
+            id_field='id',
+            name_field='name',
+            meshblock_electorate_layer=mb_electorate_layer
+        )
+        electorate_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=electorate_id:int&field=code:string&field=type:string&field=estimated_pop:int&field=scenario_id:int&field=invalid:int&field=invalid_reason:string&field=name:string&field=stats_nz_pop:int&field=stats_nz_var_20:int&field=stats_nz_var_23:int&field=expected_regions:int&field=deprecated:int",
+            "source", "memory")
+        features = []
+        for electorate_id, electorate_type in [(1, 'GN'), (2, 'GN'), (3, 'GN'), (4, 'GS'), (5, 'GS'), (7, 'M'),
+                                               (8, 'M')]:
+            f = QgsFeature()
+            f.setAttributes([electorate_id, f'test{electorate_id}', electorate_type, -1, 0])
+            features.append(f)
+        electorate_layer.dataProvider().addFeatures(features)
+
+        meshblock_layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=MeshblockNumber:string&field=offline_pop_m:int&field=offline_pop_gn:int&field=offline_pop_gs:int&field=staged_electorate:int&field=offshore:int",
+            "source", "memory")
+        features = []
+        for meshblock, x in [('11', 1), ('12', 2), ('13', 4), ('14', 6), ('15', 8)]:
+            f = QgsFeature()
+            f.setAttributes([meshblock, 1, 10, 100])
+            f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, x + 1)))
+            features.append(f)
+        meshblock_layer.dataProvider().addFeatures(features)
+
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1)
+        self.assertTrue(task.run())
+
+        # tweak unchanged electorate geometries, so we can tell if they are rebuilt
+        electorate_ids = {f['electorate_id']: f.id() for f in electorate_layer.getFeatures()}
+        electorate_layer.dataProvider().changeGeometryValues(
+            {electorate_ids[1]: QgsGeometry.fromPointXY(QgsPointXY(100, 100)),
+             electorate_ids[4]: QgsGeometry.fromPointXY(QgsPointXY(104, 104)),
+             electorate_ids[5]: QgsGeometry.fromPointXY(QgsPointXY(105, 105))})
+        # electorate 5 isn't storing the results of the current scenario, so must be rebuilt
+        electorate_layer.dataProvider().changeAttributeValues({electorate_ids[5]: {4: 3}})
+        # validation results and statistics are specific to the current scenario
+        electorate_layer.dataProvider().changeAttributeValues({electorate_ids[1]: {5: 1, 6: 'bad', 8: 50, 9: 2}})
+
+        task = ScenarioSwitchTask(task_name='', electorate_layer=electorate_layer, meshblock_layer=meshblock_layer,
+                                  meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=2,
+                                  current_scenario=1)
+        # nothing is read until the task is prepared
+        self.assertFalse(task.electorates_to_process)
+        task.prepare()
+        self.assertEqual(len(task.unchanged_electorates), 4)
+        self.assertCountEqual(task.electorates_to_process.keys(), [2, 3, 5])
+        self.assertTrue(task.run())
+        self.assertEqual([f['scenario_id'] for f in electorate_layer.getFeatures()], [2] * 7)
+        self.assertEqual([f['estimated_pop'] for f in electorate_layer.getFeatures()],
+                         [10, 10, 10, 100, 100, 3, 2])
+        self.assertEqual([(f['invalid'], f['invalid_reason'], f['stats_nz_pop'], f['stats_nz_var_20'])
+                          for f in electorate_layer.getFeatures()][0], (NULL, NULL, NULL, NULL))
+        self.assertEqual([normalized_wkt(f.geometry()) for f in electorate_layer.getFeatures()],
+                         ['Point (100 100)',
+                          'Point (2 3)',
+                          'Point (4 5)',
+                          'Point (104 104)',
+                          'Point (8 9)',
+                          'MultiPoint ((4 5),(2 3),(1 2))',
+                          'MultiPoint ((8 9),(6 7))'])
+
 if __name__ == "__main__":
     suite = unittest.makeSuite(ScenarioRegistry)
     runner = unittest.TextTestRunner(verbosity=2)
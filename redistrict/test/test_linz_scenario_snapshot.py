@@ -0,0 +1,124 @@
+"""
+LINZ Scenario Snapshot test.
+"""
+
+from array import array
+import os
+import tempfile
+import unittest
+from redistrict.linz.scenario_snapshot import ScenarioSnapshot
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def make_snapshot(name: str, gn_changes=None) -> ScenarioSnapshot:
+    """
+    Makes a snapshot for testing, with optional changes to GN electorates as
+    a dictionary of ordinal to electorate id
+    """
+    count = 10000
+    gn = array('q', [ordinal % 7 for ordinal in range(count)])
+    for ordinal, electorate in (gn_changes or {}).items():
+        gn[ordinal] = electorate
+    return ScenarioSnapshot(name, array('q', range(100, 100 + count)),
+                            {'GN': gn, 'GS': array('q', [1]) * count})
+
+
+class ScenarioSnapshotTest(unittest.TestCase):
+    """Test ScenarioSnapshot."""
+
+    def setUp(self):
+        """
+        Creates a temporary directory for each test
+        """
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.temp_dir.name, 'test.rdsnap')
+
+    def tearDown(self):
+        """
+        Removes temporary directory
+        """
+        self.temp_dir.cleanup()
+
+    def testSnapshot(self):
+        """
+        Test snapshot contents
+        """
+        snapshot = ScenarioSnapshot('s', array('q', [11, 12, 13]), {'GN': array('q', [1, -1, 2])})
+        self.assertEqual(snapshot.meshblock_count(), 3)
+        self.assertEqual(list(snapshot.electorates('gn')), [1, -1, 2])
+        self.assertEqual(list(snapshot.electorates('M')), [-1, -1, -1])
+        self.assertEqual(snapshot.electorates_by_meshblock('GN'), {11: 1, 13: 2})
+        self.assertEqual(snapshot.electorates_by_meshblock('GS'), {})
+
+    def testReadWrite(self):
+        """
+        Test writing and reading snapshots
+        """
+        make_snapshot('Scenario ā').write(self.path)
+        snapshot = ScenarioSnapshot.read(self.path)
+        self.assertEqual(snapshot.name, 'Scenario ā')
+        self.assertEqual(snapshot.meshblock_count(), 10000)
+        self.assertEqual(snapshot.meshblock_numbers[5], 105)
+        self.assertEqual(snapshot.electorates('GN')[8], 1)
+        self.assertEqual(snapshot.electorates('GS')[8], 1)
+        self.assertEqual(snapshot.electorates('M')[8], ScenarioSnapshot.NO_ELECTORATE)
+        self.assertTrue(snapshot.has_same_meshblocks(make_snapshot('x')))
+        snapshot.close()
+        self.assertEqual(snapshot.meshblock_count(), 0)
+
+        # corrupt snapshot
+        with open(self.path, 'rb') as f:
+            contents = bytearray(f.read())
+        contents[-1] ^= 1
+        with open(self.path, 'wb') as f:
+            f.write(contents)
+        with self.assertRaises(ValueError):
+            ScenarioSnapshot.read(self.path)
+        snapshot = ScenarioSnapshot.read(self.path, verify=False)
+        self.assertEqual(snapshot.meshblock_count(), 10000)
+        snapshot.close()
+
+        # truncated snapshot
+        with open(self.path, 'wb') as f:
+            f.write(contents[:-8])
+        with self.assertRaises(ValueError):
+            ScenarioSnapshot.read(self.path)
+
+        # not a snapshot
+        with open(self.path, 'wb') as f:
+            f.write(b'')
+        with self.assertRaises(ValueError):
+            ScenarioSnapshot.read(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 100)
+        with self.assertRaises(ValueError):
+            ScenarioSnapshot.read(self.path)
+
+    def testChangedMeshblocks(self):
+        """
+        Test diffing snapshots
+        """
+        base = make_snapshot('base')
+        base.write(self.path)
+        base = ScenarioSnapshot.read(self.path)
+        secondary = make_snapshot('secondary', {5: 99, 9000: 99, 9001: 99})
+        self.assertEqual(ScenarioSnapshot.changed_meshblocks(base, secondary, 'GN'), [105, 9100, 9101])
+        self.assertEqual(ScenarioSnapshot.changed_meshblocks(secondary, base, 'GN'), [105, 9100, 9101])
+        self.assertFalse(ScenarioSnapshot.changed_meshblocks(base, secondary, 'GS'))
+        self.assertFalse(ScenarioSnapshot.changed_meshblocks(base, make_snapshot('x'), 'GN'))
+
+        # different meshblock ordering
+        other = ScenarioSnapshot('other', array('q', [106, 105, 99999]), {'GN': array('q', [6, 99, 3])})
+        small = ScenarioSnapshot('small', array('q', [105, 106]), {'GN': array('q', [5, 6])})
+        self.assertEqual(ScenarioSnapshot.changed_meshblocks(small, other, 'GN'), [105, 99999])
+        self.assertEqual(ScenarioSnapshot.changed_meshblocks(other, small, 'GN'), [105, 99999])
+        self.assertEqual(len(ScenarioSnapshot.changed_meshblocks(base, other, 'GN')), 10000)
+        base.close()
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ScenarioSnapshotTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,107 @@
+"""
+LINZ User Log Writer test.
+"""
+
+import unittest
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsVectorLayer)
+from redistrict.linz.user_log_writer import UserLogWriter
+from redistrict.linz.electorate_changes_queue import ElectorateEditQueue
+from redistrict.test.test_linz_redistrict_handler import make_user_log_layer
+from redistrict.test.utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def make_log_entry(layer: QgsVectorLayer, username: str) -> QgsFeature:
+    """
+    Makes a user log entry for testing
+    """
+    f = QgsFeature(layer.fields())
+    f['username'] = username
+    return f
+
+
+class UserLogWriterTest(unittest.TestCase):
+    """Test UserLogWriter."""
+
+    def testUnbuffered(self):
+        """
+        Test writing entries directly to the layer
+        """
+        layer = make_user_log_layer()
+        writer = UserLogWriter(layer)
+        handles = writer.add_entries([make_log_entry(layer, 'a'), make_log_entry(layer, 'b')])
+        self.assertEqual([f['username'] for f in layer.getFeatures()], ['a', 'b'])
+        self.assertFalse(writer.pending_entries())
+
+        writer.remove_entries(handles[:1])
+        self.assertEqual([f['username'] for f in layer.getFeatures()], ['b'])
+
+        # failed writes must not return handles
+        invalid_entry = QgsFeature()
+        invalid_entry.setAttributes(['x'] * (layer.fields().count() + 1))
+        self.assertEqual(writer.add_entries([invalid_entry]), [])
+        self.assertEqual([f['username'] for f in layer.getFeatures()], ['b'])
+
+    def testBuffered(self):
+        """
+        Test buffering entries until flushed
+        """
+        layer = make_user_log_layer()
+        writer = UserLogWriter(layer, buffered=True)
+        handles = writer.add_entries([make_log_entry(layer, 'a'), make_log_entry(layer, 'b')])
+        writer.add_entries([make_log_entry(layer, 'c')])
+        self.assertEqual(layer.featureCount(), 0)
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a', 'b', 'c'])
+
+        writer.remove_entries(handles[1:])
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a', 'c'])
+
+        self.assertTrue(writer.flush())
+        self.assertEqual([f['username'] for f in layer.getFeatures()], ['a', 'c'])
+        self.assertFalse(writer.pending_entries())
+
+        writer.add_entries([make_log_entry(layer, 'd')])
+        writer.discard()
+        self.assertTrue(writer.flush())
+        self.assertEqual(layer.featureCount(), 2)
+
+    def testQueue(self):
+        """
+        Test buffering user log entries from the electorate changes queue
+        """
+        district_layer = QgsVectorLayer("Polygon?crs=EPSG:4326&field=fld1:string", "source", "memory")
+        d = QgsFeature()
+        d.setAttributes(["test1"])
+        d.setGeometry(QgsGeometry.fromRect(QgsRectangle(5, 0, 10, 5)))
+        success, [d] = district_layer.dataProvider().addFeatures([d])
+        self.assertTrue(success)
+
+        layer = make_user_log_layer()
+        writer = UserLogWriter(layer, buffered=True)
+        queue = ElectorateEditQueue(electorate_layer=district_layer, user_log_layer=layer, user_log_writer=writer)
+        queue.push_changes({d.id(): {0: 'x1'}}, {}, [make_log_entry(layer, 'a')])
+        queue.push_changes({d.id(): {0: 'x2'}}, {}, [make_log_entry(layer, 'b'), make_log_entry(layer, 'c')])
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a', 'b', 'c'])
+
+        self.assertTrue(queue.back())
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a'])
+        self.assertTrue(queue.forward())
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a', 'b', 'c'])
+        self.assertTrue(queue.jump_to(0))
+        self.assertFalse(writer.pending_entries())
+        self.assertTrue(queue.jump_to(2))
+        self.assertEqual([f['username'] for f in writer.pending_entries()], ['a', 'b', 'c'])
+        self.assertEqual(layer.featureCount(), 0)
+
+        self.assertTrue(writer.flush())
+        self.assertEqual([f['username'] for f in layer.getFeatures()], ['a', 'b', 'c'])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(UserLogWriterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -16,6 +16,7 @@ from redistrict.linz.scenario_registry import ScenarioRegistry
 from redistrict.linz.linz_district_registry import \
     LinzElectoralDistrictRegistry
 from redistrict.linz.validation_task import ValidationTask
+from redistrict.linz.meshblock_adjacency_graph import MeshblockAdjacencyGraph
 from redistrict.test.test_linz_scenario_registry import make_scenario_layer
 from redistrict.test.test_linz_district_registry import make_quota_layer
 
@@ -219,6 +220,40 @@ class ValidationTaskTest(unittest.TestCase):
                           [7, 'test7', 'M', 1, 0, 1, 1, 'Deprecated electorate has meshblocks assigned', NULL],
                           [8, 'test8', 'M', 0, 1, 1, 0, NULL, NULL]])
 
+        # contiguity using meshblock adjacency graph
+        graph = MeshblockAdjacencyGraph(':memory:')
+        graph.set_edges([11, 12, 13, 14, 15, 16], [(12, 13, 1.0), (14, 15, 1.0)])
+        electorate_registry = LinzElectoralDistrictRegistry(source_layer=electorate_layer, source_field='electorate_id',
+                                                            title_field='code', electorate_type='GN',
+                                                            quota_layer=quota_layer)
+        task = ValidationTask(task_name='', electorate_registry=electorate_registry, meshblock_layer=meshblock_layer,
+                              meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                              task='GN', meshblock_graph=graph)
+        self.assertTrue(task.run())
+        self.assertEqual(len(task.results), 2)
+        self.assertEqual(task.results[0][ValidationTask.ELECTORATE_ID], 3)
+        self.assertEqual(task.results[0][ValidationTask.ERROR], 'Outside quota tolerance')
+        self.assertEqual(task.results[0][ValidationTask.ELECTORATE_GEOMETRY].asWkt(0), 'MultiPoint ((6 7),(8 9))')
+        self.assertEqual(task.results[1][ValidationTask.ELECTORATE_ID], 3)
+        self.assertEqual(task.results[1][ValidationTask.ERROR], 'Electorate has less parts than expected')
+        # geometries should only be calculated for invalid electorates
+        self.assertEqual(list(task.electorate_geometries.keys()), [3])
+        self.assertEqual([f.attributes()[:9] for f in electorate_layer.getFeatures()][:3],
+                         [[1, 'test1', 'GN', 58900, 1, 0, 0, NULL, NULL],
+                          [2, 'test2', 'GN', 59000, 1, 0, 0, NULL, NULL],
+                          [3, 'test3', 'GN', 1, 0, 0, 1, 'Electorate has less parts than expected', NULL]])
+
+        # graph doesn't match meshblocks, so geometries must be used
+        graph.set_edges([11, 12], [(11, 12, 1.0)])
+        task = ValidationTask(task_name='', electorate_registry=electorate_registry, meshblock_layer=meshblock_layer,
+                              meshblock_number_field_name='MeshblockNumber', scenario_registry=reg, scenario=1,
+                              task='GN', meshblock_graph=graph)
+        self.assertTrue(task.run())
+        self.assertFalse(task.use_meshblock_graph())
+        self.assertEqual([r[ValidationTask.ERROR] for r in task.results],
+                         ['Electorate is non-contiguous', 'Contiguous part 1', 'Contiguous part 2', 'Contiguous part 3',
+                          'Outside quota tolerance'])
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(ValidationTaskTest)
@@ -0,0 +1,57 @@
+"""
+Process Pool Dissolver Test.
+"""
+
+import unittest
+from qgis.core import (QgsGeometry,
+                       QgsRectangle)
+from redistrict.core.process_dissolver import (ProcessPoolDissolver,
+                                               dissolve_wkb)
+from redistrict.test.utilities import (get_qgis_app,
+                                       normalized_wkt)
+
+QGIS_APP = get_qgis_app()
+
+
+class ProcessPoolDissolverTest(unittest.TestCase):
+    """Test ProcessPoolDissolver."""
+
+    def testDissolveWkb(self):
+        """
+        Test dissolving WKB geometries
+        """
+        parts = [bytes(QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)).asWkb()),
+                 bytes(QgsGeometry.fromRect(QgsRectangle(1, 0, 2, 1)).asWkb())]
+        res = ProcessPoolDissolver.geometry_from_result(dissolve_wkb(parts))
+        self.assertAlmostEqual(res.area(), 2, 5)
+        self.assertFalse(res.isMultipart() and res.constGet().numGeometries() > 1)
+
+        self.assertEqual(dissolve_wkb([]), b'')
+        self.assertTrue(ProcessPoolDissolver.geometry_from_result(b'').isNull())
+        geometry = QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1))
+        self.assertEqual(ProcessPoolDissolver.geometry_from_result(geometry).asWkt(), geometry.asWkt())
+
+    def testPythonExecutable(self):
+        """
+        Test retrieving the python executable for worker processes
+        """
+        self.assertTrue(ProcessPoolDissolver.python_executable())
+
+    def testSubmit(self):
+        """
+        Test dissolving in worker processes
+        """
+        dissolver = ProcessPoolDissolver(max_workers=1)
+        future = dissolver.submit([QgsGeometry.fromRect(QgsRectangle(0, 0, 1, 1)),
+                                   QgsGeometry.fromRect(QgsRectangle(3, 0, 4, 1))])
+        res = ProcessPoolDissolver.geometry_from_result(future.result(timeout=60))
+        self.assertEqual(normalized_wkt(res),
+                         normalized_wkt(QgsGeometry.fromWkt(
+                             'MultiPolygon (((0 0, 1 0, 1 1, 0 1, 0 0)),((3 0, 4 0, 4 1, 3 1, 3 0)))')))
+        dissolver.executor.shutdown()
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ProcessPoolDissolverTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)